@@ -1,28 +1,43 @@
 ﻿import argparse
+import atexit
+import bisect
+import contextlib
+import ctypes
 import dataclasses
 import datetime
+import concurrent.futures
 import enum
+import fnmatch
 import functools
 import glob
+import hashlib
+import inspect
+import io
+import json
 import multiprocessing
+import multiprocessing.connection
 import os
+import random
 import re
 import shlex
+import shutil
+import stat
+import struct
 import subprocess
 import sys
+import tarfile
+import tempfile
+import threading
+import time
 import traceback
 import typing
-
-import charset_normalizer
+import zipfile
 
 
 if os.name == "nt":
     OS_ENCODING = "mbcs"
-    OS_SHELL = [
-        subprocess.run(
-            "where.exe cmd", shell=True, encoding=OS_ENCODING, capture_output=True, check=True
-        ).stdout.strip(),
-    ]
+    # 不在import时启动 where.exe 查找
+    OS_SHELL = [os.environ.get("COMSPEC", "cmd.exe")]
 elif os.name == "posix":
     OS_ENCODING = "utf-8"
     OS_SHELL = [
@@ -30,7 +45,20 @@ elif os.name == "posix":
         # "-i", # -i 会使得bash置于前台，其子进程接收Ctrl+C命令
     ]
 
-SUBPROCESS_RUN = functools.partial(subprocess.run, OS_SHELL, executable=None, shell=False, encoding=OS_ENCODING)
+
+def SUBPROCESS_RUN(**kw) -> subprocess.CompletedProcess:
+    # jobserver 的文件描述符需要传给 make 等子进程
+    kw.setdefault("pass_fds", JobServer.PassFds())
+    cmd = (kw.get("input") or "shell").strip()
+    with Trace.Span(cmd.splitlines()[0][:80] if cmd else "shell", "subprocess", cmd=cmd[:2000], cwd=os.getcwd()):
+        return subprocess.run(OS_SHELL, executable=None, shell=False, encoding=OS_ENCODING, **kw)
+
+
+@dataclasses.dataclass()
+class PatchRule:
+    regex: re.Pattern
+    replacement: typing.Union[str, typing.Callable[[re.Match], str]]
+    lineCount: typing.Optional[int] = None  # 最多替换的行数, None表示不限制
 
 
 class Tools:
@@ -88,6 +116,60 @@ class Tools:
         except:
             return False
 
+    _probeResults: typing.Dict[str, bool] = {}
+
+    def _ProbeKey(cmdStr: str) -> str:
+        # 工具所在路径及修改时间, 工具升级或 PATH 改变后重新探测
+        words = shlex.split(cmdStr)
+        exes = [words[0]]
+        if len(words) > 1 and not words[1].startswith("-"):
+            exes.append(f"{words[0]}-{words[1]}")  # git lfs -> git-lfs
+        stamps = []
+        for exe in exes:
+            path = shutil.which(exe)
+            stamps.append(f"{path}:{os.stat(path).st_mtime_ns}" if path else "")
+        return "|".join([cmdStr, os.environ.get("PATH", "")] + stamps)
+
+    def _Probe(cmdStr: str) -> bool:
+        # 直接启动, 不经过shell
+        try:
+            return (
+                subprocess.run(
+                    shlex.split(cmdStr), stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+                ).returncode
+                == 0
+            )
+        except OSError:
+            return False
+
+    def CheckCommands(cmdList: typing.List[str]) -> typing.Dict[str, bool]:
+        """
+        Same as CheckCommand for each of cmdList, run concurrently.
+        Results are cached in build_cache/probes.json by PATH and the mtime of the tools.
+        """
+        cacheFile = os.path.join(Config.DIR_CACHE, "probes.json")
+        if not Tools._probeResults:
+            try:
+                with open(cacheFile, "r", encoding="utf-8") as fr:
+                    Tools._probeResults = json.load(fr)
+            except (OSError, ValueError):
+                Tools._probeResults = {}
+        keys = {cmd: Tools._ProbeKey(cmd) for cmd in cmdList}
+        missing = [cmd for cmd in cmdList if keys[cmd] not in Tools._probeResults]
+        if missing:
+            with concurrent.futures.ThreadPoolExecutor(len(missing)) as executor:
+                for cmd, result in zip(missing, executor.map(Tools._Probe, missing)):
+                    Tools._probeResults[keys[cmd]] = result
+            try:
+                os.makedirs(Config.DIR_CACHE, exist_ok=True)
+                tmpFile = f"{cacheFile}.{os.getpid()}.tmp"
+                with open(tmpFile, "w", encoding="utf-8") as fw:
+                    json.dump(Tools._probeResults, fw, indent=1)
+                os.replace(tmpFile, cacheFile)
+            except OSError:
+                pass
+        return {cmd: Tools._probeResults[keys[cmd]] for cmd in cmdList}
+
     def GlobByRegex(dir: str, regex: re.Pattern, recursive: bool = False) -> typing.List[str]:
         if (not os.path.exists(dir)) or (not os.path.isdir(dir)):
             return []
@@ -104,28 +186,97 @@ class Tools:
                 Tools.Log(f"{type(e)}: {str(e)}. {traceback.format_exc()}")
         return result
 
-    def RemoveFileOrDirs(dirPatten) -> None:
+    def _RemoveTree(path: str) -> None:
+        def OnError(fn, errPath, excInfo):
+            # 只读目录(如源码缓存)中的文件需要先加上写权限
+            if fn is os.rmdir or not os.path.lexists(errPath):
+                raise excInfo[1]
+            os.chmod(os.path.dirname(errPath), stat.S_IRWXU)
+            if os.path.isdir(errPath) and not os.path.islink(errPath):
+                shutil.rmtree(errPath, onerror=OnError)
+            else:
+                os.remove(errPath)
+
+        shutil.rmtree(path, onerror=OnError)
+
+    _trashProcesses: typing.List[subprocess.Popen] = []
+
+    def RemoveFileOrDirs(dirPatten, background: bool = False) -> None:
+        """
+        background: rename dirs away and delete them in a background process, for large trees.
+        """
         dirs = glob.glob(dirPatten)
-        if not dirs:
-            return
+        trash = []
+        if background:
+            # 上次没删完的
+            for d in [dirPatten] + dirs:
+                trash.extend(glob.glob(os.path.join(os.path.dirname(d), f".trash-{os.path.basename(d)}-*")))
         for d in dirs:
-            SUBPROCESS_RUN(input=rf'cmake -E rm -rf "{d}"', check=True)
+            if os.path.islink(d) or not os.path.isdir(d):
+                os.remove(d)
+            elif background:
+                trashDir = os.path.join(os.path.dirname(d), f".trash-{os.path.basename(d)}-{time.time_ns()}")
+                try:
+                    os.rename(d, trashDir)
+                    trash.append(trashDir)
+                except OSError:
+                    Tools._RemoveTree(d)
+            else:
+                Tools._RemoveTree(d)
+        if trash:
+            code = (
+                "import os, shutil, stat, sys\n"
+                "def OnError(fn, path, excInfo):\n"
+                "    try:\n"
+                "        os.chmod(os.path.dirname(path), stat.S_IRWXU)\n"
+                "        fn(path)\n"
+                "    except OSError:\n"
+                "        pass\n"
+                "for d in sys.argv[1:]:\n"
+                "    shutil.rmtree(d, onerror=OnError)\n"
+            )
+            Tools._trashProcesses.append(
+                subprocess.Popen(
+                    [sys.executable, "-c", code] + sorted(set(trash)),
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                    close_fds=True,
+                )
+            )
 
     def CopyFileOrDirs(src, dest) -> None:
+        """
+        Copy files or dirs matching src to dest, into dest if it is an existing dir. Symlinks are copied as is.
+        """
         if not os.path.exists(src):
             return
         srcList = glob.glob(src)
         if not srcList:
             return
         for item in srcList:
-            SUBPROCESS_RUN(input=rf'cmake -E copy "{item}" "{dest}"', check=True)
+            target = os.path.join(dest, os.path.basename(item)) if os.path.isdir(dest) else dest
+            if os.path.isdir(item) and not os.path.islink(item):
+                shutil.copytree(item, target, symlinks=True, dirs_exist_ok=True)
+                continue
+            if os.path.isfile(target) or os.path.islink(target):
+                # 目标可能是源码缓存的硬链接, 先断开, 不能写穿到缓存中
+                os.remove(target)
+            shutil.copy2(item, target, follow_symlinks=False)
 
-    def Decompress(filePatten: str, destDir: str) -> None:
+    def Decompress(filePatten: str, destDir: str, members: typing.List[str] = None) -> None:
+        """
+        Extract .tar.gz/.tar.xz/.tar.bz2/.zip into destDir in process.
+        members: fnmatch pattens of member names to be extracted, None means all.
+        """
         file = glob.glob(filePatten)
         assert len(file) == 1
         file = os.path.abspath(file[0])
         assert os.path.exists(destDir)
-        SUBPROCESS_RUN(input=rf'cmake -E tar -xf "{file}"', cwd=destDir, check=True)
+        if zipfile.is_zipfile(file):
+            Archive.ExtractZip(file, destDir, members)
+        else:
+            Archive.ExtractTar(file, destDir, members)
 
     def RegexLineByLine(
         filePatten: str,
@@ -137,34 +288,1316 @@ class Tools:
         Use regexSearcher.sub process file line by line.
         lineCount: maximum number of line to be replaced, None means no limit.
         """
+        Tools.PatchFile(filePatten, [PatchRule(regexSearcher, replacement, lineCount)])
+
+    def DetectEncoding(data: bytes) -> str:
+        # 绝大多数源码是 ascii/utf-8, 不必跑完整的编码检测
+        if data.isascii():
+            return "utf-8"
+        try:
+            data.decode("utf-8")
+            return "utf-8"
+        except UnicodeDecodeError:
+            pass
+        import charset_normalizer  # 较慢, 用到时才导入
+
+        encoding = charset_normalizer.detect(data)["encoding"]
+        if encoding is None:
+            raise UnicodeError("unknown encoding")
+        return encoding
+
+    def ReadText(file: str) -> typing.Tuple[str, str]:
+        """
+        Read and decode a whole text file, return (text, encoding). Line endings are kept.
+        """
+        with open(file, mode="rb") as fr:
+            data = fr.read()
+        encoding = Tools.DetectEncoding(data)
+        return data.decode(encoding), encoding
+
+    def _PatchRuleDigest(rule: "PatchRule") -> str:
+        if callable(rule.replacement):
+            try:
+                replacement = inspect.getsource(rule.replacement).strip()
+            except (OSError, TypeError):
+                replacement = rule.replacement.__qualname__
+        else:
+            replacement = rule.replacement
+        text = json.dumps([rule.regex.pattern, rule.regex.flags, replacement, rule.lineCount])
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+    def _PatchStream(fr: typing.TextIO, fw: typing.TextIO, rules: typing.List["PatchRule"]) -> bool:
+        # 每行依次应用所有规则, 规则替换次数用完后不再匹配, 全部用完则直接拷贝剩余内容
+        remain = [rule.lineCount for rule in rules]
+        active = list(range(len(rules)))
+        changed = False
+        for line in fr:
+            body = line.rstrip("\r\n")
+            eol = line[len(body) :]
+            for i in active:
+                newBody = rules[i].regex.sub(rules[i].replacement, body)
+                if newBody != body:
+                    body = newBody
+                    changed = True
+                    if remain[i] is not None:
+                        remain[i] -= 1
+            fw.write(body + eol)
+            active = [i for i in active if remain[i] is None or remain[i] > 0]
+            if not active:
+                fw.write(fr.read())
+                break
+        return changed
+
+    def PatchFile(filePatten: str, rules: typing.List["PatchRule"]) -> bool:
+        """
+        Apply rules to a text file line by line in one pass, rules are applied to each line in order.
+        Applied rules are recorded in a hidden stamp file next to it, they are skipped while the file is
+        unchanged since then. Return True if the file is rewritten.
+        """
         file = glob.glob(filePatten)
         assert len(file) == 1
         file = file[0]
-        with open(file, mode="rb") as fr:
-            encoding = charset_normalizer.detect(fr.read())["encoding"]
+        stampFile = os.path.join(os.path.dirname(file), f".{os.path.basename(file)}.patched")
+        digests = [Tools._PatchRuleDigest(rule) for rule in rules]
+        applied = []
+        try:
+            with open(stampFile, "r", encoding="utf-8") as fr:
+                stamp = json.load(fr)
+            st = os.stat(file)
+            if stamp["size"] == st.st_size and stamp["mtime_ns"] == st.st_mtime_ns:
+                applied = stamp["rules"]
+        except (OSError, ValueError, KeyError):
+            pass
+        pending = [rule for rule, digest in zip(rules, digests) if digest not in applied]
+        if not pending:
+            return False
+
         tmpFile = file + ".tmp"
-        if lineCount is None:
-            lineCount = int("0xFFFFFFFFFFFFFFF", 16)
+        changed = False
         try:
-            changedCount = 0
-            with open(tmpFile, "w", encoding=encoding) as fw:
-                with open(file, "r", encoding=encoding) as fr:
-                    for line in fr:
-                        newLine = regexSearcher.sub(replacement, line)
-                        fw.write(newLine)
-                        if newLine != line:
-                            changedCount += 1
-                            if changedCount >= lineCount:
-                                fw.write(fr.read())
-                                break
-            if changedCount > 0:
-                os.remove(file)
-                os.rename(tmpFile, file)
+            # 先按utf-8流式处理, 解码失败再检测编码重来
+            try:
+                encoding = "utf-8"
+                with open(file, "r", encoding=encoding, newline="") as fr:
+                    with open(tmpFile, "w", encoding=encoding, newline="") as fw:
+                        changed = Tools._PatchStream(fr, fw, pending)
+            except UnicodeDecodeError:
+                with open(file, mode="rb") as fr:
+                    encoding = Tools.DetectEncoding(fr.read())
+                with open(file, "r", encoding=encoding, newline="") as fr:
+                    with open(tmpFile, "w", encoding=encoding, newline="") as fw:
+                        changed = Tools._PatchStream(fr, fw, pending)
+            if changed:
+                # 替换而不是改写, 源码可能是缓存的只读硬链接
+                shutil.copymode(file, tmpFile)
+                os.chmod(tmpFile, os.stat(tmpFile).st_mode | stat.S_IWUSR)
+                os.replace(tmpFile, file)
+            st = os.stat(file)
+            with open(stampFile, "w", encoding="utf-8") as fw:
+                json.dump(
+                    {
+                        "rules": applied + [d for d in digests if d not in applied],
+                        "size": st.st_size,
+                        "mtime_ns": st.st_mtime_ns,
+                    },
+                    fw,
+                )
         except Exception as e:
             Tools.Log(f"{type(e)}:{str(e)}")
         finally:
             if os.path.exists(tmpFile):
                 os.remove(tmpFile)
+        return changed
+
+
+class Archive:
+    """
+    In-process archive extraction. Files are written by a thread pool; zip members are decompressed in parallel,
+    tar streams are decompressed by pigz/xz -T0/lbzip2 when installed.
+    """
+
+    THREADS = min(32, multiprocessing.cpu_count() + 4)
+    MAX_PENDING_BYTES = 256 << 20  # 等待写入的文件内容最大占用内存
+
+    # 扩展名 -> 可以多线程解压的命令
+    TAR_DECOMPRESSORS = {
+        (".gz", ".tgz"): [["pigz", "-dc"]],
+        (".xz", ".txz"): [["xz", "-dc", "-T0"]],
+        (".bz2", ".tbz2"): [["lbzip2", "-dc"], ["pbzip2", "-dc"]],
+    }
+
+    def _Selected(name: str, members: typing.Optional[typing.List[str]]) -> bool:
+        if members is None:
+            return True
+        return any(fnmatch.fnmatchcase(name, p) or fnmatch.fnmatchcase(name, p.rstrip("/") + "/*") for p in members)
+
+    def _SafePath(destDir: str, name: str) -> str:
+        path = os.path.abspath(os.path.join(destDir, name))
+        if os.path.commonpath([destDir, path]) != destDir:
+            raise RuntimeError(f"unsafe member path: {name}")
+        return path
+
+    def _WriteFile(path: str, data: bytes, mode: int, mtime: float) -> None:
+        if os.path.lexists(path):
+            # 可能是硬链接或只读文件, 先删除
+            os.remove(path)
+        with open(path, "wb") as fw:
+            fw.write(data)
+        os.chmod(path, mode)
+        os.utime(path, (mtime, mtime))
+
+    class _Writer:
+        """Thread pool writing files, the pending bytes are limited by MAX_PENDING_BYTES."""
+
+        def __init__(self):
+            self.pool = concurrent.futures.ThreadPoolExecutor(Archive.THREADS)
+            self.futures = []
+            self.pendingBytes = 0
+            self.cond = threading.Condition()
+
+        def Submit(self, fn: typing.Callable, size: int = 0) -> None:
+            with self.cond:
+                self.cond.wait_for(
+                    lambda: self.pendingBytes == 0 or self.pendingBytes + size <= Archive.MAX_PENDING_BYTES
+                )
+                self.pendingBytes += size
+
+            def Run():
+                try:
+                    fn()
+                finally:
+                    with self.cond:
+                        self.pendingBytes -= size
+                        self.cond.notify_all()
+
+            self.futures.append(self.pool.submit(Run))
+
+        def Wait(self) -> None:
+            self.pool.shutdown(wait=True)
+            for f in self.futures:
+                f.result()
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, excType, excValue, excTraceback) -> None:
+            # 出错时取消还没开始的写入, 并等待正在写入的线程结束, 不留下线程和打开的文件
+            self.pool.shutdown(wait=True, cancel_futures=excType is not None)
+
+    def ExtractZip(file: str, destDir: str, members: typing.List[str] = None) -> None:
+        destDir = os.path.abspath(destDir)
+        local = threading.local()
+        openedZips = []
+        lock = threading.Lock()
+
+        def ZipOfThread() -> zipfile.ZipFile:
+            # 每个线程单独打开, 解压可以并行
+            if not hasattr(local, "zip"):
+                local.zip = zipfile.ZipFile(file)
+                with lock:
+                    openedZips.append(local.zip)
+            return local.zip
+
+        with zipfile.ZipFile(file) as zf:
+            infos = [info for info in zf.infolist() if Archive._Selected(info.filename, members)]
+        dirs = []
+        links = []
+        try:
+            with Archive._Writer() as writer:
+                for info in infos:
+                    path = Archive._SafePath(destDir, info.filename)
+                    mode = (info.external_attr >> 16) & 0o170777
+                    mtime = datetime.datetime(*info.date_time).timestamp()
+                    if info.is_dir():
+                        os.makedirs(path, exist_ok=True)
+                        dirs.append((path, mode & 0o7777, mtime))
+                    elif stat.S_ISLNK(mode):
+                        links.append((info, path))
+                    else:
+                        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+                        def Extract(info=info, path=path, mode=mode, mtime=mtime):
+                            data = ZipOfThread().read(info)
+                            Archive._WriteFile(path, data, (mode & 0o7777) or 0o644, mtime)
+
+                        writer.Submit(Extract, info.file_size)
+                writer.Wait()
+            with zipfile.ZipFile(file) as zf:
+                for info, path in links:
+                    if os.path.lexists(path):
+                        os.remove(path)
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    os.symlink(zf.read(info).decode(), path)
+        finally:
+            for zf in openedZips:
+                zf.close()
+        for path, mode, mtime in reversed(dirs):
+            if mode:
+                os.chmod(path, mode)
+            os.utime(path, (mtime, mtime))
+
+    def _OpenTarStream(file: str) -> typing.Tuple[typing.IO[bytes], typing.Optional[subprocess.Popen]]:
+        for suffixes, commands in Archive.TAR_DECOMPRESSORS.items():
+            if not file.endswith(suffixes):
+                continue
+            for cmd in commands:
+                if shutil.which(cmd[0]):
+                    proc = subprocess.Popen(cmd + [file], stdout=subprocess.PIPE)
+                    return proc.stdout, proc
+        return open(file, "rb"), None
+
+    def ExtractTar(file: str, destDir: str, members: typing.List[str] = None) -> None:
+        destDir = os.path.abspath(destDir)
+        stream, proc = Archive._OpenTarStream(file)
+        dirs = []
+        links = []
+        try:
+            # 流式读取, 文件内容交给线程池写入
+            with Archive._Writer() as writer, tarfile.open(fileobj=stream, mode="r|*") as tar:
+                for member in tar:
+                    if not Archive._Selected(member.name, members):
+                        continue
+                    path = Archive._SafePath(destDir, member.name)
+                    if member.isdir():
+                        os.makedirs(path, exist_ok=True)
+                        dirs.append((path, member.mode, member.mtime))
+                    elif member.issym() or member.islnk():
+                        links.append(member)
+                    elif member.isreg():
+                        os.makedirs(os.path.dirname(path), exist_ok=True)
+                        data = tar.extractfile(member).read()
+                        writer.Submit(
+                            functools.partial(Archive._WriteFile, path, data, member.mode, member.mtime), len(data)
+                        )
+                writer.Wait()
+        except BaseException:
+            if proc is not None:
+                proc.kill()
+            raise
+        finally:
+            stream.close()
+            if proc is not None:
+                proc.wait()
+        if proc is not None and proc.returncode != 0:
+            raise RuntimeError(f"decompress {file} failed: {proc.returncode}")
+
+        # 链接在文件之后创建, 硬链接的目标文件必须已经存在
+        for member in links:
+            path = Archive._SafePath(destDir, member.name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if os.path.lexists(path):
+                os.remove(path)
+            if member.issym():
+                os.symlink(member.linkname, path)
+            else:
+                os.link(Archive._SafePath(destDir, member.linkname), path)
+        for path, mode, mtime in reversed(dirs):
+            os.chmod(path, mode)
+            os.utime(path, (mtime, mtime))
+
+
+class SourceCache:
+    """
+    Persistent cache of pristine extracted source trees, build_cache/src/<archive hash>/. Each build gets a working
+    copy by reflink (FICLONE), or by hardlink of read-only files (writers in this script remove the file before
+    writing, build tools writing in place fail instead of corrupting the cache), falling back to a plain copy.
+    root ignores the read-only bits, so hardlink is never used by root.
+    """
+
+    MODES = ["auto", "reflink", "hardlink", "copy", "off"]
+    FICLONE = 0x40049409  # linux/fs.h: _IOW(0x94, 9, int)
+
+    _recipe: str = ""  # 正在编译的库的配方摘要, 记录在检出标记中
+
+    def BeginPackage(pkg: "Package") -> None:
+        SourceCache._recipe = hashlib.sha256(ArtifactCache.RecipeSource(pkg).encode()).hexdigest()
+
+    def _Populate(archive: str, archiveHash: str) -> str:
+        """Extract archive into the cache once, concurrent builds wait for the first one."""
+        import fcntl
+
+        srcDir = os.path.join(Config.DIR_CACHE, "src")
+        os.makedirs(srcDir, exist_ok=True)
+        treeDir = os.path.join(srcDir, archiveHash)
+        lockFd = os.open(f"{treeDir}.lock", os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(lockFd, fcntl.LOCK_EX)
+            if not os.path.isdir(treeDir):
+                tmpDir = f"{treeDir}.{os.getpid()}.tmp"
+                Tools.RemoveFileOrDirs(tmpDir)
+                os.makedirs(tmpDir)
+                Tools.Decompress(archive, tmpDir)
+                # 缓存中的文件只读, 硬链接检出时不会被修改
+                for root, _, files in os.walk(tmpDir):
+                    for name in files:
+                        path = os.path.join(root, name)
+                        if not os.path.islink(path):
+                            os.chmod(path, stat.S_IMODE(os.lstat(path).st_mode) & ~0o222)
+                os.rename(tmpDir, treeDir)
+        finally:
+            os.close(lockFd)
+        return treeDir
+
+    def _Reflink(src: str, dest: str) -> None:
+        import fcntl
+
+        with open(src, "rb") as fr, open(dest, "wb") as fw:
+            fcntl.ioctl(fw.fileno(), SourceCache.FICLONE, fr.fileno())
+
+    def _CheckoutFile(mode: str, src: str, dest: str) -> None:
+        if os.path.lexists(dest):
+            os.remove(dest)
+        if mode == "hardlink":
+            os.link(src, dest)
+            return
+        if mode == "reflink":
+            SourceCache._Reflink(src, dest)
+        else:
+            shutil.copyfile(src, dest)
+        st = os.stat(src)
+        os.chmod(dest, stat.S_IMODE(st.st_mode) | stat.S_IWUSR)
+        os.utime(dest, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+    def _HardlinkSafe() -> bool:
+        # root 可以写只读文件, 原地修改会改掉缓存中的文件
+        return os.geteuid() != 0
+
+    def _ProbeMode(treeDir: str, destDir: str) -> str:
+        """The first checkout mode in reflink, hardlink (not as root), copy which works between treeDir and destDir."""
+        sample = None
+        for root, _, files in os.walk(treeDir):
+            for name in files:
+                if not os.path.islink(os.path.join(root, name)):
+                    sample = os.path.join(root, name)
+                    break
+            if sample:
+                break
+        if sample is None:
+            return "copy"
+        probe = os.path.join(destDir, f".checkout_probe.{os.getpid()}")
+        for mode in ["reflink", "hardlink"] if SourceCache._HardlinkSafe() else ["reflink"]:
+            try:
+                SourceCache._CheckoutFile(mode, sample, probe)
+                return mode
+            except OSError:
+                pass
+            finally:
+                if os.path.lexists(probe):
+                    os.remove(probe)
+        return "copy"
+
+    def Checkout(archivePatten: str, destDir: str) -> None:
+        """Same as Tools.Decompress(archivePatten, destDir), but from the cache."""
+        mode = Config.SOURCE_CACHE
+        if mode == "off" or os.name != "posix":
+            Tools.Decompress(archivePatten, destDir)
+            return
+        archive = glob.glob(archivePatten)
+        assert len(archive) == 1
+        archive = os.path.abspath(archive[0])
+        archiveHash = ArtifactCache.FileHash(archive)
+        treeDir = SourceCache._Populate(archive, archiveHash)
+        topEntries = sorted(os.listdir(treeDir))
+
+        # --no_clean 时, 配方未改变则不再检出, 保留上次的修改和时间戳; 配方改变后重新检出, 撤销旧的补丁和修改
+        marker = os.path.join(destDir, f".checkout-{archiveHash}")
+        try:
+            with open(marker, encoding="utf-8") as fr:
+                checkedOut = fr.read() == SourceCache._recipe
+        except OSError:
+            checkedOut = False
+        if checkedOut and all(os.path.lexists(os.path.join(destDir, e)) for e in topEntries):
+            Tools.Log(f"{os.path.basename(archive)}: already checked out")
+            return
+        if mode == "hardlink" and not SourceCache._HardlinkSafe():
+            Tools.Log("hardlink checkout is not safe as root, use reflink or copy")
+            mode = "auto"
+        if mode == "auto":
+            mode = SourceCache._ProbeMode(treeDir, destDir)
+
+        startTime = time.monotonic()
+        dirs = []
+        with concurrent.futures.ThreadPoolExecutor(Archive.THREADS) as pool:
+            futures = []
+            for root, dirNames, files in os.walk(treeDir):
+                relDir = os.path.relpath(root, treeDir)
+                destRoot = os.path.normpath(os.path.join(destDir, relDir))
+                os.makedirs(destRoot, exist_ok=True)
+                dirs.append((root, destRoot))
+                for name in dirNames + files:
+                    src = os.path.join(root, name)
+                    dest = os.path.join(destRoot, name)
+                    if os.path.islink(src):
+                        if os.path.lexists(dest):
+                            os.remove(dest)
+                        os.symlink(os.readlink(src), dest)
+                    elif name in files:
+                        futures.append(pool.submit(SourceCache._CheckoutFile, mode, src, dest))
+            for f in futures:
+                f.result()
+        for src, dest in reversed(dirs):
+            st = os.stat(src)
+            os.utime(dest, ns=(st.st_atime_ns, st.st_mtime_ns))
+        with open(marker, "w", encoding="utf-8") as fw:
+            fw.write(SourceCache._recipe)
+        Tools.Log(f"{os.path.basename(archive)}: checked out by {mode}, {time.monotonic() - startTime:.2f}s")
+
+
+# ------------------------------------------------------------------------------------------------
+
+
+class JobServer:
+    """
+    GNU make jobserver shared by all concurrent package builds (posix only), so the total number of compile
+    jobs stays at Config.PARALLEL_JOBS no matter how many packages are building. The scheduler holds one token
+    for each running package (its implicit job slot), make children take the others through MAKEFLAGS.
+    """
+
+    _fifo: str = ""
+    _fdClient: int = -1  # O_RDWR, 读写token, 传给make等子进程
+    _fdPoll: int = -1  # 单独打开的非阻塞描述符, 本进程获取token时不会阻塞, 也不影响子进程
+    _makeFlags: str = ""
+    _packages = None  # 正在编译的库的个数, fork前创建, 所有进程(包括matrix的各目标)共享
+
+    FAIR_SHARE_WAIT = 60.0  # 秒, Reserve 等待达到平均份额的最长时间
+
+    def IsActive() -> bool:
+        return JobServer._fdClient >= 0
+
+    def _MakeVersion() -> typing.Tuple[int, int]:
+        try:
+            output = subprocess.run(["make", "--version"], capture_output=True, encoding=OS_ENCODING).stdout
+            reMatch = re.search(r"GNU Make\s+(\d+)\.(\d+)", output)
+            if reMatch:
+                return (int(reMatch.group(1)), int(reMatch.group(2)))
+        except OSError:
+            pass
+        return (0, 0)
+
+    def _NinjaVersion() -> typing.Tuple[int, int]:
+        try:
+            output = subprocess.run(["ninja", "--version"], capture_output=True, encoding=OS_ENCODING).stdout
+            reMatch = re.match(r"\s*(\d+)\.(\d+)", output)
+            if reMatch:
+                return (int(reMatch.group(1)), int(reMatch.group(2)))
+        except OSError:
+            pass
+        return (0, 0)
+
+    def NinjaClient() -> bool:
+        """Whether ninja can take its jobs from the jobserver (ninja>=1.13, fifo only)."""
+        return JobServer.IsActive() and JobServer._NinjaVersion() >= (1, 13)
+
+    def NinjaEnv() -> typing.Dict[str, str]:
+        # ninja 只支持命名管道形式, 与make的版本无关, 不能指定 -j, 否则不使用jobserver
+        return {"MAKEFLAGS": f"-j --jobserver-auth=fifo:{JobServer._fifo}"} if JobServer.IsActive() else {}
+
+    def Start(jobs: int) -> None:
+        if os.name != "posix" or JobServer.IsActive():
+            return
+        fifoDir = tempfile.mkdtemp(prefix="jobserver_")
+        atexit.register(shutil.rmtree, fifoDir, True)
+        JobServer._fifo = os.path.join(fifoDir, "fifo")
+        os.mkfifo(JobServer._fifo, 0o600)
+        JobServer._fdClient = os.open(JobServer._fifo, os.O_RDWR)
+        JobServer._fdPoll = os.open(JobServer._fifo, os.O_RDONLY | os.O_NONBLOCK)
+        os.write(JobServer._fdClient, b"+" * jobs)
+        JobServer._packages = multiprocessing.Value("i", 0)
+        if JobServer._MakeVersion() >= (4, 4):
+            # make>=4.4, ninja>=1.13 支持命名管道
+            JobServer._makeFlags = f"-j --jobserver-auth=fifo:{JobServer._fifo}"
+        else:
+            fd = JobServer._fdClient
+            JobServer._makeFlags = f"-j --jobserver-fds={fd},{fd} --jobserver-auth={fd},{fd}"
+        Tools.Log(f"jobserver: {jobs} jobs, MAKEFLAGS={JobServer._makeFlags}")
+
+    def Env() -> typing.Dict[str, str]:
+        return {"MAKEFLAGS": JobServer._makeFlags} if JobServer.IsActive() else {}
+
+    def PassFds() -> typing.Tuple[int, ...]:
+        return (JobServer._fdClient,) if JobServer.IsActive() else ()
+
+    def PollFd() -> int:
+        return JobServer._fdPoll
+
+    def TryAcquire() -> bool:
+        try:
+            return len(os.read(JobServer._fdPoll, 1)) == 1
+        except BlockingIOError:
+            return False
+
+    def Release(count: int = 1) -> None:
+        if count > 0:
+            os.write(JobServer._fdClient, b"+" * count)
+
+    def AddPackages(count: int) -> None:
+        """Called by the scheduler when packages start (1) and finish (-1)."""
+        if JobServer._packages is not None:
+            with JobServer._packages.get_lock():
+                JobServer._packages.value += count
+
+    def FairShare() -> int:
+        """Config.PARALLEL_JOBS divided by the packages building now."""
+        packages = JobServer._packages.value if JobServer._packages is not None else 0
+        return max(1, Config.PARALLEL_JOBS // max(1, packages))
+
+    @contextlib.contextmanager
+    def Reserve(maxJobs: int, wait: float = 0):
+        """
+        Take free tokens besides the implicit one, for tools that don't speak the jobserver protocol (b2, old
+        ninja) or need their own job limit. Yields the number of jobs to pass with "-j".
+        At most the fair share of the running packages is taken, so the first package doesn't keep all tokens;
+        up to wait seconds are spent waiting for tokens held by others, so a long build started while the
+        others are busy doesn't run with -j1 to the end.
+        """
+        if not JobServer.IsActive():
+            yield max(1, maxJobs)
+            return
+        wanted = min(maxJobs, JobServer.FairShare())
+        deadline = time.monotonic() + wait
+        count = 0
+        while count < wanted - 1:
+            if JobServer.TryAcquire():
+                count += 1
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            # 其他进程归还token时可读
+            multiprocessing.connection.wait([JobServer._fdPoll], remaining)
+        if count < wanted - 1:
+            Tools.Log(f"jobserver: {count + 1} of {wanted} jobs available")
+        try:
+            yield count + 1
+        finally:
+            JobServer.Release(count)
+
+
+class MemoryGovernor:
+    """
+    Adjusts the number of compile jobs on the fly by available memory (/proc/meminfo, cgroup limit) and the RSS
+    of running compiler processes: tokens are taken out of the JobServer when memory is short and given back
+    when there is enough. Package.memPerJob is used as the per-job memory before real jobs are observed.
+    Called from the scheduler loop, so no thread is running when packages are forked.
+    """
+
+    # 按进程名统计的编译任务
+    JOB_COMMANDS = {"cc1", "cc1plus", "cc1obj", "f951", "lto1", "clang", "clang++", "ld", "ld.lld", "ld.gold", "lld"}
+    DEFAULT_MEM_PER_JOB = 512 << 20
+    UPDATE_INTERVAL = 1.0  # 秒
+
+    _withheld: int = 0  # 当前扣留的token
+    _perJob: float = 0  # 观测到的每个任务的内存峰值, 缓慢衰减
+    _jobs: int = -1  # 当前允许的任务数
+    _lastUpdate: float = 0
+
+    def IsActive() -> bool:
+        return Config.MEMORY_GOVERNOR and JobServer.IsActive() and os.path.exists("/proc/meminfo")
+
+    def _ReadInt(file: str) -> typing.Optional[int]:
+        try:
+            with open(file) as fr:
+                return int(fr.read().strip())
+        except (OSError, ValueError):
+            return None
+
+    def _CgroupAvailable() -> typing.Optional[int]:
+        """Memory left under the cgroup limits of this process (v2 and v1), None if unlimited."""
+        result = None
+        try:
+            with open("/proc/self/cgroup") as fr:
+                lines = fr.read().splitlines()
+        except OSError:
+            return None
+        for line in lines:
+            _, controllers, path = line.split(":", 2)
+            if controllers == "":
+                dirs, limitName, usageName = ["/sys/fs/cgroup"], "memory.max", "memory.current"
+            elif "memory" in controllers.split(","):
+                dirs, limitName, usageName = ["/sys/fs/cgroup/memory"], "memory.limit_in_bytes", "memory.usage_in_bytes"
+            else:
+                continue
+            # 容器中看到的可能是自己的cgroup根目录, 从自己的目录逐级向上检查
+            parts = [p for p in path.split("/") if p]
+            candidates = [os.path.join(dirs[0], *parts[:i]) for i in range(len(parts), -1, -1)]
+            for cgDir in candidates:
+                limit = MemoryGovernor._ReadInt(os.path.join(cgDir, limitName))
+                usage = MemoryGovernor._ReadInt(os.path.join(cgDir, usageName))
+                if limit is None or usage is None or limit >= (1 << 60):
+                    continue
+                left = max(0, limit - usage)
+                result = left if result is None else min(result, left)
+        return result
+
+    def Available() -> int:
+        available = 0
+        with open("/proc/meminfo") as fr:
+            for line in fr:
+                if line.startswith("MemAvailable:"):
+                    available = int(line.split()[1]) * 1024
+                    break
+        cgroupAvailable = MemoryGovernor._CgroupAvailable()
+        if cgroupAvailable is not None:
+            available = min(available, cgroupAvailable)
+        return available
+
+    def ProcessTree(rootPid: int) -> typing.Dict[int, typing.Tuple[str, int]]:
+        """pid -> (command, rss) of all descendants of rootPid."""
+        children: typing.Dict[int, typing.List[int]] = {}
+        info: typing.Dict[int, typing.Tuple[str, int]] = {}
+        pageSize = os.sysconf("SC_PAGE_SIZE")
+        for entry in os.listdir("/proc"):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f"/proc/{entry}/stat") as fr:
+                    statLine = fr.read()
+            except OSError:
+                continue
+            # 第2项是 (comm), 可能包含空格
+            comm = statLine[statLine.index("(") + 1 : statLine.rindex(")")]
+            fields = statLine[statLine.rindex(")") + 2 :].split()
+            pid = int(entry)
+            children.setdefault(int(fields[1]), []).append(pid)
+            info[pid] = (comm, int(fields[21]) * pageSize)
+        result = {}
+        stack = list(children.get(rootPid, []))
+        while stack:
+            pid = stack.pop()
+            result[pid] = info[pid]
+            stack.extend(children.get(pid, []))
+        return result
+
+    def Update(memPerJobHints: typing.List[int], force: bool = False) -> bool:
+        """
+        memPerJobHints: Package.memPerJob (MB) of running packages.
+        Returns True if more tokens should be withheld, the caller should wait on JobServer.PollFd().
+        """
+        if not MemoryGovernor.IsActive():
+            return False
+        now = time.monotonic()
+        if force or now - MemoryGovernor._lastUpdate >= MemoryGovernor.UPDATE_INTERVAL:
+            MemoryGovernor._lastUpdate = now
+            jobs = [
+                rss
+                for comm, rss in MemoryGovernor.ProcessTree(os.getpid()).values()
+                if comm in MemoryGovernor.JOB_COMMANDS
+            ]
+            if jobs:
+                MemoryGovernor._perJob = max(sum(jobs) / len(jobs), MemoryGovernor._perJob * 0.98)
+            perJob = max(
+                MemoryGovernor._perJob,
+                max(memPerJobHints, default=0) << 20,
+                MemoryGovernor.DEFAULT_MEM_PER_JOB if not jobs else 0,
+            )
+            usable = MemoryGovernor.Available() + sum(jobs) - (Config.MEMORY_RESERVE_MB << 20)
+            target = max(1, min(Config.PARALLEL_JOBS, int(usable // perJob)))
+            if target != MemoryGovernor._jobs:
+                Tools.Log(
+                    f"memory: usable {usable >> 20} MB, {perJob / (1 << 20):.0f} MB per job, "
+                    f"jobs {MemoryGovernor._jobs} -> {target}"
+                )
+                MemoryGovernor._jobs = target
+
+        # 扣留/归还token, 使得 总token数 - 扣留数 = 允许的任务数
+        wanted = Config.PARALLEL_JOBS - MemoryGovernor._jobs
+        while MemoryGovernor._withheld < wanted and JobServer.TryAcquire():
+            MemoryGovernor._withheld += 1
+        if MemoryGovernor._withheld > wanted:
+            JobServer.Release(MemoryGovernor._withheld - wanted)
+            MemoryGovernor._withheld = wanted
+        return MemoryGovernor._withheld < wanted
+
+    def ReleaseAll() -> None:
+        JobServer.Release(MemoryGovernor._withheld)
+        MemoryGovernor._withheld = 0
+        MemoryGovernor._jobs = -1
+
+
+class RamBuildDir:
+    """
+    Extracts and builds packages on tmpfs (Config.RAM_BUILD_DIR) instead of build_tmp, which may be slow storage.
+    The scheduler places each package before it starts: in RAM when the estimated size of its tree fits into
+    the budget left by the running RAM packages and the free space of the mount, otherwise in build_tmp as usual.
+    The estimate is the larger of the tree size of the last build (the sampled peak in RAM, the final size on disk)
+    and a multiple of the source archive size. A RAM build that fails after running short of space is retried once in build_tmp.
+    RAM trees are removed as soon as the package is installed, and kept if it fails.
+    """
+
+    # 没有记录时, 编译目录大小按源码包大小的倍数估计
+    ARCHIVE_FACTOR = 8
+    # 中间文件远大于源码包的库
+    ARCHIVE_FACTORS = {"boost": 24, "mlpack": 24}
+    DEFAULT_ESTIMATE = 256 << 20
+    # 内存盘剩余空间低于此值时, 不再放入新库, 失败的库改在磁盘上重新编译
+    FREE_MARGIN = 512 << 20
+    WATCH_INTERVAL = 5.0
+
+    _budget: int = 0
+    _placed: typing.Dict[str, int] = {}  # 内存中编译的库 -> 预估大小
+    # 编译进程中, 后台线程采样编译目录的峰值大小
+    _stop: threading.Event = None
+    _thread: threading.Thread = None
+    _watchDir: str = None
+    _peak: int = 0
+    _short: bool = False  # 编译期间内存盘剩余空间曾低于 FREE_MARGIN
+
+    def Init() -> None:
+        RamBuildDir._budget = 0
+        RamBuildDir._placed = {}
+        mount = "/dev/shm" if Config.RAM_BUILD_DIR == "auto" else Config.RAM_BUILD_DIR
+        if not mount:
+            return
+        if os.name != "posix" or not os.path.isdir(mount) or not os.access(mount, os.W_OK):
+            Tools.Log(f"{mount} is not a writable dir, build in {Config.DIR_BUILD_TMP}")
+            return
+        Config.RAM_BUILD_DIR = mount
+        budget = Config.RAM_BUILD_BUDGET_MB << 20
+        if not budget:
+            budget = MemoryGovernor.Available() // 2 if os.path.exists("/proc/meminfo") else 0
+        RamBuildDir._budget = budget
+        Tools.Log(f"RAM build dir: {RamBuildDir.Root()}, budget {budget >> 20} MB")
+
+    def IsActive() -> bool:
+        return RamBuildDir._budget > 0
+
+    def Root() -> str:
+        # 不同的 build_tmp (checkout, matrix目标) 使用不同的目录
+        key = hashlib.sha256(Config.DIR_BUILD_TMP.encode()).hexdigest()[:12]
+        return os.path.join(Config.RAM_BUILD_DIR, f"build_tmp-{key}")
+
+    def _SizeFile() -> str:
+        return os.path.join(Config.DIR_CACHE, "build_tree_sizes.json")
+
+    def _LoadSizes() -> typing.Dict[str, int]:
+        try:
+            with open(RamBuildDir._SizeFile(), encoding="utf-8") as fr:
+                return json.load(fr)
+        except (OSError, ValueError):
+            return {}
+
+    def Estimate(pkg: "Package") -> int:
+        archives = [f for pattern in pkg.sources for f in glob.glob(os.path.join(Config.DIR_BASE, pattern))]
+        factor = RamBuildDir.ARCHIVE_FACTORS.get(pkg.name, RamBuildDir.ARCHIVE_FACTOR)
+        estimate = sum(os.path.getsize(f) for f in archives) * factor
+        # 记录的是编译期间采样的峰值, 采样间隔内的增长不在其中, 因此留出余量
+        size = RamBuildDir._LoadSizes().get(pkg.name)
+        if size is not None:
+            return max(estimate, size * 5 // 4)
+        return estimate or RamBuildDir.DEFAULT_ESTIMATE
+
+    def Place(pkg: "Package") -> None:
+        """Called by the scheduler before forking the package, the child finds its place in _placed."""
+        if not RamBuildDir.IsActive():
+            return
+        estimate = RamBuildDir.Estimate(pkg)
+        used = sum(RamBuildDir._placed.values())
+        free = RamBuildDir._Free()
+        # tmpfs 中的文件占用内存, 不能被回收
+        memory = MemoryGovernor.Available() - (Config.MEMORY_RESERVE_MB << 20)
+        if used + estimate <= RamBuildDir._budget and estimate + RamBuildDir.FREE_MARGIN <= min(free, memory):
+            RamBuildDir._placed[pkg.name] = estimate
+            where = "in RAM"
+        else:
+            where = "on disk"
+        Tools.Log(
+            f"{pkg.name}: build {where}, estimated {estimate >> 20} MB, "
+            f"RAM used {used >> 20}/{RamBuildDir._budget >> 20} MB, free {min(free, memory) >> 20} MB"
+        )
+
+    def Release(name: str) -> None:
+        RamBuildDir._placed.pop(name, None)
+
+    def _Free() -> int:
+        st = os.statvfs(RamBuildDir.Root() if os.path.isdir(RamBuildDir.Root()) else Config.RAM_BUILD_DIR)
+        return st.f_bavail * st.f_frsize
+
+    def BuildDir(name: str) -> str:
+        """Build dir of the package, in the forked child."""
+        if name in RamBuildDir._placed:
+            return os.path.join(RamBuildDir.Root(), name)
+        return os.path.join(Config.DIR_BUILD_TMP, name)
+
+    def _TreeSize(top: str) -> int:
+        total = 0
+        for root, dirNames, files in os.walk(top):
+            for name in dirNames + files:
+                try:
+                    total += os.lstat(os.path.join(root, name)).st_blocks * 512
+                except OSError:
+                    pass
+        return total
+
+    def _Watch(name: str, buildDir: str) -> None:
+        while True:
+            RamBuildDir._peak = max(RamBuildDir._peak, RamBuildDir._TreeSize(buildDir))
+            if not RamBuildDir._short and RamBuildDir._Free() < RamBuildDir.FREE_MARGIN:
+                RamBuildDir._short = True
+                Tools.Log(f"{name}: RAM build dir is running short, {RamBuildDir._Free() >> 20} MB free")
+            if RamBuildDir._stop.wait(RamBuildDir.WATCH_INTERVAL):
+                return
+
+    def StartWatch(name: str, buildDir: str) -> None:
+        """Sample the peak size of a RAM tree while the package builds, in the forked child."""
+        RamBuildDir._peak = 0
+        RamBuildDir._short = False
+        if not RamBuildDir.IsActive():
+            return
+        RamBuildDir._watchDir = buildDir
+        # 磁盘上的库只在结束时统计一次, 遍历大的编译目录会和编译争抢IO
+        if name not in RamBuildDir._placed:
+            return
+        RamBuildDir._stop = threading.Event()
+        RamBuildDir._thread = threading.Thread(
+            target=RamBuildDir._Watch, args=(name, buildDir), name="ram-build-dir", daemon=True
+        )
+        RamBuildDir._thread.start()
+
+    def StopWatch() -> None:
+        if RamBuildDir._watchDir is None:
+            return
+        if RamBuildDir._thread is not None:
+            RamBuildDir._stop.set()
+            RamBuildDir._thread.join()
+            RamBuildDir._thread = None
+        RamBuildDir._peak = max(RamBuildDir._peak, RamBuildDir._TreeSize(RamBuildDir._watchDir))
+        RamBuildDir._watchDir = None
+
+    def ShouldSpill(name: str) -> bool:
+        """Whether a failed RAM build ran short of space and is worth retrying on disk."""
+        if name not in RamBuildDir._placed:
+            return False
+        return RamBuildDir._short or RamBuildDir._Free() < RamBuildDir.FREE_MARGIN
+
+    def Spill(name: str, buildDir: str) -> str:
+        """Remove the RAM tree of a failed package, and return its build dir in build_tmp."""
+        os.chdir(Config.DIR_BASE)
+        Tools.RemoveFileOrDirs(buildDir)
+        RamBuildDir._placed.pop(name, None)
+        Tools.Log(f"{name}: RAM build failed at {RamBuildDir._peak >> 20} MB, retry in {Config.DIR_BUILD_TMP}")
+        return os.path.join(Config.DIR_BUILD_TMP, name)
+
+    def Finish(name: str, buildDir: str) -> None:
+        """Record the peak tree size for later estimates, and remove the tree of a RAM package."""
+        if not RamBuildDir.IsActive():
+            return
+        sizes = RamBuildDir._LoadSizes()
+        sizes[name] = RamBuildDir._peak
+        try:
+            os.makedirs(Config.DIR_CACHE, exist_ok=True)
+            tmpFile = f"{RamBuildDir._SizeFile()}.{os.getpid()}.tmp"
+            with open(tmpFile, "w", encoding="utf-8") as fw:
+                json.dump(sizes, fw, indent=1)
+            os.replace(tmpFile, RamBuildDir._SizeFile())
+        except OSError:
+            pass
+        if name in RamBuildDir._placed:
+            os.chdir(Config.DIR_BASE)
+            # 立即删除, 释放内存
+            Tools.RemoveFileOrDirs(buildDir)
+            Tools.Log(f"{name}: removed RAM build dir, {sizes[name] >> 20} MB")
+
+
+class CompilerCache:
+    """
+    Puts ccache/sccache in front of the compilers of every build system: CMAKE_<LANG>_COMPILER_LAUNCHER for cmake,
+    "ccache gcc" in CC/CXX for configure scripts, and the b2 toolset command for boost.
+    Only how objects are compiled is changed, so the launcher is not a part of the artifact cache keys.
+    """
+
+    MODES = ["auto", "ccache", "sccache", "off"]
+    # ccache 统计日志中的命中结果
+    HIT_RESULTS = {"direct_cache_hit", "preprocessed_cache_hit", "local_storage_hit", "remote_storage_hit"}
+    MISS_RESULTS = {"cache_miss"}
+
+    _launcher: str = ""
+
+    def Init(mode: str) -> None:
+        CompilerCache._launcher = ""
+        if mode == "off":
+            return
+        for name in ["ccache", "sccache"] if mode == "auto" else [mode]:
+            path = shutil.which(name)
+            if path:
+                CompilerCache._launcher = path
+                break
+        else:
+            Tools.Log(f"{mode} not found, compiler cache disabled")
+            return
+        if CompilerCache.IsCcache():
+            # 路径相对化, 不同编译目录(build_tmp/<name>)之间也能命中
+            os.environ.setdefault("CCACHE_BASEDIR", Config.DIR_BASE)
+        Tools.Log(f"Compiler launcher: {CompilerCache._launcher}")
+
+    def IsActive() -> bool:
+        return bool(CompilerCache._launcher)
+
+    def IsCcache() -> bool:
+        return os.path.basename(CompilerCache._launcher).startswith("ccache")
+
+    def Wrap(compiler: str) -> str:
+        return f"{CompilerCache._launcher} {compiler}" if CompilerCache.IsActive() else compiler
+
+    def CMakeArgs() -> typing.List[str]:
+        if not CompilerCache.IsActive():
+            return []
+        return [f"-D CMAKE_{lang}_COMPILER_LAUNCHER={CompilerCache._launcher}" for lang in ["C", "CXX"]]
+
+    def _StatsLogFile(name: str) -> str:
+        return os.path.join(Config.DIR_BUILD_TMP, "logs", f"{name}.ccache-stats.log")
+
+    def BeginPackage(name: str) -> None:
+        """Log the results of ccache to a file of this package, used by PackageStats."""
+        if not (CompilerCache.IsActive() and CompilerCache.IsCcache()):
+            return
+        statsLog = CompilerCache._StatsLogFile(name)
+        os.makedirs(os.path.dirname(statsLog), exist_ok=True)
+        if os.path.exists(statsLog):
+            os.remove(statsLog)
+        os.environ["CCACHE_STATSLOG"] = statsLog
+
+    def PackageStats(name: str) -> typing.Optional[typing.Tuple[int, int, int]]:
+        """(hit, miss, uncacheable) compilations of a package, None if unknown."""
+        try:
+            with open(CompilerCache._StatsLogFile(name), encoding="utf-8", errors="replace") as fr:
+                lines = fr.read().splitlines()
+        except OSError:
+            return None
+        # 每次编译一条记录: "# 源文件" 后面每行一个结果
+        hit, miss, total = 0, 0, 0
+        results: typing.Set[str] = set()
+        for line in lines + ["#"]:
+            if line.startswith("#"):
+                if results:
+                    total += 1
+                    if results & CompilerCache.HIT_RESULTS:
+                        hit += 1
+                    elif results & CompilerCache.MISS_RESULTS:
+                        miss += 1
+                results = set()
+            elif line.strip():
+                results.add(line.strip())
+        return hit, miss, total - hit - miss
+
+    def FormatStats(stats: typing.Tuple[int, int, int]) -> str:
+        hit, miss, uncacheable = stats
+        rate = 100 * hit / (hit + miss) if hit + miss else 0
+        return f"ccache hit {hit}/{hit + miss} ({rate:.0f}%), uncacheable {uncacheable}"
+
+    def Summary(names: typing.List[str]) -> None:
+        if not CompilerCache.IsActive():
+            return
+        if not CompilerCache.IsCcache():
+            # sccache 只有全局统计
+            SUBPROCESS_RUN(input=f"{CompilerCache._launcher} --show-stats")
+            return
+        total = [0, 0, 0]
+        for name in names:
+            stats = CompilerCache.PackageStats(name)
+            if stats is None:
+                continue
+            Tools.Log(f"{name}: {CompilerCache.FormatStats(stats)}")
+            total = [a + b for a, b in zip(total, stats)]
+        Tools.Log(f"total: {CompilerCache.FormatStats(tuple(total))}")
+
+
+class Trace:
+    """
+    Spans of build phases and subprocesses in Chrome trace format (chrome://tracing, ui.perfetto.dev).
+    Each process appends its events to trace/<pid>.jsonl, Finish merges them into trace.json and prints a summary.
+    """
+
+    # 汇总表中的阶段, 依次为列
+    PHASES = ["extract", "prebuild", "configure", "compile", "install", "pkgconfig", "patchelf"]
+
+    _dir: str = ""
+
+    def IsActive() -> bool:
+        return bool(Trace._dir)
+
+    def Start(traceDir: str) -> None:
+        Tools.RemoveFileOrDirs(traceDir)
+        os.makedirs(traceDir, exist_ok=True)
+        Trace._dir = traceDir
+        Trace.SetProcessName("build.py")
+
+    def _Write(event: dict) -> None:
+        if not Trace.IsActive():
+            return
+        line = json.dumps(event, ensure_ascii=False) + "\n"
+        # 每条事件一次追加写, fork 出的子进程各写各的文件
+        with open(os.path.join(Trace._dir, f"{os.getpid()}.jsonl"), "a", encoding="utf-8") as fw:
+            fw.write(line)
+
+    def SetProcessName(name: str) -> None:
+        Trace._Write({"name": "process_name", "ph": "M", "pid": os.getpid(), "args": {"name": name}})
+
+    @contextlib.contextmanager
+    def Span(name: str, cat: str = "phase", **args):
+        startTime = time.time()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            Trace._Write(
+                {
+                    "name": name,
+                    "cat": cat,
+                    "ph": "X",
+                    "ts": int(startTime * 1e6),
+                    "dur": int((time.perf_counter() - start) * 1e6),
+                    "pid": os.getpid(),
+                    "tid": threading.get_native_id(),
+                    "args": args,
+                }
+            )
+
+    def Events() -> typing.List[dict]:
+        events = []
+        for file in glob.glob(os.path.join(Trace._dir, "*.jsonl")):
+            with open(file, encoding="utf-8") as fr:
+                for line in fr:
+                    try:
+                        events.append(json.loads(line))
+                    except ValueError:
+                        pass  # 被杀掉的进程可能留下半行
+        return events
+
+    def Finish(traceFile: str) -> None:
+        if not Trace.IsActive():
+            return
+        events = Trace.Events()
+        with open(traceFile, "w", encoding="utf-8") as fw:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, fw)
+        Tools.Log(f"Trace: {traceFile}")
+        index = Trace.Index(events)
+        Trace.Summary(events, index)
+        Sampler.Report(events, index)
+
+    def Index(events: typing.List[dict]) -> typing.Dict[int, dict]:
+        """Package spans sorted by start time and the process name of each pid, for Owner."""
+        index: typing.Dict[int, dict] = {}
+        for e in events:
+            if e.get("cat") == "package" or e.get("ph") == "M":
+                entry = index.setdefault(e["pid"], {"spans": [], "name": None})
+                if e.get("cat") == "package":
+                    entry["spans"].append(e)
+                elif entry["name"] is None:
+                    entry["name"] = e["args"]["name"]
+        for entry in index.values():
+            entry["spans"].sort(key=lambda e: e["ts"])
+            entry["starts"] = [e["ts"] for e in entry["spans"]]
+        return index
+
+    def Owner(event: dict, index: typing.Dict[int, dict]) -> str:
+        """Package of an event: the package span containing it in the same process, else the process name."""
+        entry = index.get(event["pid"])
+        if entry is None:
+            return str(event["pid"])
+        # 同一进程中的库依次编译, 不会重叠
+        i = bisect.bisect_right(entry["starts"], event["ts"]) - 1
+        if i >= 0 and event["ts"] <= entry["spans"][i]["ts"] + entry["spans"][i]["dur"]:
+            return entry["spans"][i]["name"]
+        return entry["name"] if entry["name"] is not None else str(event["pid"])
+
+    def FormatTable(lines: typing.List[typing.List[str]]) -> str:
+        widths = [max(len(line[i]) for line in lines) for i in range(len(lines[0]))]
+        return "\n".join(
+            "  ".join(cell.ljust(w) if i == 0 else cell.rjust(w) for i, (cell, w) in enumerate(zip(line, widths)))
+            for line in lines
+        )
+
+    def Summary(events: typing.List[dict], index: typing.Dict[int, dict]) -> None:
+        # 各库的各阶段耗时, 按总耗时排序. windows上所有库在同一进程中编译, 阶段按时间归属到库
+        rows: typing.Dict[str, typing.Dict[str, float]] = {}
+        for e in events:
+            if e.get("ph") == "X" and e.get("cat") == "package":
+                row = rows.setdefault(e["name"], {})
+                row["total"] = row.get("total", 0) + e["dur"] / 1e6
+        for e in events:
+            if e.get("ph") != "X" or e.get("cat") != "phase" or e["name"] not in Trace.PHASES:
+                continue
+            row = rows.setdefault(Trace.Owner(e, index), {})
+            row[e["name"]] = row.get(e["name"], 0) + e["dur"] / 1e6
+        if not rows:
+            return
+        lines = [["package", "total"] + Trace.PHASES]
+        for name, row in sorted(rows.items(), key=lambda item: -item[1].get("total", sum(item[1].values()))):
+            total = row.get("total", sum(row.values()))
+            lines.append([name, f"{total:.1f}"] + [f"{row[p]:.1f}" if p in row else "-" for p in Trace.PHASES])
+        Tools.Log(f"Elapsed seconds:\n{Trace.FormatTable(lines)}")
+
+
+class Sampler:
+    """
+    Background thread in the process building a package, samples its process tree from /proc: cores used,
+    RSS, disk read/write bytes, plus system CPU and available memory. Samples are counter events of the trace,
+    Report flags the phases that used about one core on a many-core machine or ran short of memory.
+    """
+
+    INTERVAL = 1.0  # 秒
+    SINGLE_THREAD_CORES = 1.5  # 平均使用的核数低于此值视为单线程
+    MIN_PHASE_SECONDS = 5.0  # 忽略更短的阶段
+
+    _stop: typing.Optional[threading.Event] = None
+    _thread: typing.Optional[threading.Thread] = None
+
+    def IsActive() -> bool:
+        return Trace.IsActive() and os.path.exists("/proc/stat")
+
+    def _SystemCpu() -> typing.Tuple[int, int]:
+        """(busy, total) clock ticks of all cpus."""
+        with open("/proc/stat") as fr:
+            values = [int(v) for v in fr.readline().split()[1:]]
+        idle = values[3] + (values[4] if len(values) > 4 else 0)  # idle + iowait
+        return sum(values) - idle, sum(values)
+
+    def _TreeUsage(rootPid: int) -> typing.Tuple[float, int, int, int]:
+        """(cpu seconds, rss, read bytes, write bytes) of rootPid and its descendants."""
+        # 已回收的子进程的cpu和io计入其父进程的 cutime/cstime 和 io 中
+        clockTicks = os.sysconf("SC_CLK_TCK")
+        cpu, rss, readBytes, writeBytes = 0.0, 0, 0, 0
+        tree = MemoryGovernor.ProcessTree(rootPid)
+        for pid in [rootPid] + list(tree.keys()):
+            try:
+                with open(f"/proc/{pid}/stat") as fr:
+                    statLine = fr.read()
+                fields = statLine[statLine.rindex(")") + 2 :].split()
+                cpu += sum(int(v) for v in fields[11:15]) / clockTicks
+                rss += tree[pid][1] if pid in tree else int(fields[21]) * os.sysconf("SC_PAGE_SIZE")
+                with open(f"/proc/{pid}/io") as fr:
+                    for line in fr:
+                        name, value = line.split(":")
+                        if name == "read_bytes":
+                            readBytes += int(value)
+                        elif name == "write_bytes":
+                            writeBytes += int(value)
+            except (OSError, ValueError, IndexError):
+                continue
+        return cpu, rss, readBytes, writeBytes
+
+    def _Run(rootPid: int) -> None:
+        last = None
+        while True:
+            now = time.time()
+            try:
+                sample = (now, Sampler._SystemCpu(), Sampler._TreeUsage(rootPid))
+            except (OSError, ValueError):
+                return
+            if last:
+                interval = max(now - last[0], 1e-3)
+                (busy, total), (lastBusy, lastTotal) = sample[1], last[1]
+                cpu, rss, readBytes, writeBytes = sample[2]
+                ts = int(now * 1e6)
+                pid = os.getpid()
+                Trace._Write(
+                    {
+                        "name": "cpu",
+                        "ph": "C",
+                        "ts": ts,
+                        "pid": pid,
+                        "args": {
+                            "cores": round(max(0.0, cpu - last[2][0]) / interval, 2),
+                            "system %": round(100 * (busy - lastBusy) / max(1, total - lastTotal), 1),
+                        },
+                    }
+                )
+                Trace._Write(
+                    {
+                        "name": "memory",
+                        "ph": "C",
+                        "ts": ts,
+                        "pid": pid,
+                        "args": {"rss MB": rss >> 20, "available MB": MemoryGovernor.Available() >> 20},
+                    }
+                )
+                Trace._Write(
+                    {
+                        "name": "io",
+                        "ph": "C",
+                        "ts": ts,
+                        "pid": pid,
+                        "args": {
+                            "read MB/s": round(max(0, readBytes - last[2][2]) / interval / (1 << 20), 2),
+                            "write MB/s": round(max(0, writeBytes - last[2][3]) / interval / (1 << 20), 2),
+                        },
+                    }
+                )
+            last = sample
+            if Sampler._stop.wait(Sampler.INTERVAL):
+                return
+
+    def Start() -> None:
+        if not Sampler.IsActive():
+            return
+        Sampler._stop = threading.Event()
+        Sampler._thread = threading.Thread(target=Sampler._Run, args=(os.getpid(),), name="sampler", daemon=True)
+        Sampler._thread.start()
+
+    def Stop() -> None:
+        if Sampler._thread is None:
+            return
+        Sampler._stop.set()
+        Sampler._thread.join()
+        Sampler._thread = None
+
+    def Report(events: typing.List[dict], index: typing.Dict[int, dict]) -> None:
+        counters: typing.Dict[int, typing.List[dict]] = {}
+        for e in events:
+            if e.get("ph") == "C":
+                counters.setdefault(e["pid"], []).append(e)
+        if not counters:
+            return
+
+        # 每个库: 平均核数, 峰值RSS, 读写量
+        rows: typing.Dict[str, typing.Dict[str, float]] = {}
+        for samples in counters.values():
+            samples.sort(key=lambda e: e["ts"])
+            lastTs = None
+            for e in samples:
+                row = rows.setdefault(Trace.Owner(e, index), {"cores": 0, "n": 0, "rss": 0, "read": 0, "write": 0})
+                if e["name"] == "cpu":
+                    row["cores"] += e["args"]["cores"]
+                    row["n"] += 1
+                elif e["name"] == "memory":
+                    row["rss"] = max(row["rss"], e["args"]["rss MB"])
+                elif e["name"] == "io":
+                    interval = (e["ts"] - lastTs) / 1e6 if lastTs else Sampler.INTERVAL
+                    lastTs = e["ts"]
+                    row["read"] += e["args"]["read MB/s"] * interval
+                    row["write"] += e["args"]["write MB/s"] * interval
+        lines = [["package", "avg cores", "peak rss MB", "read MB", "write MB"]]
+        for name, row in sorted(rows.items(), key=lambda item: -item[1]["rss"]):
+            lines.append(
+                [
+                    name,
+                    f"{row['cores'] / max(1, row['n']):.1f}",
+                    f"{row['rss']:.0f}",
+                    f"{row['read']:.0f}",
+                    f"{row['write']:.0f}",
+                ]
+            )
+        Tools.Log(f"Utilization:\n{Trace.FormatTable(lines)}")
+
+        # 单线程及内存不足的阶段
+        cpuCount = multiprocessing.cpu_count()
+        sampleTimes = {pid: [c["ts"] for c in samples] for pid, samples in counters.items()}
+        findings = []
+        for e in events:
+            if e.get("ph") != "X" or e.get("cat") != "phase" or e["dur"] < Sampler.MIN_PHASE_SECONDS * 1e6:
+                continue
+            samples = counters.get(e["pid"], [])
+            times = sampleTimes.get(e["pid"], [])
+            samples = samples[bisect.bisect_left(times, e["ts"]) : bisect.bisect_right(times, e["ts"] + e["dur"])]
+            cores = [c["args"]["cores"] for c in samples if c["name"] == "cpu"]
+            available = [c["args"]["available MB"] for c in samples if c["name"] == "memory"]
+            where = f"{Trace.Owner(e, index)} {e['name']}: {e['dur'] / 1e6:.0f} s"
+            if cpuCount >= 4 and cores and sum(cores) / len(cores) < Sampler.SINGLE_THREAD_CORES:
+                findings.append(f"{where} single-threaded, {sum(cores) / len(cores):.1f} of {cpuCount} cores")
+            if available and min(available) < Config.MEMORY_RESERVE_MB:
+                findings.append(f"{where} memory pressure, available down to {min(available)} MB")
+        if findings:
+            Tools.Log("Bottlenecks:\n" + "\n".join(findings))
 
 
 # ------------------------------------------------------------------------------------------------
@@ -200,18 +1633,57 @@ class AndroidNdk:
     ANDROID_NATIVE_API_LEVEL: str = ""
 
 
+@dataclasses.dataclass()
+class Package:
+    name: str
+    fnBuild: typing.Callable
+    deps: typing.List[str] = dataclasses.field(default_factory=list)  # 不在本次编译列表中的依赖会被忽略
+    weight: int = 1  # 相对编译耗时, 用于计算关键路径, 耗时长的优先编译
+    sources: typing.List[str] = dataclasses.field(default_factory=list)  # 源码包等输入文件, 相对 DIR_BASE 的通配符
+    memPerJob: int = 0  # 每个编译任务大约需要的内存(MB), 0表示默认
+    config: typing.List[str] = dataclasses.field(default_factory=list)  # 只影响该库的Config值, 加入该库的缓存key
+
+
 class Config:
     # user config
     BUILD_VIDEO_AUDIO: bool = True  # 音视频
     BUILD_MACHINE_LEARNING: bool = True  # 机器学习
     BUILD_SDL2_VIDEO: bool = False  # sdl2 video
     BUILD_NATIVE_ARCH: bool = False  # linux, "-march=native"
+    ARCH_LEVELS: typing.List[str] = []  # linux x86_64, 额外编译的微架构版本, 如 ["x86-64-v2", "x86-64-v3", "x86-64-v4"]
+    ARCH_VARIANT_PACKAGES: typing.List[str] = ["zstd", "superlu", "hdf5", "armadillo", "faiss"]  # 编译微架构版本的库
+    BOOST_COMPONENTS: typing.List[str] = []  # 编译的boost库, 如 ["filesystem", "thread", "log"], 空表示全部(python除外)
+    PARALLEL_JOBS: int = multiprocessing.cpu_count()  # 编译任务总数
+    PARALLEL_PACKAGES: int = max(1, min(16, multiprocessing.cpu_count()))  # 同时编译的库的个数, 同时受 jobserver 限制
+    ARTIFACT_CACHE: bool = True  # 缓存编译安装结果, 输入不变时直接恢复
+    SOURCE_CACHE: str = "auto"  # 解压后的源码缓存, 检出方式: auto, reflink, hardlink, copy, off
+    MEMORY_GOVERNOR: bool = True  # 根据可用内存动态调整编译任务数
+    MEMORY_RESERVE_MB: int = 1024  # 给系统及其他程序保留的内存
+    RAM_BUILD_DIR: str = ""  # 在内存文件系统中解压编译: "" 不使用, auto 即 /dev/shm, 或 tmpfs 挂载目录
+    RAM_BUILD_BUDGET_MB: int = 0  # 内存中编译目录的总大小上限, 0表示可用内存的一半
+    COMPILER_CACHE: str = "auto"  # 编译缓存: auto, ccache, sccache, off
+    TRACE: bool = True  # 记录各阶段耗时, 生成 chrome trace
+    CMAKE_GENERATOR = "auto"  # auto: 安装了ninja>=1.13(可加入jobserver)时使用Ninja, 否则Unix Makefiles; ninja; make
+    PGO: bool = False  # x264, x265, vpx, ffmpeg 使用PGO编译, 仅 linux release
+    SPLIT_DEBUG: bool = False  # 安装后把调试信息分离到 lib/debug/.build-id, 并strip
+    CONFIGURE_CACHE: bool = False  # 复用configure检测结果: cmake 相同检测跨库共享, autoconf 按库缓存
+    BENCHMARK: bool = False  # 编译后测试库的性能, 与基线比较, 仅 linux
+    BENCHMARK_THRESHOLD: float = 0.1  # 低于基线的比例超过此值时失败
+    BENCHMARK_UPDATE: bool = False  # 用本次结果更新基线
+    INTERACTIVE: bool = True  # False: 不提示输入, 使用 PROFILE 中的值或默认值
+    PROFILE: typing.Dict[str, typing.Any] = {}  # 提示的预设答案, 见 PROFILE_KEYS
+    MATRIX: typing.List[str] = []  # 同时编译多个目标, 如 ["linux-release", "linux-debug", "android-release"]
 
     # generated config
+    PROFILE_KEYS = ["build_type", "target_os", "clang", "ndk_dir", "api_level"]
+    CMAKE_GENERATOR_NAMES = {"ninja": "Ninja", "make": "Unix Makefiles"}
+    CMAKE_GENERATOR_NAME = ""  # 实际使用的cmake生成器
+    MATRIX_TARGET = ""  # 矩阵编译中当前的目标, 安装目录为 3rd_root_{os}_{type}
     BUILD_TYPE = BuildType.release
     TARGET_OS = TargetOs.windows
     DIR_BASE = os.path.dirname(os.path.abspath(__file__))
     DIR_BUILD_TMP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "build_tmp")
+    DIR_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "build_cache")
     DIR_INSTALL_ROOT = ""
     IS_CLANG: bool = False
     ENV = Environment()
@@ -224,36 +1696,75 @@ class Config:
     ]
     CMAKE_BOOST_ARGS: typing.List[str] = []
 
+    def LoadProfile(file: str) -> None:
+        """
+        Load a json profile: upper case keys set Config attributes (e.g. "BUILD_MACHINE_LEARNING": false,
+        "MATRIX": [...]), lower case keys are answers of the prompts, see PROFILE_KEYS.
+        """
+        with open(file, "r", encoding="utf-8") as fr:
+            profile = json.load(fr)
+        for key, value in profile.items():
+            if key in Config.PROFILE_KEYS:
+                Config.PROFILE[key] = value
+            elif key.isupper() and key in Config.__dict__ and not callable(Config.__dict__[key]):
+                setattr(Config, key, value)
+            else:
+                raise ValueError(f"{file}: unknown key {key}")
+
+    def _Select(key: str, promt: str, optionList: typing.Iterable, defaultValue):
+        if key in Config.PROFILE:
+            value = Config.PROFILE[key]
+            for opt in optionList:
+                if opt == value or (isinstance(opt, enum.Enum) and opt.name == str(value).lower()):
+                    return opt
+            raise ValueError(f"{key}: {value!r} not in {list(optionList)}")
+        if not Config.INTERACTIVE:
+            return defaultValue
+        return Tools.PromptSelect(promt, optionList, defaultValue)
+
+    def _Input(key: str, promt: str, defaultValue):
+        if key in Config.PROFILE:
+            return type(defaultValue)(Config.PROFILE[key])
+        if not Config.INTERACTIVE:
+            return defaultValue
+        return Tools.PromptInput(promt, defaultValue)
+
     def _CheckPresets():
         assert (sys.version_info.major >= 3) and (sys.version_info.minor >= 9)
         assert not Tools.HasUnsafeChar(Config.DIR_BASE)
-        assert Tools.CheckCommand("cmake --version")
-        assert Tools.CheckCommand("perl -v")
-        assert Tools.CheckCommand("nasm -v")
-        assert Tools.CheckCommand("git lfs -v")
+        required = ["cmake --version", "perl -v", "nasm -v", "git lfs -v"]
+        optional = []
         if os.name == "nt":
-            assert Tools.CheckCommand("ninja --version")
+            required += ["ninja --version"]
         else:
-            assert Tools.CheckCommand("autoconf -V")
-            assert Tools.CheckCommand("automake --version")
-            assert Tools.CheckCommand("make -v")
-            assert Tools.CheckCommand("pkg-config --version")
-            assert Tools.CheckCommand("gfortran -v")
-            assert Tools.CheckCommand("patchelf --version")
+            required += [
+                "autoconf -V",
+                "automake --version",
+                "make -v",
+                "pkg-config --version",
+                "gfortran -v",
+                "patchelf --version",
+            ]
+            # _InitLinux, _InitPosixCommmon 中使用, 一起探测
+            optional += ["clang -v", "clang++ -v", "gcc -v", "g++ -v", "ninja --version", "objcopy --version"]
+        results = Tools.CheckCommands(required + optional)
+        for cmd in required:
+            assert results[cmd], f"{cmd} failed"
 
     def _InitWindows():
         pass
 
     def _InitLinux():
+        results = Tools.CheckCommands(["clang -v", "clang++ -v", "gcc -v", "g++ -v"])
         Config.IS_CLANG = (
-            Tools.CheckCommand("clang -v")
-            and Tools.CheckCommand("clang++ -v")
-            and Tools.PromptSelect("use clang?", [False, True], False)
+            results["clang -v"]
+            and results["clang++ -v"]
+            and Config._Select("clang", "use clang?", [False, True], False)
         )
         if Config.IS_CLANG:
             Config.ENV.CC = "clang"
             Config.ENV.CXX = "clang++"
-        elif (not Tools.CheckCommand("gcc -v")) or (not Tools.CheckCommand("g++ -v")):
+        elif (not results["gcc -v"]) or (not results["g++ -v"]):
             raise RuntimeError("gcc not found!")
         else:
             Config.ENV.CC = "gcc"
@@ -264,11 +1775,13 @@ class Config:
 
     def _InitAndroid():
         while True:
-            value = Tools.PromptInput("Input android ndk root dir", "/opt/android-ndk-*")
+            value = Config._Input("ndk_dir", "Input android ndk root dir", "/opt/android-ndk-*")
             dirList = glob.glob(value)
             if dirList:
                 Config.ANDROID_NDK.ANDROID_NDK_HOME = dirList[0]
                 break
+            elif "ndk_dir" in Config.PROFILE or not Config.INTERACTIVE:
+                raise RuntimeError(f"android ndk {value} not found!")
             else:
                 Tools.Log(f"{value} not found!")
 
@@ -286,7 +1799,7 @@ class Config:
         assert os.path.exists(binpath)
         Config.ENV.PATH = f'{binpath}:{os.environ["PATH"]}'
 
-        apiLevel = Tools.PromptInput("Input android api level number", 21)
+        apiLevel = Config._Input("api_level", "Input android api level number", 21)
         Config.ANDROID_NDK.ANDROID_NATIVE_API_LEVEL = apiLevel
 
         Config.IS_CLANG = True
@@ -326,9 +1839,7 @@ class Config:
             Config.ENV.CFLAGS += " -O3"
 
         libPath = f"{Config.DIR_INSTALL_ROOT}/lib"
-        os.makedirs(libPath, exist_ok=True)
-        if not os.path.exists(f"{Config.DIR_INSTALL_ROOT}/lib64"):
-            SUBPROCESS_RUN(input=r"ln -s lib lib64", cwd=Config.DIR_INSTALL_ROOT)
+        Config.InitInstallRoot()
         Config.INSTALL_RPATH = rf"'$ORIGIN:$ORIGIN/lib:$ORIGIN/../lib'"
 
         Config.ENV.CFLAGS += f" -I{Config.DIR_BASE}/3rd_root/include -I{Config.DIR_INSTALL_ROOT}/include"
@@ -337,9 +1848,19 @@ class Config:
         Config.ENV.LDFLAGS = (Config.ENV.LDFLAGS + f" -L{libPath}").strip()
         Config.ENV.PKG_CONFIG_PATH = f"{libPath}/pkgconfig:{Config.DIR_INSTALL_ROOT}/share/pkgconfig"
 
+        generator = Config.CMAKE_GENERATOR
+        if generator == "auto":
+            generator = "ninja" if Tools.CheckCommands(["ninja --version"])["ninja --version"] else "make"
+            if generator == "ninja" and JobServer.IsActive() and not JobServer.NinjaClient():
+                # 旧版ninja不能加入jobserver, 任务数不受共享限制和内存调节
+                Tools.Log("ninja < 1.13 can't use the jobserver, use Unix Makefiles")
+                generator = "make"
+        elif generator == "ninja" and not Tools.CheckCommands(["ninja --version"])["ninja --version"]:
+            raise RuntimeError("ninja not found!")
+        Config.CMAKE_GENERATOR_NAME = Config.CMAKE_GENERATOR_NAMES[generator]
         Config.CMAKE_COMMON_ARGS += [
             f"-D CMAKE_INSTALL_RPATH={Config.INSTALL_RPATH}",  # 设置rpath, 避免编译时找不到间接依赖库。
-            "-G 'Unix Makefiles'",
+            f"-G '{Config.CMAKE_GENERATOR_NAME}'",
         ]
 
     def InitBoostCmakeArgs(boostDir: str = None):
@@ -350,25 +1871,36 @@ class Config:
         if isinstance(boostDir, str) and os.path.exists(f"{boostDir}/stage"):
             Config.CMAKE_BOOST_ARGS = [f"-D Boost_ROOT={boostDir}/stage", f"-D Boost_DEBUG=ON"]
 
+    def InitInstallRoot():
+        os.makedirs(Config.DIR_INSTALL_ROOT, exist_ok=True)
+        if Config.TARGET_OS != TargetOs.windows:
+            os.makedirs(f"{Config.DIR_INSTALL_ROOT}/lib", exist_ok=True)
+            if not os.path.lexists(f"{Config.DIR_INSTALL_ROOT}/lib64"):
+                os.symlink("lib", f"{Config.DIR_INSTALL_ROOT}/lib64")
+
     def InitConfig():
         Config._CheckPresets()
 
         # build type
-        Config.BUILD_TYPE = Tools.PromptSelect("Build type?", [BuildType.release, BuildType.debug], BuildType.release)
+        Config.BUILD_TYPE = Config._Select(
+            "build_type", "Build type?", [BuildType.release, BuildType.debug], BuildType.release
+        )
         Config.CMAKE_COMMON_ARGS.append(f"-D CMAKE_BUILD_TYPE={Config.BUILD_TYPE.name.title()}")
 
         # target os
         if sys.platform.startswith("win32"):
             Config.TARGET_OS = TargetOs.windows
         elif sys.platform.startswith("linux"):
-            Config.TARGET_OS = Tools.PromptSelect(
-                "Select target os:", [TargetOs.linux, TargetOs.android], TargetOs.linux
+            Config.TARGET_OS = Config._Select(
+                "target_os", "Select target os:", [TargetOs.linux, TargetOs.android], TargetOs.linux
             )
         else:
             raise RuntimeError("Unsuppored os!")
 
         # install root dir
         Config.DIR_INSTALL_ROOT = f"{Config.DIR_BASE}/3rd_root_{Config.TARGET_OS.name.lower()}"
+        if Config.MATRIX_TARGET:
+            Config.DIR_INSTALL_ROOT += f"_{Config.BUILD_TYPE.name.lower()}"
         os.makedirs(Config.DIR_INSTALL_ROOT, exist_ok=True)
         Config.CMAKE_COMMON_ARGS.extend(
             [
@@ -389,17 +1921,1022 @@ class Config:
                 Config._InitAndroid()
             Config._InitPosixCommmon()
 
-    def EnvDict():
-        return {**os.environ, **dataclasses.asdict(Config.ENV)}
+    def EnvDict(launcher: bool = False):
+        """
+        launcher: prefix CC/CXX with the compiler cache, for configure scripts.
+        cmake must not use it, cmake takes the first word of CC as the compiler.
+        """
+        env = {**os.environ, **dataclasses.asdict(Config.ENV), **JobServer.Env()}
+        if launcher and CompilerCache.IsActive():
+            for name in ["CC", "CXX"]:
+                if env.get(name):
+                    env[name] = CompilerCache.Wrap(env[name])
+        return env
+
+
+# ------------------------------------------------------------------------------------------------
+
+
+class InstallTracker:
+    """
+    Records the files each package installs into Config.DIR_INSTALL_ROOT. Packages build concurrently,
+    so install steps are serialized by a file lock and the install root is compared before and after each step.
+    """
+
+    STATE_DIR = ".build_state"  # 安装目录下保存编译状态的目录, 不属于任何库
+
+    _lockFd: int = -1
+    _lockDepth: int = 0
+    _installed: typing.Set[str] = set()  # 当前进程(一个库)安装的文件, 相对安装目录
+
+    def StateDir() -> str:
+        stateDir = os.path.join(Config.DIR_INSTALL_ROOT, InstallTracker.STATE_DIR)
+        os.makedirs(stateDir, exist_ok=True)
+        return stateDir
+
+    def Reset() -> None:
+        InstallTracker._installed = set()
+
+    def Installed() -> typing.List[str]:
+        return sorted(InstallTracker._installed)
+
+    def Snapshot() -> typing.Dict[str, tuple]:
+        result = {}
+        stack = [""]
+        while stack:
+            relDir = stack.pop()
+            try:
+                entries = list(os.scandir(os.path.join(Config.DIR_INSTALL_ROOT, relDir)))
+            except OSError:
+                continue
+            for entry in entries:
+                relPath = os.path.join(relDir, entry.name)
+                if relPath == InstallTracker.STATE_DIR:
+                    continue
+                st = entry.stat(follow_symlinks=False)
+                if entry.is_dir(follow_symlinks=False):
+                    result[relPath] = ("d",)
+                    stack.append(relPath)
+                else:
+                    result[relPath] = (st.st_mtime_ns, st.st_size, st.st_ino, st.st_mode)
+        return result
+
+    @contextlib.contextmanager
+    def Lock():
+        """Reentrant lock of the install root among package processes, windows builds in order without it."""
+        if InstallTracker._lockDepth == 0 and os.name == "posix":
+            import fcntl
+
+            InstallTracker._lockFd = os.open(
+                os.path.join(InstallTracker.StateDir(), "install.lock"), os.O_RDWR | os.O_CREAT, 0o644
+            )
+            fcntl.flock(InstallTracker._lockFd, fcntl.LOCK_EX)
+        InstallTracker._lockDepth += 1
+        try:
+            yield
+        finally:
+            InstallTracker._lockDepth -= 1
+            if InstallTracker._lockDepth == 0 and InstallTracker._lockFd >= 0:
+                os.close(InstallTracker._lockFd)
+                InstallTracker._lockFd = -1
+
+    @contextlib.contextmanager
+    def Step():
+        """Install step of current package: new or changed files in the install root belong to it."""
+        with InstallTracker.Lock():
+            outermost = InstallTracker._lockDepth == 1
+            before = InstallTracker.Snapshot() if outermost else None
+            yield
+            if outermost:
+                InstallTracker._Diff(before)
+
+    def _Diff(before: typing.Dict[str, tuple]) -> None:
+        for relPath, value in InstallTracker.Snapshot().items():
+            if before.get(relPath) != value:
+                InstallTracker._installed.add(relPath)
+
+    def RecordManifestFile(manifestFile: str) -> None:
+        """Add files listed in cmake's install_manifest.txt, up-to-date files are not copied again."""
+        if not os.path.exists(manifestFile):
+            return
+        root = os.path.abspath(Config.DIR_INSTALL_ROOT)
+        with open(manifestFile, encoding=OS_ENCODING, errors="replace") as fr:
+            for line in fr:
+                path = os.path.abspath(line.strip())
+                if line.strip() and os.path.commonpath([root, path]) == root and os.path.lexists(path):
+                    InstallTracker._installed.add(os.path.relpath(path, root))
+
+
+class ArtifactCache:
+    """
+    Content-addressed cache of finished package installs: build_cache/artifacts/<key>.tar,
+    key is the hash of source packages, recipe, Config and hashes of the dependencies.
+    """
+
+    _compilerVersion: str = None
+    KEY_INPUTS: typing.Dict[str, dict] = {}  # name -> 计算key的输入, 由Keys()生成
+
+    def _Dir() -> str:
+        cacheDir = os.path.join(Config.DIR_CACHE, "artifacts")
+        os.makedirs(cacheDir, exist_ok=True)
+        return cacheDir
+
+    def FileHash(file: str) -> str:
+        # 按(路径, 大小, 修改时间)缓存文件hash, 避免每次都计算大的源码包
+        st = os.stat(file)
+        hashFile = os.path.join(Config.DIR_CACHE, "file_hashes.json")
+        try:
+            with open(hashFile, encoding="utf-8") as fr:
+                hashes = json.load(fr)
+        except (OSError, ValueError):
+            hashes = {}
+        key = f"{os.path.abspath(file)}:{st.st_size}:{st.st_mtime_ns}"
+        if key not in hashes:
+            sha = hashlib.sha256()
+            with open(file, "rb") as fr:
+                for block in iter(lambda: fr.read(1 << 20), b""):
+                    sha.update(block)
+            hashes[key] = sha.hexdigest()
+            os.makedirs(Config.DIR_CACHE, exist_ok=True)
+            tmpFile = f"{hashFile}.{os.getpid()}.tmp"
+            with open(tmpFile, "w", encoding="utf-8") as fw:
+                json.dump(hashes, fw, indent=1)
+            os.replace(tmpFile, hashFile)
+        return hashes[key]
+
+    def CompilerVersion() -> str:
+        if ArtifactCache._compilerVersion is None:
+            result = []
+            for compiler in [Config.ENV.CC, Config.ENV.CXX]:
+                try:
+                    result.append(
+                        subprocess.run(
+                            [compiler, "--version"], capture_output=True, encoding=OS_ENCODING, env=Config.EnvDict()
+                        ).stdout
+                    )
+                except OSError:
+                    result.append(compiler)
+            ArtifactCache._compilerVersion = "\n".join(result)
+        return ArtifactCache._compilerVersion
+
+    def ConfigInputs() -> dict:
+        """Config values that change the installed files."""
+        return {
+            "BUILD_TYPE": Config.BUILD_TYPE.name,
+            "TARGET_OS": Config.TARGET_OS.name,
+            "IS_CLANG": Config.IS_CLANG,
+            "BUILD_SDL2_VIDEO": Config.BUILD_SDL2_VIDEO,
+            "BUILD_NATIVE_ARCH": Config.BUILD_NATIVE_ARCH,
+            "DIR_INSTALL_ROOT": Config.DIR_INSTALL_ROOT,
+            "INSTALL_RPATH": Config.INSTALL_RPATH,
+            "ENV": dataclasses.asdict(Config.ENV),
+            "ANDROID_NDK": dataclasses.asdict(Config.ANDROID_NDK),
+            # 生成器不影响安装的文件
+            "CMAKE_COMMON_ARGS": [arg for arg in Config.CMAKE_COMMON_ARGS if not arg.startswith("-G ")],
+        }
+
+    def _Recipes(fn: typing.Callable) -> typing.List[typing.Callable]:
+        if isinstance(fn, functools.partial):
+            # 包装的配方, 如 ArchVariants.Build(Builder.BuildZstd, level), 被包装的配方也在key中
+            wrapped = [fn.func, *fn.args, *fn.keywords.values()]
+            return [r for f in wrapped if callable(f) for r in ArtifactCache._Recipes(f)]
+        qualname = getattr(fn, "__qualname__", "")
+        owner = getattr(sys.modules.get(getattr(fn, "__module__", "")), qualname.split(".")[0], None)
+        if inspect.isclass(owner) and owner is not Builder:
+            # 配方在单独的类中, 如 Pgo, 其中编译的其他库的配方也在key中
+            return [owner, *(owner.Recipes() if hasattr(owner, "Recipes") else [])]
+        return [fn]
+
+    def RecipeSource(pkg: Package) -> str:
+        # 配方函数(包括其中的Prebuild等)以及通用编译函数的源码
+        result = []
+        for fn in [
+            *ArtifactCache._Recipes(pkg.fnBuild),
+            Builder.PrepareSrcPackage,
+            Builder.CMakeBuild,
+            Builder.MakefileBuild,
+            Builder._PkgconigAddPrivLibsToPubLibs,
+        ]:
+            try:
+                result.append(inspect.getsource(fn))
+            except (OSError, TypeError):
+                result.append(repr(fn))
+        return "\n".join(result)
+
+    def Keys(packages: typing.List[Package]) -> typing.Dict[str, str]:
+        pkgMap = {pkg.name: pkg for pkg in packages}
+        keys: typing.Dict[str, str] = {}
+
+        def Key(pkg: Package) -> str:
+            if pkg.name not in keys:
+                sources = {}
+                for patten in pkg.sources:
+                    for file in sorted(glob.glob(os.path.join(Config.DIR_BASE, patten))):
+                        sources[os.path.relpath(file, Config.DIR_BASE)] = ArtifactCache.FileHash(file)
+                inputs = {
+                    "name": pkg.name,
+                    "sources": sources,
+                    "recipe": hashlib.sha256(ArtifactCache.RecipeSource(pkg).encode()).hexdigest(),
+                    "config": {**ArtifactCache.ConfigInputs(), **{name: getattr(Config, name) for name in pkg.config}},
+                    "compiler": ArtifactCache.CompilerVersion(),
+                    "deps": {d: Key(pkgMap[d]) for d in sorted(pkg.deps) if d in pkgMap},
+                }
+                keys[pkg.name] = hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+                ArtifactCache.KEY_INPUTS[pkg.name] = inputs
+            return keys[pkg.name]
+
+        for pkg in packages:
+            Key(pkg)
+        return keys
+
+    def _TarFilter() -> dict:
+        # python>=3.12 解压需要指定filter, 缓存是自己生成的, 可信
+        return {"filter": "fully_trusted"} if hasattr(tarfile, "fully_trusted_filter") else {}
+
+    def Restore(name: str, key: str) -> typing.Optional[typing.List[str]]:
+        """Restore installed files of package from cache, return the file list, or None if not cached."""
+        tarFile = os.path.join(ArtifactCache._Dir(), f"{key}.tar")
+        metaFile = os.path.join(ArtifactCache._Dir(), f"{key}.json")
+        if not (os.path.exists(tarFile) and os.path.exists(metaFile)):
+            return None
+        with open(metaFile, encoding="utf-8") as fr:
+            files = json.load(fr)["files"]
+        with InstallTracker.Lock():
+            with tarfile.open(tarFile, "r") as tar:
+                tar.extractall(Config.DIR_INSTALL_ROOT, **ArtifactCache._TarFilter())
+        Tools.Log(f"{name}: restored {len(files)} files from cache {key}")
+        return files
+
+    def Store(name: str, key: str, files: typing.List[str]) -> None:
+        tarFile = os.path.join(ArtifactCache._Dir(), f"{key}.tar")
+        metaFile = os.path.join(ArtifactCache._Dir(), f"{key}.json")
+        tmpSuffix = f".{os.getpid()}.tmp"
+        with tarfile.open(tarFile + tmpSuffix, "w") as tar:
+            for relPath in files:
+                path = os.path.join(Config.DIR_INSTALL_ROOT, relPath)
+                if os.path.lexists(path):
+                    tar.add(path, arcname=relPath, recursive=False)
+        with open(metaFile + tmpSuffix, "w", encoding="utf-8") as fw:
+            json.dump({"name": name, "files": files}, fw, indent=1)
+        os.replace(tarFile + tmpSuffix, tarFile)
+        os.replace(metaFile + tmpSuffix, metaFile)
+        Tools.Log(f"{name}: stored {len(files)} files to cache {key}")
+
+
+class Stamp:
+    """
+    Per-package completion stamps in the install root, recording the key and inputs of the build and
+    the installed files. A rerun with --no_clean skips packages whose stamp is up to date.
+    """
+
+    def _File(name: str) -> str:
+        stampDir = os.path.join(InstallTracker.StateDir(), "stamps")
+        os.makedirs(stampDir, exist_ok=True)
+        return os.path.join(stampDir, f"{name}.json")
+
+    def Load(name: str) -> typing.Optional[dict]:
+        try:
+            with open(Stamp._File(name), encoding="utf-8") as fr:
+                return json.load(fr)
+        except (OSError, ValueError):
+            return None
+
+    def Write(name: str, key: str, files: typing.List[str]) -> None:
+        stampFile = Stamp._File(name)
+        with open(stampFile + ".tmp", "w", encoding="utf-8") as fw:
+            json.dump(
+                {
+                    "key": key,
+                    "time": datetime.datetime.now().isoformat(sep=" ", timespec="seconds"),
+                    "inputs": ArtifactCache.KEY_INPUTS.get(name, {}),
+                    "files": files,
+                },
+                fw,
+                indent=1,
+            )
+        os.replace(stampFile + ".tmp", stampFile)
+
+    def IsUpToDate(name: str, key: str) -> bool:
+        stamp = Stamp.Load(name)
+        if stamp is None:
+            return False
+        if stamp["key"] != key:
+            inputs = ArtifactCache.KEY_INPUTS.get(name, {})
+            changed = [k for k in sorted(inputs) if stamp.get("inputs", {}).get(k) != inputs[k]]
+            Tools.Log(f"{name}: stale, changed: {changed}")
+            return False
+        missing = [f for f in stamp["files"] if not os.path.lexists(os.path.join(Config.DIR_INSTALL_ROOT, f))]
+        if missing:
+            Tools.Log(f"{name}: stale, {len(missing)} installed files missing, e.g. {missing[0]}")
+            return False
+        return True
+
+    def Invalidate(name: str) -> None:
+        """Remove the stamp and the files installed by the old build, before rebuilding the package."""
+        stamp = Stamp.Load(name)
+        if stamp is None:
+            return
+        with InstallTracker.Lock():
+            for relPath in stamp["files"]:
+                path = os.path.join(Config.DIR_INSTALL_ROOT, relPath)
+                if os.path.islink(path) or os.path.isfile(path):
+                    os.remove(path)
+            os.remove(Stamp._File(name))
+
+
+class ConfigureCache:
+    """
+    Configure check results reused by later builds with the same toolchain, in build_cache/configure/<key>/.
+    The key is the compiler version, the target and the compiler related arguments and environment.
+    - autoconf: config.site (CONFIG_SITE) points the configure script to a --cache-file of its own package.
+      A cache file shared by different packages would be wrong: a script may change LIBS or CPPFLAGS between
+      its checks, e.g. AC_CHECK_FUNCS(pow) after adding -lm. The hand written configure scripts (openssl, x264,
+      vpx, ffmpeg) don't read it.
+    - cmake: checks.cmake (CMAKE_PROJECT_INCLUDE) wraps check_include_file(s), check_function_exists and
+      check_symbol_exists. Each positive result is stored under the hash of the check, its arguments,
+      CMAKE_REQUIRED_* and the compile and link flags, and only an identical check of any package reuses it.
+      Negative results are not stored, the header or library may be installed by a later package.
+    """
+
+    # autoconf 的 precious 变量, 与缓存中记录的值不同时 configure 会报错退出
+    AUTOCONF_VARS = ["CC", "CFLAGS", "CPPFLAGS", "CPP", "CXX", "CXXFLAGS", "LDFLAGS", "LIBS", "PKG_CONFIG"]
+    # 包装 check_* 宏, 原来的宏以 "_" 开头调用
+    CMAKE_SCRIPT = """# Generated by build.py, results of check_* shared by the packages built with the same toolchain.
+include_guard(GLOBAL)
+include(CheckIncludeFile)
+include(CheckIncludeFiles)
+include(CheckFunctionExists)
+include(CheckSymbolExists)
+
+function(_build_py_check_lookup var)
+  string(SHA256 key "${ARGN}|${CMAKE_REQUIRED_FLAGS}|${CMAKE_REQUIRED_DEFINITIONS}|${CMAKE_REQUIRED_INCLUDES}|\\
+${CMAKE_REQUIRED_LIBRARIES}|${CMAKE_REQUIRED_LINK_OPTIONS}|${CMAKE_EXTRA_INCLUDE_FILES}|${CMAKE_C_FLAGS}|\\
+${CMAKE_CXX_FLAGS}|${CMAKE_EXE_LINKER_FLAGS}")
+  set(_build_py_check_key "${key}" PARENT_SCOPE)
+  if(NOT DEFINED ${var} AND EXISTS "@RESULT_DIR@/${key}")
+    file(READ "@RESULT_DIR@/${key}" help)
+    set(${var} 1 CACHE INTERNAL "${help}")
+  endif()
+endfunction()
+
+function(_build_py_check_store var help)
+  if(${var})
+    string(RANDOM LENGTH 16 suffix)
+    file(WRITE "@RESULT_DIR@/${_build_py_check_key}.${suffix}.tmp" "${help}")
+    file(RENAME "@RESULT_DIR@/${_build_py_check_key}.${suffix}.tmp" "@RESULT_DIR@/${_build_py_check_key}")
+  endif()
+endfunction()
+
+macro(check_include_file _build_py_include _build_py_var)
+  _build_py_check_lookup(${_build_py_var} check_include_file "${_build_py_include}" ${ARGN})
+  if(NOT DEFINED ${_build_py_var})
+    _check_include_file("${_build_py_include}" ${_build_py_var} ${ARGN})
+    _build_py_check_store(${_build_py_var} "Have include ${_build_py_include}")
+  endif()
+endmacro()
+
+macro(check_include_files _build_py_includes _build_py_var)
+  _build_py_check_lookup(${_build_py_var} check_include_files "${_build_py_includes}" ${ARGN})
+  if(NOT DEFINED ${_build_py_var})
+    _check_include_files("${_build_py_includes}" ${_build_py_var} ${ARGN})
+    _build_py_check_store(${_build_py_var} "Have includes ${_build_py_includes}")
+  endif()
+endmacro()
+
+macro(check_function_exists _build_py_function _build_py_var)
+  _build_py_check_lookup(${_build_py_var} check_function_exists "${_build_py_function}")
+  if(NOT DEFINED ${_build_py_var})
+    _check_function_exists("${_build_py_function}" ${_build_py_var})
+    _build_py_check_store(${_build_py_var} "Have function ${_build_py_function}")
+  endif()
+endmacro()
+
+macro(check_symbol_exists _build_py_symbol _build_py_files _build_py_var)
+  _build_py_check_lookup(${_build_py_var} check_symbol_exists "${_build_py_symbol}" "${_build_py_files}")
+  if(NOT DEFINED ${_build_py_var})
+    _check_symbol_exists("${_build_py_symbol}" "${_build_py_files}" ${_build_py_var})
+    _build_py_check_store(${_build_py_var} "Have symbol ${_build_py_symbol}")
+  endif()
+endmacro()
+"""
+
+    def _Dir(*keyParts) -> str:
+        key = hashlib.sha256(
+            json.dumps(
+                [ArtifactCache.CompilerVersion(), Config.TARGET_OS.name, Config.BUILD_TYPE.name, *keyParts]
+            ).encode()
+        ).hexdigest()[:16]
+        cacheDir = os.path.join(Config.DIR_CACHE, "configure", key)
+        os.makedirs(cacheDir, exist_ok=True)
+        return cacheDir
+
+    def _WriteOnce(file: str, text: str) -> None:
+        if os.path.exists(file):
+            return
+        with open(f"{file}.{os.getpid()}.tmp", "w", encoding="utf-8") as fw:
+            fw.write(text)
+        os.replace(f"{file}.{os.getpid()}.tmp", file)
+
+    def AutoconfEnv(cmd: str, env: typing.Dict[str, str]) -> typing.Dict[str, str]:
+        """env of the configure command cmd run in the source tree, with CONFIG_SITE when enabled."""
+        if not Config.CONFIGURE_CACHE:
+            return env
+        # 源码目录名(编译目录下的第一级)区分不同的库及版本; host/build/target 也是 precious 变量
+        cacheDir = ConfigureCache._Dir(
+            "autoconf",
+            os.path.relpath(os.getcwd(), Config.DIR_BUILD_TMP).split(os.sep)[0],
+            {name: env.get(name, "") for name in ConfigureCache.AUTOCONF_VARS},
+            re.findall(r"--(?:host|build|target)=\S+", cmd),
+        )
+        siteFile = os.path.join(cacheDir, "config.site")
+        ConfigureCache._WriteOnce(
+            siteFile, f'if test "$cache_file" = /dev/null; then\n  cache_file={cacheDir}/config.cache\nfi\n'
+        )
+        return {**env, "CONFIG_SITE": siteFile}
+
+    def CMakeArgs() -> typing.List[str]:
+        if not Config.CONFIGURE_CACHE:
+            return []
+        # 生成器不影响检测结果
+        args = [arg for arg in Config.CMAKE_COMMON_ARGS if not arg.startswith("-G ")]
+        cacheDir = ConfigureCache._Dir("cmake", dataclasses.asdict(Config.ENV), args)
+        resultDir = os.path.join(cacheDir, "checks")
+        os.makedirs(resultDir, exist_ok=True)
+        scriptFile = os.path.join(cacheDir, "checks.cmake")
+        ConfigureCache._WriteOnce(scriptFile, ConfigureCache.CMAKE_SCRIPT.replace("@RESULT_DIR@", resultDir))
+        return [f"-D CMAKE_PROJECT_INCLUDE='{scriptFile}'"]
+
+
+class Pgo:
+    """
+    Profile guided optimization of the video codecs. x264, x265, vpx and ffmpeg are built by the single package
+    "pgo" instead of their own packages, so their files have one owner in the stamps and the artifact cache:
+    a plain build, then an instrumented one trained by encoding and decoding test patterns made by the freshly
+    built ffmpeg, then a build with the profile. Encode speed of the plain and the final build is reported.
+    The training runs on the build machine, so only linux release builds are supported.
+    """
+
+    PACKAGES = ["x264", "x265", "vpx", "ffmpeg"]  # 被 pgo 替换的库
+
+    # (名称, ffmpeg编码参数, 输出格式)
+    ENCODERS = [
+        ("x264", "-c:v libx264 -preset medium -crf 23", "mkv"),
+        ("x265", "-c:v libx265 -preset medium -crf 28", "mkv"),
+        ("vp8", "-c:v libvpx -deadline good -cpu-used 2 -b:v 2M", "webm"),
+        ("vp9", "-c:v libvpx-vp9 -deadline good -cpu-used 2 -row-mt 1 -b:v 2M", "webm"),
+    ]
+    PATTERNS = ["testsrc2=size=1280x720:rate=30", "mandelbrot=size=1280x720:rate=30"]
+    SECONDS = 3  # 每个测试图案的时长
+    BENCH_RUNS = 3  # 测速时取最快的一次
+
+    def IsEnabled() -> bool:
+        return Config.PGO and Config.TARGET_OS == TargetOs.linux and Config.BUILD_TYPE == BuildType.release
+
+    def Sources() -> typing.List[str]:
+        return [
+            "src_package/x264*.tar.bz2",
+            "src_package/x265*.tar.gz",
+            "src_package/libvpx-*.zip",
+            "src_package/ffmpeg*.tar.xz",
+        ]
+
+    def Recipes() -> typing.List[typing.Callable]:
+        """Recipes of PACKAGES in build order, also a part of the artifact cache key of pgo."""
+        return [Builder.BuildX264, Builder.BuildX265, Builder.BuildVpx, Builder.BuildFfmpeg]
+
+    def Replace(packages: typing.List[Package]) -> typing.List[Package]:
+        """Replace PACKAGES by the pgo package, depending on what they depend on."""
+        replaced = [pkg for pkg in packages if pkg.name in Pgo.PACKAGES]
+        packages = [pkg for pkg in packages if pkg.name not in Pgo.PACKAGES]
+        for pkg in packages:
+            pkg.deps = [("pgo" if d in Pgo.PACKAGES else d) for d in pkg.deps]
+        deps = sorted({d for pkg in replaced for d in pkg.deps} - set(Pgo.PACKAGES))
+        # 普通编译 + 两次重新编译
+        weight = 3 * sum(pkg.weight for pkg in replaced)
+        return packages + [Package("pgo", Pgo.Build, deps, weight=weight, sources=Pgo.Sources())]
+
+    def _Dir() -> str:
+        return os.path.join(Config.DIR_BUILD_TMP, "pgo")
+
+    def _Flags(stage: str) -> str:
+        profileDir = os.path.join(Pgo._Dir(), "profile")
+        if stage == "generate":
+            # 编码器是多线程的, 计数器需要原子更新
+            return f"-fprofile-generate={profileDir} -fprofile-update=atomic"
+        if Config.IS_CLANG:
+            return (
+                f"-fprofile-use={profileDir}/merged.profdata "
+                "-Wno-profile-instr-unprofiled -Wno-profile-instr-out-of-date"
+            )
+        # 训练没有覆盖的代码按普通方式优化, 而不是按冷代码优化
+        return f"-fprofile-use={profileDir} -fprofile-partial-training -Wno-missing-profile"
+
+    def _Rebuild(stage: str) -> None:
+        oldEnv, oldBuildTmp = Config.ENV, Config.DIR_BUILD_TMP
+        flags = Pgo._Flags(stage)
+        # 两次编译的目标文件路径必须相同, gcc 按路径查找 .gcda
+        buildTmp = os.path.join(Pgo._Dir(), "src")
+        Tools.RemoveFileOrDirs(buildTmp)
+        os.makedirs(buildTmp)
+        Config.ENV = dataclasses.replace(
+            oldEnv,
+            CFLAGS=f"{oldEnv.CFLAGS} {flags}",
+            CXXFLAGS=f"{oldEnv.CXXFLAGS} {flags}",
+            LDFLAGS=f"{oldEnv.LDFLAGS} {flags}",
+        )
+        Config.DIR_BUILD_TMP = buildTmp
+        try:
+            with Trace.Span(f"pgo-{stage}"):
+                for fn in Pgo.Recipes():
+                    Tools.Log(f"pgo: {stage} {fn.__name__}")
+                    fn()
+        finally:
+            Config.ENV, Config.DIR_BUILD_TMP = oldEnv, oldBuildTmp
+
+    def Ffmpeg(args: str) -> float:
+        """Run the installed ffmpeg, return the seconds it took."""
+        env = {**os.environ, "LD_LIBRARY_PATH": f"{Config.DIR_INSTALL_ROOT}/lib"}
+        start = time.monotonic()
+        SUBPROCESS_RUN(
+            input=f"{Config.DIR_INSTALL_ROOT}/bin/ffmpeg -hide_banner -loglevel error -nostdin -y {args}",
+            env=env,
+            check=True,
+        )
+        return time.monotonic() - start
+
+    def _MakeInputs() -> typing.List[str]:
+        inputs = []
+        for index, pattern in enumerate(Pgo.PATTERNS):
+            file = os.path.join(Pgo._Dir(), f"input{index}.y4m")
+            Pgo.Ffmpeg(f"-f lavfi -i {pattern} -t {Pgo.SECONDS} -pix_fmt yuv420p {file}")
+            inputs.append(file)
+        return inputs
+
+    def _Run(inputs: typing.List[str], runs: int, decode: bool = False) -> typing.Dict[str, float]:
+        """Encode all inputs with each encoder, return the best frames per second."""
+        frames = sum(int(pattern.rsplit("rate=", 1)[1]) * Pgo.SECONDS for pattern in Pgo.PATTERNS)
+        result = {}
+        for name, encoderArgs, ext in Pgo.ENCODERS:
+            best = None
+            for _ in range(runs):
+                seconds = 0.0
+                for index, file in enumerate(inputs):
+                    output = os.path.join(Pgo._Dir(), f"{name}{index}.{ext}")
+                    seconds += Pgo.Ffmpeg(f"-i {file} {encoderArgs} {output}")
+                    if decode:
+                        Pgo.Ffmpeg(f"-i {output} -f null -")
+                best = seconds if best is None else min(best, seconds)
+            result[name] = frames / best
+        return result
+
+    def _MergeProfile() -> None:
+        if not Config.IS_CLANG:
+            return
+        profileDir = os.path.join(Pgo._Dir(), "profile")
+        if not Tools.CheckCommands(["llvm-profdata --version"])["llvm-profdata --version"]:
+            raise RuntimeError("llvm-profdata not found!")
+        SUBPROCESS_RUN(input=f"llvm-profdata merge -o {profileDir}/merged.profdata {profileDir}/*.profraw", check=True)
+
+    def Report(baseline: typing.Dict[str, float], optimized: typing.Dict[str, float]) -> None:
+        lines = ["pgo encode speed (fps):", f"{'encoder':<10}{'plain':>10}{'pgo':>10}{'speedup':>10}"]
+        for name in baseline:
+            speedup = optimized[name] / baseline[name] - 1
+            lines.append(f"{name:<10}{baseline[name]:>10.1f}{optimized[name]:>10.1f}{speedup:>+10.1%}")
+        Tools.Log("\n".join(lines))
+        with open(os.path.join(Pgo._Dir(), "report.json"), "w", encoding="utf-8") as fw:
+            json.dump({"baseline": baseline, "pgo": optimized}, fw, indent=1)
+
+    def Build() -> None:
+        Tools.RemoveFileOrDirs(Pgo._Dir())
+        os.makedirs(Pgo._Dir())
+        for fn in Pgo.Recipes():
+            Tools.Log(f"pgo: plain {fn.__name__}")
+            fn()
+        with Trace.Span("pgo-baseline"):
+            inputs = Pgo._MakeInputs()
+            baseline = Pgo._Run(inputs, Pgo.BENCH_RUNS)
+        Pgo._Rebuild("generate")
+        with Trace.Span("pgo-train"):
+            Pgo._Run(inputs, 1, decode=True)
+            Pgo._MergeProfile()
+        Pgo._Rebuild("use")
+        with Trace.Span("pgo-bench"):
+            optimized = Pgo._Run(inputs, Pgo.BENCH_RUNS)
+        Pgo.Report(baseline, optimized)
+
+
+class ArchVariants:
+    """
+    x86-64 micro-architecture variants (x86-64-v2/v3/v4) of Config.ARCH_VARIANT_PACKAGES. Each variant is built
+    with -march=<level> and installed by DESTDIR into a staging dir, and its shared libraries are copied to
+    lib/glibc-hwcaps/<level> of the install root, where ld.so (glibc>=2.33) picks the best one from CPUID at
+    process start. For older glibc, bin/arch_env.sh selects the same dir by LD_LIBRARY_PATH.
+    Packages in RUNS_BUILT_PROGRAMS only get the levels the build machine can run.
+    """
+
+    LEVELS = ["x86-64-v2", "x86-64-v3", "x86-64-v4"]
+    # 各级别新增的cpu特性(/proc/cpuinfo 中的名字), 见 x86-64 psABI
+    LEVEL_FLAGS = {
+        "x86-64-v2": ["cx16", "lahf_lm", "popcnt", "sse4_1", "sse4_2", "ssse3"],
+        "x86-64-v3": ["avx", "avx2", "bmi1", "bmi2", "f16c", "fma", "abm", "movbe", "xsave"],
+        "x86-64-v4": ["avx512f", "avx512bw", "avx512cd", "avx512dq", "avx512vl"],
+    }
+    HWCAPS_DIR = "lib/glibc-hwcaps"
+    # 编译过程中运行编译出的程序的库(hdf5: H5detect, try_run), 高于本机cpu的级别会因非法指令失败
+    RUNS_BUILT_PROGRAMS = {"hdf5"}
+
+    def IsEnabled() -> bool:
+        return (
+            bool(Config.ARCH_LEVELS)
+            and Config.TARGET_OS == TargetOs.linux
+            and os.uname().machine == "x86_64"
+            and not Config.BUILD_NATIVE_ARCH
+        )
+
+    def Flags(level: str) -> typing.List[str]:
+        """All cpu flags required by level, including the lower levels."""
+        return [
+            flag
+            for item in ArchVariants.LEVELS[: ArchVariants.LEVELS.index(level) + 1]
+            for flag in ArchVariants.LEVEL_FLAGS[item]
+        ]
+
+    def HostSupports(level: str) -> bool:
+        try:
+            with open("/proc/cpuinfo") as fr:
+                reMatch = re.search(r"^flags\s*:(.*)$", fr.read(), flags=re.MULTILINE)
+        except OSError:
+            return False
+        hostFlags = set(reMatch.group(1).split()) if reMatch else set()
+        return all(flag in hostFlags for flag in ArchVariants.Flags(level))
+
+    def Packages(packages: typing.List[Package]) -> typing.List[Package]:
+        result = []
+        for pkg in packages:
+            if pkg.name not in Config.ARCH_VARIANT_PACKAGES:
+                continue
+            for level in Config.ARCH_LEVELS:
+                if pkg.name in ArchVariants.RUNS_BUILT_PROGRAMS and not ArchVariants.HostSupports(level):
+                    Tools.Log(f"arch variants: {pkg.name} runs its programs while building, {level} skipped")
+                    continue
+                result.append(
+                    Package(
+                        f"{pkg.name}@{level}",
+                        functools.partial(ArchVariants.Build, pkg.fnBuild, level),
+                        [pkg.name, *pkg.deps],
+                        weight=pkg.weight,
+                        sources=pkg.sources,
+                        memPerJob=pkg.memPerJob,
+                    )
+                )
+        if result:
+            result.append(
+                Package(
+                    "arch-variants",
+                    ArchVariants.WriteManifest,
+                    [pkg.name for pkg in result],
+                    config=["ARCH_LEVELS"],
+                )
+            )
+        return result
+
+    def Build(fnBuild: typing.Callable, level: str) -> None:
+        # 在子进程中编译, 直接修改 Config 及环境变量
+        stageDir = os.path.join(Config.DIR_BUILD_TMP, "arch", level, fnBuild.__name__)
+        Tools.RemoveFileOrDirs(stageDir)
+        Config.DIR_BUILD_TMP = os.path.join(stageDir, "src")
+        os.makedirs(Config.DIR_BUILD_TMP)
+        Config.ENV.CFLAGS += f" -march={level}"
+        Config.ENV.CXXFLAGS += f" -march={level}"
+        destDir = os.path.join(stageDir, "destdir")
+        os.environ["DESTDIR"] = destDir
+        try:
+            fnBuild()
+        finally:
+            del os.environ["DESTDIR"]
+
+        stagedRoot = destDir + os.path.abspath(Config.DIR_INSTALL_ROOT)
+        hwcapsDir = os.path.join(Config.DIR_INSTALL_ROOT, ArchVariants.HWCAPS_DIR, level)
+        # 只安装动态库, 头文件等与 lib 中的相同; 都在安装目录中, 由安装记录, 缓存及stamp管理
+        with InstallTracker.Step():
+            os.makedirs(hwcapsDir, exist_ok=True)
+            libs = []
+            for file in glob.glob(f"{stagedRoot}/lib/lib*.so*"):
+                target = os.path.join(hwcapsDir, os.path.basename(file))
+                if os.path.lexists(target):
+                    os.remove(target)
+                shutil.copy2(file, target, follow_symlinks=False)
+                if not os.path.islink(target):
+                    libs.append(target)
+            if libs:
+                # 依赖库在 lib 中
+                SUBPROCESS_RUN(input=f"patchelf --set-rpath '$ORIGIN:$ORIGIN/../..' {' '.join(libs)}", check=True)
+
+    def WriteManifest() -> None:
+        hwcapsRoot = os.path.join(Config.DIR_INSTALL_ROOT, ArchVariants.HWCAPS_DIR)
+        # 所有库都跳过的级别没有目录
+        levels = [
+            level
+            for level in ArchVariants.LEVELS
+            if level in Config.ARCH_LEVELS and os.path.isdir(os.path.join(hwcapsRoot, level))
+        ]
+        manifest = {
+            level: {
+                "flags": ArchVariants.Flags(level),
+                "libraries": sorted(os.listdir(os.path.join(hwcapsRoot, level))),
+            }
+            for level in levels
+        }
+        lines = [
+            "# Generated by build.py, source it to use the best x86-64 variants in lib/glibc-hwcaps.",
+            "# ld.so of glibc>=2.33 selects them by itself.",
+            '_root="$(cd "$(dirname "${BASH_SOURCE[0]:-$0}")/.." && pwd)"',
+            "_flags=\" $(grep -m1 '^flags' /proc/cpuinfo | cut -d: -f2) \"",
+            '_best=""',
+        ]
+        for level in levels:
+            lines += [
+                "_ok=1",
+                f"for _f in {' '.join(ArchVariants.Flags(level))}; do",
+                '    case "$_flags" in *" $_f "*) ;; *) _ok=0 ;; esac',
+                "done",
+                f'[ "$_ok" = 1 ] && _best="{level}"',
+            ]
+        lines += [
+            'if [ -n "$_best" ]; then',
+            f'    export LD_LIBRARY_PATH="$_root/{ArchVariants.HWCAPS_DIR}/$_best${{LD_LIBRARY_PATH:+:$LD_LIBRARY_PATH}}"',
+            "fi",
+            "unset _root _flags _best _ok _f",
+        ]
+        with InstallTracker.Step():
+            with open(os.path.join(hwcapsRoot, "manifest.json"), "w", encoding="utf-8") as fw:
+                json.dump(manifest, fw, indent=1)
+            os.makedirs(os.path.join(Config.DIR_INSTALL_ROOT, "bin"), exist_ok=True)
+            with open(os.path.join(Config.DIR_INSTALL_ROOT, "bin", "arch_env.sh"), "w", encoding="utf-8") as fw:
+                fw.write("\n".join(lines) + "\n")
+        summary = ", ".join(f"{level} {len(item['libraries'])} files" for level, item in manifest.items())
+        Tools.Log(f"arch variants: {summary}")
+
+
+class Benchmark:
+    """
+    Optional stage after the build, measuring the installed libraries and tools on this machine. Every result is
+    "higher is better". Baselines are kept per install root in build_cache/benchmarks/<root>.json, results lower
+    than the baseline by more than Config.BENCHMARK_THRESHOLD fail the build.
+    """
+
+    MIN_SECONDS = 0.5  # 每项至少运行的时间, 取最快的一次
+    DATA_MB = 64  # 压缩测试的数据量
+    DGEMM_SIZE = 1024
+    SQLITE_ROWS = 200000
+    FAISS_SOURCE = """
+#include <faiss/IndexFlat.h>
+#include <chrono>
+#include <cstdio>
+#include <random>
+#include <vector>
+int main() {
+    const int d = 128, nb = 100000, nq = 500, k = 10;
+    std::vector<float> xb(size_t(d) * nb), xq(size_t(d) * nq), distances(size_t(k) * nq);
+    std::vector<faiss::Index::idx_t> labels(size_t(k) * nq);
+    std::mt19937 rng(1);
+    std::uniform_real_distribution<float> dist;
+    for (auto& v : xb) v = dist(rng);
+    for (auto& v : xq) v = dist(rng);
+    faiss::IndexFlatL2 index(d);
+    index.add(nb, xb.data());
+    double best = 0;
+    for (int i = 0; i < 3; ++i) {
+        auto start = std::chrono::steady_clock::now();
+        index.search(nq, xq.data(), k, distances.data(), labels.data());
+        std::chrono::duration<double> seconds = std::chrono::steady_clock::now() - start;
+        best = std::max(best, nq / seconds.count());
+    }
+    std::printf("%f\\n", best);
+    return 0;
+}
+"""
+
+    def _Dir() -> str:
+        return os.path.join(Config.DIR_BUILD_TMP, "benchmark")
+
+    def _BaselineFile() -> str:
+        return os.path.join(Config.DIR_CACHE, "benchmarks", f"{os.path.basename(Config.DIR_INSTALL_ROOT)}.json")
+
+    def _Lib(name: str) -> typing.Optional[ctypes.CDLL]:
+        files = Tools.GlobByRegex(f"{Config.DIR_INSTALL_ROOT}/lib", re.compile(rf"lib{name}\.so(\.\d+)*"))
+        if not files:
+            return None
+        # 依赖的库在同一目录, 需要全局可见
+        return ctypes.CDLL(os.path.join(Config.DIR_INSTALL_ROOT, "lib", sorted(files, key=len)[0]), ctypes.RTLD_GLOBAL)
+
+    def _Rate(fn: typing.Callable, amount: float) -> float:
+        """amount per second of the fastest call of fn, calling it for at least MIN_SECONDS."""
+        best, total, count = None, 0.0, 0
+        while total < Benchmark.MIN_SECONDS or count < 3:
+            start = time.perf_counter()
+            fn()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+            total += elapsed
+            count += 1
+        return amount / best
+
+    def _Data() -> bytes:
+        # 可压缩的数据: 随机选取的单词, 每次相同
+        rng = random.Random(1)
+        letters = b"abcdefghijklmnopqrstuvwxyz"
+        words = [bytes(rng.choice(letters) for _ in range(rng.randint(2, 10))) for _ in range(2000)]
+        chunk = b" ".join(rng.choice(words) for _ in range(200000))
+        return (chunk * (Benchmark.DATA_MB * (1 << 20) // len(chunk) + 1))[: Benchmark.DATA_MB << 20]
+
+    def Openssl() -> typing.Dict[str, float]:
+        result = {}
+        for algorithm in ["aes-256-gcm", "sha256"]:
+            output = subprocess.run(
+                [f"{Config.DIR_INSTALL_ROOT}/bin/openssl", "speed", "-mr", "-seconds", "1", "-evp", algorithm],
+                capture_output=True,
+                encoding=OS_ENCODING,
+                env={**os.environ, "LD_LIBRARY_PATH": f"{Config.DIR_INSTALL_ROOT}/lib"},
+                check=True,
+            ).stdout
+            # +F:<index>:<name>:<bytes/s of each block size>...
+            lines = [line for line in output.splitlines() if line.startswith("+F:")]
+            result[f"openssl.{algorithm} MB/s"] = float(lines[-1].split(":")[-1]) / (1 << 20)
+        return result
+
+    def Compression() -> typing.Dict[str, float]:
+        result = {}
+        data = Benchmark._Data()
+        megabytes = len(data) / (1 << 20)
+        zstd = Benchmark._Lib("zstd")
+        if zstd:
+            zstd.ZSTD_compressBound.restype = ctypes.c_size_t
+            zstd.ZSTD_compress.restype = ctypes.c_size_t
+            zstd.ZSTD_decompress.restype = ctypes.c_size_t
+            bound = zstd.ZSTD_compressBound(ctypes.c_size_t(len(data)))
+            compressed = ctypes.create_string_buffer(bound)
+            decompressed = ctypes.create_string_buffer(len(data))
+            size = ctypes.c_size_t(0)
+
+            def ZstdCompress():
+                size.value = zstd.ZSTD_compress(compressed, ctypes.c_size_t(bound), data, ctypes.c_size_t(len(data)), 3)
+
+            def ZstdDecompress():
+                assert zstd.ZSTD_decompress(decompressed, ctypes.c_size_t(len(data)), compressed, size) == len(data)
+
+            result["zstd.compress MB/s"] = Benchmark._Rate(ZstdCompress, megabytes)
+            result["zstd.decompress MB/s"] = Benchmark._Rate(ZstdDecompress, megabytes)
+        zlib = Benchmark._Lib("z")
+        if zlib:
+            bound = zlib.compressBound(ctypes.c_ulong(len(data)))
+            compressed = ctypes.create_string_buffer(bound)
+            decompressed = ctypes.create_string_buffer(len(data))
+            compressedSize = ctypes.c_ulong(0)
+
+            def ZlibCompress():
+                compressedSize.value = bound
+                assert zlib.compress2(compressed, ctypes.byref(compressedSize), data, ctypes.c_ulong(len(data)), 6) == 0
+
+            def ZlibDecompress():
+                size = ctypes.c_ulong(len(data))
+                assert zlib.uncompress(decompressed, ctypes.byref(size), compressed, compressedSize) == 0
+
+            result["zlib.compress MB/s"] = Benchmark._Rate(ZlibCompress, megabytes)
+            result["zlib.decompress MB/s"] = Benchmark._Rate(ZlibDecompress, megabytes)
+        return result
+
+    def Video() -> typing.Dict[str, float]:
+        if not os.path.exists(f"{Config.DIR_INSTALL_ROOT}/bin/ffmpeg"):
+            return {}
+        clip = os.path.join(Benchmark._Dir(), "clip.y4m")
+        frames = 90
+        Pgo.Ffmpeg(f"-f lavfi -i testsrc2=size=1280x720:rate=30 -frames:v {frames} -pix_fmt yuv420p {clip}")
+        result = {}
+        for name, encoderArgs in [("x264", "-c:v libx264 -preset medium"), ("x265", "-c:v libx265 -preset medium")]:
+            if not Tools.GlobByRegex(f"{Config.DIR_INSTALL_ROOT}/lib", re.compile(rf"lib{name}\.so.*")):
+                continue
+            output = os.path.join(Benchmark._Dir(), f"{name}.mkv")
+            seconds = min(Pgo.Ffmpeg(f"-i {clip} {encoderArgs} {output}") for _ in range(2))
+            result[f"{name}.encode fps"] = frames / seconds
+        return result
+
+    def Dgemm() -> typing.Dict[str, float]:
+        openblas = Benchmark._Lib("openblas")
+        if not openblas:
+            return {}
+        n = Benchmark.DGEMM_SIZE
+        matrixType = ctypes.c_double * (n * n)
+        a, b, c = matrixType(*([0.5] * (n * n))), matrixType(*([0.25] * (n * n))), matrixType()
+        args = [ctypes.c_int(n)] * 3 + [ctypes.c_double(1.0), a, ctypes.c_int(n), b, ctypes.c_int(n)]
+        args += [ctypes.c_double(0.0), c, ctypes.c_int(n)]
+        # CblasRowMajor, CblasNoTrans, CblasNoTrans
+        fn = lambda: openblas.cblas_dgemm(101, 111, 111, *args)
+        return {"openblas.dgemm GFLOPS": Benchmark._Rate(fn, 2 * n**3 / 1e9)}
+
+    def Faiss() -> typing.Dict[str, float]:
+        if not Benchmark._Lib("faiss"):
+            return {}
+        source = os.path.join(Benchmark._Dir(), "faiss_flat.cpp")
+        binary = os.path.join(Benchmark._Dir(), "faiss_flat")
+        with open(source, "w", encoding="utf-8") as fw:
+            fw.write(Benchmark.FAISS_SOURCE)
+        SUBPROCESS_RUN(
+            input=f"{Config.ENV.CXX} {Config.ENV.CXXFLAGS} -O2 {source} -o {binary} {Config.ENV.LDFLAGS} "
+            f"-lfaiss -lopenblas -fopenmp -Wl,-rpath,{Config.DIR_INSTALL_ROOT}/lib",
+            check=True,
+        )
+        output = subprocess.run([binary], capture_output=True, encoding=OS_ENCODING, check=True).stdout
+        return {"faiss.flat_search queries/s": float(output.strip())}
+
+    def Sqlite() -> typing.Dict[str, float]:
+        sqlite = Benchmark._Lib("sqlite3")
+        if not sqlite:
+            return {}
+        db = ctypes.c_void_p()
+        assert sqlite.sqlite3_open(b":memory:", ctypes.byref(db)) == 0
+        rows = Benchmark.SQLITE_ROWS
+
+        def Exec(sql: str):
+            assert sqlite.sqlite3_exec(db, sql.encode(), None, None, None) == 0, sql
+
+        def Insert():
+            Exec(
+                "DROP TABLE IF EXISTS t; CREATE TABLE t(k INTEGER PRIMARY KEY, v TEXT); "
+                f"WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c WHERE x < {rows}) "
+                "INSERT INTO t SELECT x, hex(randomblob(16)) FROM c;"
+            )
+
+        result = {"sqlite.insert rows/s": Benchmark._Rate(Insert, rows)}
+        selectFn = lambda: Exec("SELECT count(*), max(v) FROM t WHERE k % 7 = 3 AND v > '8';")
+        result["sqlite.select rows/s"] = Benchmark._Rate(selectFn, rows)
+        sqlite.sqlite3_close(db)
+        return result
+
+    def Compare(baseline: typing.Dict[str, float], results: typing.Dict[str, float]) -> typing.List[str]:
+        """Log the results table, return the regressed items."""
+        regressions = []
+        lines = [f"{'benchmark':<32}{'baseline':>12}{'result':>12}{'change':>10}"]
+        for name, value in results.items():
+            base = baseline.get(name)
+            change = "" if not base else f"{value / base - 1:+.1%}"
+            if base and value < base * (1 - Config.BENCHMARK_THRESHOLD):
+                regressions.append(name)
+                change += " !"
+            baseText = f"{base:.1f}" if base else "-"
+            lines.append(f"{name:<32}{baseText:>12}{value:>12.1f}{change:>10}")
+        Tools.Log("benchmark:\n" + "\n".join(lines))
+        return regressions
+
+    def Run() -> None:
+        if Config.TARGET_OS != TargetOs.linux:
+            Tools.Log("benchmark: only supported by linux builds, skipped")
+            return
+        Tools.RemoveFileOrDirs(Benchmark._Dir())
+        os.makedirs(Benchmark._Dir())
+        results = {}
+        for fn in [
+            Benchmark.Openssl,
+            Benchmark.Compression,
+            Benchmark.Video,
+            Benchmark.Dgemm,
+            Benchmark.Faiss,
+            Benchmark.Sqlite,
+        ]:
+            with Trace.Span(fn.__name__, "benchmark"):
+                results.update(fn())
+        with open(os.path.join(Benchmark._Dir(), "results.json"), "w", encoding="utf-8") as fw:
+            json.dump(results, fw, indent=1)
+
+        baselineFile = Benchmark._BaselineFile()
+        try:
+            with open(baselineFile, encoding="utf-8") as fr:
+                baseline = json.load(fr)
+        except (OSError, ValueError):
+            baseline = {}
+        regressions = Benchmark.Compare(baseline, results)
+        # 新增的项目加入基线, 已有的只在指定时更新
+        baseline = {**results, **baseline} if not Config.BENCHMARK_UPDATE else {**baseline, **results}
+        os.makedirs(os.path.dirname(baselineFile), exist_ok=True)
+        with open(baselineFile + ".tmp", "w", encoding="utf-8") as fw:
+            json.dump(baseline, fw, indent=1)
+        os.replace(baselineFile + ".tmp", baselineFile)
+        if regressions and not Config.BENCHMARK_UPDATE:
+            raise RuntimeError(f"benchmark regressed more than {Config.BENCHMARK_THRESHOLD:.0%}: {regressions}")
 
 
 # ------------------------------------------------------------------------------------------------
 
 
 class Builder:
+    REQUIRED_VERSION_RULE = PatchRule(
+        re.compile(r"(CMAKE_MINIMUM_REQUIRED\s*\(\s*VERSION)\s+[\d\.]+", re.IGNORECASE), r"\g<1> 3.27", 1
+    )
+
     def PrepareSrcPackage(compressedFilePatten: str, decompressedDirPatten: str):
         os.chdir(Config.DIR_BASE)
-        Tools.Decompress(f"src_package/{compressedFilePatten}", Config.DIR_BUILD_TMP)
+        with Trace.Span("extract", archive=compressedFilePatten):
+            SourceCache.Checkout(f"src_package/{compressedFilePatten}", Config.DIR_BUILD_TMP)
         curDir = glob.glob(f"{Config.DIR_BUILD_TMP}/{decompressedDirPatten}")
         assert len(curDir) == 1
         os.chdir(curDir[0])
@@ -414,21 +2951,17 @@ class Builder:
         env: typing.Dict[str, str] = None,  # None means Config.EnvDict()
         buildDir: str = "build",  # building in this dir, and "../CMakeLists.txt" must exist!
         changeRequiredVersion: bool = False,
-        parallelJobs=multiprocessing.cpu_count(),
+        parallelJobs: int = None,  # None means Config.PARALLEL_JOBS
     ):
         Builder.PrepareSrcPackage(compressedFilePatten, decompressedDirPatten)
-        if fnPrebuild:
-            fnPrebuild()
-        assert not os.path.isabs(buildDir)
-        os.makedirs(buildDir, exist_ok=True)
-        os.chdir(buildDir)
-        if changeRequiredVersion:
-            Tools.RegexLineByLine(
-                "../CMakeLists.txt",
-                re.compile(r"(CMAKE_MINIMUM_REQUIRED\s*\(\s*VERSION)\s+[\d\.]+", re.IGNORECASE),
-                lambda match: f"{match.group(1)} 3.27",
-                1,
-            )
+        with Trace.Span("prebuild"):
+            if fnPrebuild:
+                fnPrebuild()
+            assert not os.path.isabs(buildDir)
+            os.makedirs(buildDir, exist_ok=True)
+            os.chdir(buildDir)
+            if changeRequiredVersion:
+                Tools.PatchFile("../CMakeLists.txt", [Builder.REQUIRED_VERSION_RULE])
 
         cmd = ["cmake"]
         if cmakeParam is None:
@@ -436,40 +2969,93 @@ class Builder:
         cmd += cmakeParam
         if isinstance(cmakeExtraParam, list):
             cmd += cmakeExtraParam
+        cmd += CompilerCache.CMakeArgs()
+        cmd += ConfigureCache.CMakeArgs()
         cmd += [".."]
         if env is None:
             env = Config.EnvDict()
-        SUBPROCESS_RUN(input=" ".join(cmd), env=env, check=True)
-        SUBPROCESS_RUN(
-            input=rf"cmake --build . -j {parallelJobs} -t install",
-            env=env,
-            check=True,
-        )
+        with Trace.Span("configure"):
+            Builder.CleanMismatchedCMakeCache(Config.CMAKE_GENERATOR_NAME)
+            SUBPROCESS_RUN(input=" ".join(cmd), env=env, check=True)
+        buildEnv = env
+        if Config.CMAKE_GENERATOR_NAME == "Ninja":
+            if JobServer.NinjaClient():
+                buildEnv = {**env, **JobServer.NinjaEnv()}
+            else:
+                # 旧版ninja不使用jobserver, 从中取出平均份额的token后用 -j 指定
+                parallelJobs = parallelJobs or Config.PARALLEL_JOBS
+        Builder.RunParallel("cmake --build .", buildEnv, parallelJobs)
+        with Trace.Span("install"), InstallTracker.Step():
+            SUBPROCESS_RUN(input="cmake --install .", env=env, check=True)
+            # 已是最新的文件不会被重新拷贝, 以 cmake 记录的安装列表为准
+            InstallTracker.RecordManifestFile("install_manifest.txt")
+
+    def CleanMismatchedCMakeCache(generatorName: str) -> None:
+        """
+        cmake refuses to configure a build dir made by another generator, e.g. a --no_clean rebuild after
+        switching to Ninja. Remove the cache of the current dir in that case.
+        """
+        if not generatorName or not os.path.exists("CMakeCache.txt"):
+            return
+        with open("CMakeCache.txt", "r", encoding="utf-8", errors="replace") as fr:
+            reMatch = re.search(r"^CMAKE_GENERATOR:INTERNAL=(.*)$", fr.read(), flags=re.MULTILINE)
+        if reMatch and reMatch.group(1).strip() != generatorName:
+            Tools.Log(f"generator changed: {reMatch.group(1).strip()} -> {generatorName}, clean {os.getcwd()}")
+            Tools.RemoveFileOrDirs(os.path.join(os.getcwd(), "*"))
 
     def MakefileBuild(
         cmd: str,
-        env: typing.Dict[str, str] = None,  # None means Config.EnvDict()
+        env: typing.Dict[str, str] = None,  # None means Config.EnvDict(launcher=True)
         *,
-        parallelJobs=multiprocessing.cpu_count(),
+        parallelJobs: int = None,  # None means Config.PARALLEL_JOBS
     ):
         if env is None:
-            env = Config.EnvDict()
-        SUBPROCESS_RUN(input=cmd, env=env, check=True)
-        SUBPROCESS_RUN(input=f"make -j{parallelJobs}", env=env, check=True)
-        SUBPROCESS_RUN(input="make install", env=env, check=True)
+            env = Config.EnvDict(launcher=True)
+        with Trace.Span("configure"):
+            SUBPROCESS_RUN(input=cmd, env=ConfigureCache.AutoconfEnv(cmd, env), check=True)
+        Builder.RunParallel("make", env, parallelJobs)
+        with Trace.Span("install"), InstallTracker.Step():
+            SUBPROCESS_RUN(input="make install", env=Builder.EnvWithoutJobServer(env), check=True)
+
+    def RunParallel(cmd: str, env: typing.Dict[str, str], parallelJobs: int = None) -> None:
+        """
+        Run a make-like build command ("make", "cmake --build .") under the shared JobServer.
+        parallelJobs: None means make joins the jobserver through MAKEFLAGS,
+        otherwise at most parallelJobs tokens are taken and passed with "-j".
+        """
+        with Trace.Span("compile"):
+            if parallelJobs is None and JobServer.IsActive():
+                # 不能再指定 -j, 否则make会新建自己的jobserver
+                SUBPROCESS_RUN(input=cmd, env=env, check=True)
+                return
+            with JobServer.Reserve(parallelJobs or Config.PARALLEL_JOBS, JobServer.FAIR_SHARE_WAIT) as jobs:
+                SUBPROCESS_RUN(input=f"{cmd} -j {jobs}", env=Builder.EnvWithoutJobServer(env), check=True)
+
+    def EnvWithoutJobServer(env: typing.Dict[str, str]) -> typing.Dict[str, str]:
+        # make install 等不需要并行的命令
+        return {k: v for k, v in env.items() if k != "MAKEFLAGS"}
 
     def PkgconigAddPrivLibsToPubLibs(pkgFile: str):
-        privateLibs = ""
+        with Trace.Span("pkgconfig", file=os.path.basename(pkgFile)), InstallTracker.Step():
+            Builder._PkgconigAddPrivLibsToPubLibs(pkgFile)
 
-        def FindPrivateLibs(reMatch: re.Match):
-            nonlocal privateLibs
-            privateLibs = reMatch.group(1)
-            return reMatch.group(0)
+    def _PkgconigAddPrivLibsToPubLibs(pkgFile: str):
+        # .pc 文件中 Libs 在 Libs.private 之前, 整个读入后一次处理
+        text, encoding = Tools.ReadText(pkgFile)
+        privateLibs = re.search(r"^Libs.private:([^\r\n]*)", text, flags=re.IGNORECASE | re.MULTILINE)
+        if not privateLibs or not privateLibs.group(1).strip():
+            return
+        privateLibs = privateLibs.group(1)
 
-        Tools.RegexLineByLine(pkgFile, re.compile(r"Libs.private:(.*)", flags=re.IGNORECASE), FindPrivateLibs, 1)
-        Tools.RegexLineByLine(
-            pkgFile, re.compile(r"Libs:.*", flags=re.IGNORECASE), lambda reMatch: reMatch.group(0) + privateLibs
-        )
+        def AddPrivateLibs(reMatch: re.Match):
+            if reMatch.group(0).endswith(privateLibs):
+                return reMatch.group(0)
+            return reMatch.group(0) + privateLibs
+
+        newText = re.sub(r"^Libs:[^\r\n]*", AddPrivateLibs, text, flags=re.IGNORECASE | re.MULTILINE)
+        if newText != text:
+            with open(pkgFile, "w", encoding=encoding, newline="") as fw:
+                fw.write(newText)
 
     # ------------------------------------------------------------------------------------------------
 
@@ -495,7 +3081,7 @@ class Builder:
     def BuildOpenssl():
         Builder.PrepareSrcPackage("openssl*.tar.gz", "openssl*")
         cmd = []
-        env = Config.EnvDict()
+        env = Config.EnvDict(launcher=True)
         if Config.TARGET_OS == TargetOs.windows:
             cmd.append("perl Configure VC-WIN64A")
             # 1. 需要安装perl和nasm
@@ -521,14 +3107,20 @@ class Builder:
                 "--libdir=lib --openssldir=./SSL shared -DOPENSSL_NO_ASYNC",
             ]
         )
-        SUBPROCESS_RUN(input=cmd, env=env, check=True)
+        with Trace.Span("configure"):
+            SUBPROCESS_RUN(input=cmd, env=env, check=True)
         # 不安装doc，生成doc太慢了
         if Config.TARGET_OS == TargetOs.windows:
-            SUBPROCESS_RUN(input="nmake", env=env, check=True)
-            SUBPROCESS_RUN(input="nmake install_sw install_ssldirs", env=env, check=True)
+            with Trace.Span("compile"):
+                SUBPROCESS_RUN(input="nmake", env=env, check=True)
+            with Trace.Span("install"), InstallTracker.Step():
+                SUBPROCESS_RUN(input="nmake install_sw install_ssldirs", env=env, check=True)
         else:
-            SUBPROCESS_RUN(input=f"make -j{multiprocessing.cpu_count()}", env=env, check=True)
-            SUBPROCESS_RUN(input="make install_sw install_ssldirs", env=env, check=True)
+            Builder.RunParallel("make", env)
+            with Trace.Span("install"), InstallTracker.Step():
+                SUBPROCESS_RUN(
+                    input="make install_sw install_ssldirs", env=Builder.EnvWithoutJobServer(env), check=True
+                )
 
     def BuildIconv():
         if Config.TARGET_OS == TargetOs.windows:
@@ -541,23 +3133,23 @@ class Builder:
         Builder.MakefileBuild(cmd)
 
     def BuildBoost():
-        os.chdir(Config.DIR_BASE)
-        Tools.Decompress("src_package/boost_*.tar.gz", Config.DIR_INSTALL_ROOT)
-        boostDir = glob.glob(f"{Config.DIR_INSTALL_ROOT}/boost_*")
-        assert len(boostDir) == 1
-        boostDir = boostDir[0]
-        os.chdir(boostDir)
+        # 在编译目录中编译, 完成后整个目录移动到安装目录
+        Builder.PrepareSrcPackage("boost_*.tar.gz", "boost_*")
+        boostDir = os.getcwd()
 
         # 文档: jamroot and index.html -> tools -> boost.build -> section 4
         configJam = "./user-config.jam"
-        cmd = [
-            f"./b2 stage -d 2 --debug-configuration --user-config={configJam} --hash link=static",
+        cmd = [f"./b2 stage -d 2 --debug-configuration --user-config={configJam} --hash link=static"]
+        if Config.BOOST_COMPONENTS:
+            # --with-* 与 --without-* 不能同时使用
+            cmd.extend([f"--with-{item}" for item in Config.BOOST_COMPONENTS])
+        else:
             # python 使用 pybind11
-            "--without-python",
-        ]
+            cmd.append("--without-python")
         with open(configJam, mode="w") as fwConfig:
             if Config.TARGET_OS == TargetOs.windows:
-                SUBPROCESS_RUN(input="bootstrap.bat", check=True)
+                with Trace.Span("configure"):
+                    SUBPROCESS_RUN(input="bootstrap.bat", check=True)
                 """toolset对应关系
                 Visual Studio 2022 -- 14.3
                 Visual Studio 2019 -- 14.2
@@ -571,22 +3163,26 @@ class Builder:
                 """
                 cmd.append("toolset=msvc-14.2")
             else:
-                SUBPROCESS_RUN(input="bash bootstrap.sh", check=True)
+                with Trace.Span("configure"):
+                    SUBPROCESS_RUN(input="bash bootstrap.sh", check=True)
                 # "-s ICONV_PATH" 不需要了，CXXFLAGS, LDFLAGS已经有路径了。(libs/locale/build/Jamfile.v2)
                 if Config.TARGET_OS == TargetOs.android:
-                    fwConfig.write(f"using clang : arm64 : {Config.ENV.CXX} : ;\n")
+                    fwConfig.write(f"using clang : arm64 : {CompilerCache.Wrap(Config.ENV.CXX)} : ;\n")
                     cmd.append("toolset=clang-arm64 target-os=android architecture=arm binary-format=elf abi=aapcs")
                 else:
                     if Config.IS_CLANG:
                         cmd.append("toolset=clang")
                     else:
                         cmd.append("toolset=gcc")
+                    if CompilerCache.IsActive():
+                        # project-config.jam 中的 "using gcc ;" 在已初始化时会跳过
+                        toolset = "clang" if Config.IS_CLANG else "gcc"
+                        fwConfig.write(f"using {toolset} : : {CompilerCache.Wrap(Config.ENV.CXX)} ;\n")
                     # statx 是linux kernel 4.11才加入的，如果系统是低版本的，但在高版本的docker内编译，能编译但运行就会出错。
                     disableStatx = True
                     if Config.BUILD_NATIVE_ARCH:
-                        reMatch = re.compile(r"^Linux\s+version\s+(\d+\.\d+)\..*").search(
-                            SUBPROCESS_RUN(input="cat /proc/version", capture_output=True).stdout.decode()
-                        )
+                        with open("/proc/version") as fr:
+                            reMatch = re.compile(r"^Linux\s+version\s+(\d+\.\d+)\..*").search(fr.read())
                         try:
                             if reMatch and float(reMatch.group(1)) >= 4.11:
                                 disableStatx = False
@@ -628,12 +3224,22 @@ class Builder:
             for item in ["shared", "static"]:
                 cmdExtra = f" runtime-link={item}"
                 Tools.Log(cmd + cmdExtra)
-                SUBPROCESS_RUN(input=cmd + cmdExtra, env=env, check=True)
+                with Trace.Span("compile"), JobServer.Reserve(Config.PARALLEL_JOBS) as jobs:
+                    SUBPROCESS_RUN(input=f"{cmd}{cmdExtra} -j {jobs}", env=env, check=True)
         else:
             # linux 上 runtime-link如果用static 编译时会加 -static
-            SUBPROCESS_RUN(input=" ".join(cmd), env=env, check=True)
+            # b2 不支持jobserver, 从中取出token后用 -j 指定, 编译时间长, 等待平均份额的token
+            with Trace.Span("compile"), JobServer.Reserve(Config.PARALLEL_JOBS, JobServer.FAIR_SHARE_WAIT) as jobs:
+                SUBPROCESS_RUN(input=f"{' '.join(cmd)} -j {jobs}", env=Builder.EnvWithoutJobServer(env), check=True)
+            # 同步删除: 后台删除时回收站目录在 boostDir 中, 会被一起移到安装目录, 记录的安装文件随后消失
             Tools.RemoveFileOrDirs("./bin.v2")
-        Config.InitBoostCmakeArgs(boostDir)
+
+        installDir = os.path.join(Config.DIR_INSTALL_ROOT, os.path.basename(boostDir))
+        os.chdir(Config.DIR_BUILD_TMP)
+        with Trace.Span("install"), InstallTracker.Step():
+            Tools.RemoveFileOrDirs(installDir)
+            shutil.move(boostDir, installDir)
+        Config.InitBoostCmakeArgs(installDir)
 
     def BuildJpeg():
         Builder.CMakeBuild(
@@ -667,8 +3273,9 @@ class Builder:
         )
         if Config.TARGET_OS == TargetOs.android:
             # android上必须通过java层初始化jni环境，否则无法使用。因此拷贝官方提供的java初始化代码。
-            Tools.RemoveFileOrDirs(f"{Config.DIR_INSTALL_ROOT}/lib/java")
-            Tools.CopyFileOrDirs("../android-project/app/src/main/java", f"{Config.DIR_INSTALL_ROOT}/lib")
+            with InstallTracker.Step():
+                Tools.RemoveFileOrDirs(f"{Config.DIR_INSTALL_ROOT}/lib/java")
+                Tools.CopyFileOrDirs("../android-project/app/src/main/java", f"{Config.DIR_INSTALL_ROOT}/lib")
 
     def BuildOpus():
         def PreBuild():
@@ -722,7 +3329,7 @@ class Builder:
         Builder.PrepareSrcPackage("ffmpeg*.tar.xz", "ffmpeg*")
         # ffmpeg交叉编译时默认使用${cross-prefix}-pkg-config，不一定存在，存在也可能有bug(ubuntu20中mingw的pkg-config工具)，
         # 因此明确指明pkg-config工具
-        cmd = f'./configure --pkg-config=pkg-config --prefix={Config.DIR_INSTALL_ROOT} --enable-shared --disable-static --enable-pic --enable-gpl --enable-nonfree --cc={Config.ENV.CC} --cxx={Config.ENV.CXX} --extra-cflags="{Config.ENV.CFLAGS}" --extra-cxxflags="{Config.ENV.CXXFLAGS}" --extra-ldflags="{Config.ENV.LDFLAGS}" '
+        cmd = f'./configure --pkg-config=pkg-config --prefix={Config.DIR_INSTALL_ROOT} --enable-shared --disable-static --enable-pic --enable-gpl --enable-nonfree --cc="{CompilerCache.Wrap(Config.ENV.CC)}" --cxx="{CompilerCache.Wrap(Config.ENV.CXX)}" --extra-cflags="{Config.ENV.CFLAGS}" --extra-cxxflags="{Config.ENV.CXXFLAGS}" --extra-ldflags="{Config.ENV.LDFLAGS}" '
 
         if Config.BUILD_TYPE == BuildType.debug:
             cmd += "--enable-debug --disable-optimizations --disable-stripping "
@@ -736,45 +3343,34 @@ class Builder:
         else:
             cmd += f"--enable-openssl --enable-libopus --enable-libx264 --enable-libx265 --enable-libvpx "
         Builder.MakefileBuild(cmd)
-        if Config.TARGET_OS == TargetOs.linux:
-            # 优化软连接：
-            # 原本的状态：比如
-            # libavcodec.so -> libavcodec.so.58.91.100
-            # libavcodec.so.58 -> libavcodec.so.58.91.100
-            # libavformat.so 依赖 libavcodec.so.58
-            # 编译的时候 -lavformat -lavcodec，安装时候递归拷贝libavcodec.so,libavformat.so，运行就会报找不到so。因为libavformat.so
-            # 依赖的是libavcodec.so.58，不是libavcodec.so或libavcodec.so.58.91.100，还必须把libavcodec.so.58这个软连接单独拷贝。
-            libDir = f"{Config.DIR_INSTALL_ROOT}/lib"
-            os.chdir(libDir)
-            for item in ["avutil", "swresample", "swscale", "postproc", "avcodec", "avformat", "avfilter", "avdevice"]:
-                link = f"lib{item}.so"
-                Tools.RemoveFileOrDirs(link)
-                file = Tools.GlobByRegex(libDir, re.compile(rf"{link}\.\d+"))
-                assert len(file) == 1
-                SUBPROCESS_RUN(input=f"ln -f -s {file[0]} {link}", check=True)
+        # libavcodec.so 等软链接由 SharedLibs.Run 统一修正
 
     def BuildOpenBlas():
         def Prebuild():
-            # 修改debug模式生成文件名字
-            Tools.RegexLineByLine(
+            Tools.PatchFile(
                 "./CMakeLists.txt",
-                re.compile(r"set_target_properties.*?LIBRARY_OUTPUT_NAME_DEBUG.*", flags=re.IGNORECASE),
-                lambda reMatch: f"# {reMatch.group(0)}",
-            )
-            # 修改.cmake安装位置
-            Tools.RegexLineByLine(
-                "./CMakeLists.txt",
-                re.compile(r"(set\s*\(\s*CMAKECONFIG_INSTALL_DIR.*?)share", flags=re.IGNORECASE),
-                lambda reMatch: f"{reMatch.group(1)}lib",
-                1,
+                [
+                    # 修改debug模式生成文件名字
+                    PatchRule(
+                        re.compile(r"set_target_properties.*?LIBRARY_OUTPUT_NAME_DEBUG.*", flags=re.IGNORECASE),
+                        lambda reMatch: f"# {reMatch.group(0)}",
+                    ),
+                    # 修改.cmake安装位置
+                    PatchRule(
+                        re.compile(r"(set\s*\(\s*CMAKECONFIG_INSTALL_DIR.*?)share", flags=re.IGNORECASE),
+                        lambda reMatch: f"{reMatch.group(1)}lib",
+                        1,
+                    ),
+                    Builder.REQUIRED_VERSION_RULE,
+                ],
             )
 
+        # 版本号在 Prebuild 中一并修改, 只改写一次文件
         Builder.CMakeBuild(
             "OpenBLAS*.tar.gz",
             "OpenBLAS*",
             Prebuild,
             cmakeExtraParam=["-D BUILD_SHARED_LIBS=ON", "-D NUM_THREADS=64"],
-            changeRequiredVersion=True,
         )
 
     def BuildHdf5():
@@ -799,16 +3395,21 @@ class Builder:
             ],
         )
 
-    def BuildMlpack():
+    def BuildStb():
         if Config.TARGET_OS != TargetOs.linux:
             return
         os.chdir(Config.DIR_BASE)
-        Tools.Decompress("src_package/stb*.tar.gz", f"{Config.DIR_INSTALL_ROOT}/include")
-        SUBPROCESS_RUN(
-            input=f"mv {Config.DIR_INSTALL_ROOT}/include/stb/include/* {Config.DIR_INSTALL_ROOT}/include/stb/",
-            check=True,
-        )
-        Tools.RemoveFileOrDirs(f"{Config.DIR_INSTALL_ROOT}/include/stb/include")
+        with InstallTracker.Step():
+            Tools.Decompress("src_package/stb*.tar.gz", f"{Config.DIR_INSTALL_ROOT}/include")
+            stbDir = f"{Config.DIR_INSTALL_ROOT}/include/stb"
+            for name in os.listdir(f"{stbDir}/include"):
+                Tools.RemoveFileOrDirs(f"{stbDir}/{name}")
+                os.rename(f"{stbDir}/include/{name}", f"{stbDir}/{name}")
+            Tools.RemoveFileOrDirs(f"{stbDir}/include")
+
+    def BuildMlpack():
+        if Config.TARGET_OS != TargetOs.linux:
+            return
 
         def Prebuild():
             # 删除 IMPLICIT_INCLUDE_DIRECTORIES 会导致误删除必要的include 目录
@@ -827,76 +3428,47 @@ class Builder:
             Prebuild,
             cmakeExtraParam=cmakeExtraParam,
             changeRequiredVersion=True,
-            parallelJobs=multiprocessing.cpu_count() // 2,  # 编译比较耗内存，减少个数避免出错
         )
 
+    def BuildFmt():
+        Builder.CMakeBuild(
+            "fmt*.tar.gz",
+            "fmt*",
+            cmakeExtraParam=["-D FMT_DOC=OFF", "-D FMT_TEST=OFF", "-D BUILD_SHARED_LIBS=OFF"],
+            changeRequiredVersion=True,
+        )
 
-if __name__ == "__main__":
-    Config.InitConfig()
-    parser = argparse.ArgumentParser("Build ThirdParty")
-    parser.add_argument("--debug_env", action="store_true", help="debug env")
-    parser.add_argument("--no_clean", action="store_true", help="don't clean old build cache")
-    args = parser.parse_known_args(sys.argv[1:])
-    if args[0].debug_env:
-        Tools.Log(f"Debug env, next, exter new interactive shell...")
-        returncode = SUBPROCESS_RUN(env=Config.EnvDict()).returncode
-        Tools.Log(f"Exit with {returncode}!")
-        sys.exit(returncode)
-    if args[0].no_clean:
-        Config.InitBoostCmakeArgs()
-    else:
-        Tools.RemoveFileOrDirs(Config.DIR_BUILD_TMP)
-        os.makedirs(Config.DIR_BUILD_TMP, exist_ok=True)
-        Tools.RemoveFileOrDirs(Config.DIR_INSTALL_ROOT)
-
-    Builder.BuildLua()
-    Builder.CMakeBuild(
-        "fmt*.tar.gz",
-        "fmt*",
-        cmakeExtraParam=["-D FMT_DOC=OFF", "-D FMT_TEST=OFF", "-D BUILD_SHARED_LIBS=OFF"],
-        changeRequiredVersion=True,
-    )
-    Builder.CMakeBuild(
-        "spdlog*.zip",
-        "spdlog*",
-        cmakeExtraParam=["-D SPDLOG_ENABLE_PCH=ON", "-D SPDLOG_BUILD_PIC=ON", "-D SPDLOG_FMT_EXTERNAL=ON"],
-    )
-    Builder.CMakeBuild(
-        "zlib*.zip",
-        "zlib*",
-        cmakeExtraParam=[
-            f"-D INSTALL_INC_DIR:PATH={Config.DIR_INSTALL_ROOT}/include/zlib",
-            f"-D INSTALL_PKGCONFIG_DIR:PATH={Config.DIR_INSTALL_ROOT}/lib/pkgconfig",
-        ],
-    )
-    Builder.CMakeBuild(
-        "zstd*.tar.gz",
-        "zstd*",
-        cmakeExtraParam=[
-            f"-D CMAKE_INSTALL_INCLUDEDIR={Config.DIR_INSTALL_ROOT}/include/zstd",
-        ],
-        buildDir="build/cmake/build",
-    )
-    # Builder.CMakeBuild("brotli*.tar.gz", "brotli*", buildDir="out")
-    Builder.BuildSqlite3()
-    Builder.BuildPugixml()
-    Builder.BuildOpenssl()
-    Builder.BuildIconv()
-    Builder.BuildBoost()
-    if Config.BUILD_VIDEO_AUDIO:
-        Builder.BuildJpeg()
-        Builder.BuildYuv()
-        Builder.BuildSdl2()
-        Builder.BuildOpus()
-        Builder.BuildX264()
-        if Config.TARGET_OS != TargetOs.android:
-            # 汇编代码不支持android平台，性能差
-            Builder.CMakeBuild("x265*.tar.gz", "x265*", buildDir="source/build")
-        Builder.BuildVpx()
-        Builder.BuildFfmpeg()
-
-    if Config.BUILD_MACHINE_LEARNING:
-        Builder.BuildOpenBlas()
+    def BuildSpdlog():
+        Builder.CMakeBuild(
+            "spdlog*.zip",
+            "spdlog*",
+            cmakeExtraParam=["-D SPDLOG_ENABLE_PCH=ON", "-D SPDLOG_BUILD_PIC=ON", "-D SPDLOG_FMT_EXTERNAL=ON"],
+        )
+
+    def BuildZlib():
+        Builder.CMakeBuild(
+            "zlib*.zip",
+            "zlib*",
+            cmakeExtraParam=[
+                f"-D INSTALL_INC_DIR:PATH={Config.DIR_INSTALL_ROOT}/include/zlib",
+                f"-D INSTALL_PKGCONFIG_DIR:PATH={Config.DIR_INSTALL_ROOT}/lib/pkgconfig",
+            ],
+        )
+
+    def BuildZstd():
+        Builder.CMakeBuild(
+            "zstd*.tar.gz",
+            "zstd*",
+            cmakeExtraParam=[
+                f"-D CMAKE_INSTALL_INCLUDEDIR={Config.DIR_INSTALL_ROOT}/include/zstd",
+            ],
+            buildDir="build/cmake/build",
+        )
+
+    def BuildX265():
+        Builder.CMakeBuild("x265*.tar.gz", "x265*", buildDir="source/build")
+
+    def BuildSuperlu():
         Builder.CMakeBuild(
             "superlu*.zip",
             "superlu*",
@@ -908,6 +3480,8 @@ if __name__ == "__main__":
             ],
             changeRequiredVersion=True,
         )
+
+    def BuildEigen():
         Builder.CMakeBuild(
             "eigen*.tar.gz",
             "eigen*",
@@ -921,7 +3495,8 @@ if __name__ == "__main__":
             ],
             changeRequiredVersion=True,
         )
-        Builder.BuildHdf5()
+
+    def BuildArmadillo():
         Builder.CMakeBuild(
             "armadillo-*.tar.xz",
             "armadillo-*",
@@ -930,7 +3505,11 @@ if __name__ == "__main__":
             ],
             changeRequiredVersion=True,
         )
+
+    def BuildEnsmallen():
         Builder.CMakeBuild("ensmallen*.tar.gz", "ensmallen*", changeRequiredVersion=True)
+
+    def BuildCereal():
         Builder.CMakeBuild(
             "cereal*.zip",
             "cereal*",
@@ -940,7 +3519,8 @@ if __name__ == "__main__":
             ],
             changeRequiredVersion=True,
         )
-        Builder.BuildMlpack()
+
+    def BuildFaiss():
         Builder.CMakeBuild(
             "faiss*.zip",
             "faiss*",
@@ -954,15 +3534,1170 @@ if __name__ == "__main__":
             ],
         )
 
-    Builder.CMakeBuild(
-        "pybind11*.tar.gz",
-        "pybind11*",
-        cmakeExtraParam=[f"-D CMAKE_INSTALL_DATAROOTDIR={Config.DIR_INSTALL_ROOT}/lib", "-D PYBIND11_TEST=OFF"],
-    )
+    def BuildPybind11():
+        Builder.CMakeBuild(
+            "pybind11*.tar.gz",
+            "pybind11*",
+            cmakeExtraParam=[f"-D CMAKE_INSTALL_DATAROOTDIR={Config.DIR_INSTALL_ROOT}/lib", "-D PYBIND11_TEST=OFF"],
+        )
 
-    if Config.TARGET_OS == TargetOs.linux:
-        # ----设置runpath，避免开发或部署时找不到依赖库 -------
-        SUBPROCESS_RUN(
-            input=f"patchelf --debug --set-rpath {Config.INSTALL_RPATH} {Config.DIR_INSTALL_ROOT}/lib/*.so",
+    # ------------------------------------------------------------------------------------------------
+
+    def Packages() -> typing.List[Package]:
+        """
+        All packages to be built for current Config, in the preferred order.
+        deps: packages that must be installed before this one.
+        """
+        packages = [
+            Package("lua", Builder.BuildLua, sources=["src_package/lua*.tar.gz", "my_conf/lua_CMakeLists.txt"]),
+            Package("fmt", Builder.BuildFmt, sources=["src_package/fmt*.tar.gz"]),
+            Package("spdlog", Builder.BuildSpdlog, ["fmt"], sources=["src_package/spdlog*.zip"]),
+            Package("zlib", Builder.BuildZlib, sources=["src_package/zlib*.zip"]),
+            Package("zstd", Builder.BuildZstd, sources=["src_package/zstd*.tar.gz"]),
+            # Package("brotli", lambda: Builder.CMakeBuild("brotli*.tar.gz", "brotli*", buildDir="out")),
+            Package(
+                "sqlite3",
+                Builder.BuildSqlite3,
+                sources=[
+                    "src_package/sqlite*.zip",
+                    "src_package/SQLiteCpp*.tar.gz",
+                    "my_conf/sqlite_CMakeLists.txt",
+                ],
+            ),
+            Package("pugixml", Builder.BuildPugixml, sources=["src_package/pugixml*.tar.gz"]),
+            Package("openssl", Builder.BuildOpenssl, weight=4, sources=["src_package/openssl*.tar.gz"]),
+            Package("iconv", Builder.BuildIconv, sources=["src_package/libiconv*.tar.gz"]),
+            Package(
+                "boost",
+                Builder.BuildBoost,
+                ["zlib", "zstd", "iconv"],
+                weight=20,
+                sources=["src_package/boost_*.tar.gz"],
+                config=["BOOST_COMPONENTS"],
+            ),
+        ]
+        if Config.BUILD_VIDEO_AUDIO:
+            packages += [
+                Package("jpeg", Builder.BuildJpeg, sources=["src_package/libjpeg-turbo*.tar.gz"]),
+                Package(
+                    "yuv",
+                    Builder.BuildYuv,
+                    ["jpeg"],
+                    sources=["src_package/libyuv*.zip", "my_conf/yuv_CMakeLists.txt"],
+                ),
+                Package("sdl2", Builder.BuildSdl2, weight=2, sources=["src_package/SDL2*.tar.gz"]),
+                Package("opus", Builder.BuildOpus, sources=["src_package/opus*.tar.gz"]),
+                Package("x264", Builder.BuildX264, sources=["src_package/x264*.tar.bz2"]),
+            ]
+            if Config.TARGET_OS != TargetOs.android:
+                # 汇编代码不支持android平台，性能差
+                packages.append(Package("x265", Builder.BuildX265, weight=4, sources=["src_package/x265*.tar.gz"]))
+            packages += [
+                Package("vpx", Builder.BuildVpx, weight=3, sources=["src_package/libvpx-*.zip"]),
+                Package(
+                    "ffmpeg",
+                    Builder.BuildFfmpeg,
+                    ["zlib", "iconv", "openssl", "sdl2", "opus", "x264", "x265", "vpx"],
+                    weight=10,
+                    sources=["src_package/ffmpeg*.tar.xz"],
+                ),
+            ]
+            if Pgo.IsEnabled():
+                packages = Pgo.Replace(packages)
+            elif Config.PGO:
+                Tools.Log("pgo: only supported by linux release builds, skipped")
+
+        if Config.BUILD_MACHINE_LEARNING:
+            packages += [
+                Package("openblas", Builder.BuildOpenBlas, weight=10, sources=["src_package/OpenBLAS*.tar.gz"]),
+                Package("superlu", Builder.BuildSuperlu, ["openblas"], sources=["src_package/superlu*.zip"]),
+                Package("eigen", Builder.BuildEigen, sources=["src_package/eigen*.tar.gz"]),
+                Package("hdf5", Builder.BuildHdf5, ["zlib"], weight=4, sources=["src_package/hdf5*.tar.gz"]),
+                Package(
+                    "armadillo",
+                    Builder.BuildArmadillo,
+                    ["openblas", "superlu", "hdf5"],
+                    sources=["src_package/armadillo-*.tar.xz"],
+                    memPerJob=1024,
+                ),
+                Package("ensmallen", Builder.BuildEnsmallen, ["armadillo"], sources=["src_package/ensmallen*.tar.gz"]),
+                Package("cereal", Builder.BuildCereal, sources=["src_package/cereal*.zip"]),
+                Package("stb", Builder.BuildStb, sources=["src_package/stb*.tar.gz"]),
+                Package(
+                    "mlpack",
+                    Builder.BuildMlpack,
+                    ["armadillo", "ensmallen", "cereal", "stb"],
+                    weight=15,
+                    sources=["src_package/mlpack*.tar.gz"],
+                    memPerJob=3072,  # 编译比较耗内存
+                ),
+                Package(
+                    "faiss",
+                    Builder.BuildFaiss,
+                    ["openblas"],
+                    weight=4,
+                    sources=["src_package/faiss*.zip"],
+                    memPerJob=1536,
+                ),
+            ]
+
+        packages.append(Package("pybind11", Builder.BuildPybind11, sources=["src_package/pybind11*.tar.gz"]))
+        if ArchVariants.IsEnabled():
+            packages += ArchVariants.Packages(packages)
+        elif Config.ARCH_LEVELS:
+            Tools.Log("arch variants: only supported by linux x86_64 builds without BUILD_NATIVE_ARCH, skipped")
+        return packages
+
+
+# ------------------------------------------------------------------------------------------------
+
+
+class Scheduler:
+    """
+    Build packages by dependency graph: packages whose deps are all installed are built concurrently,
+    each one in a forked child process, so os.chdir and Config changes don't interfere with each other.
+    """
+
+    def _SortPackages(packages: typing.List[Package]) -> typing.List[Package]:
+        """Drop deps not in this build, check cycles, and order packages by critical path length."""
+        pkgMap = {pkg.name: pkg for pkg in packages}
+        assert len(pkgMap) == len(packages), "duplicate package name"
+        for pkg in packages:
+            pkg.deps = [d for d in pkg.deps if d in pkgMap]
+
+        dependents: typing.Dict[str, typing.List[str]] = {name: [] for name in pkgMap}
+        for pkg in packages:
+            for d in pkg.deps:
+                dependents[d].append(pkg.name)
+
+        # 关键路径: 从该库到最终库的最长(耗时)依赖链, 越长越优先编译
+        pathLen: typing.Dict[str, int] = {}
+        visiting = set()
+
+        def PathLen(name: str) -> int:
+            if name in pathLen:
+                return pathLen[name]
+            if name in visiting:
+                raise RuntimeError(f"dependency cycle: {name}")
+            visiting.add(name)
+            pathLen[name] = pkgMap[name].weight + max([PathLen(d) for d in dependents[name]], default=0)
+            visiting.remove(name)
+            return pathLen[name]
+
+        order = {pkg.name: index for index, pkg in enumerate(packages)}
+        return sorted(packages, key=lambda pkg: (-PathLen(pkg.name), order[pkg.name]))
+
+    def DepsClosure(packages: typing.List[Package], name: str) -> typing.Set[str]:
+        pkgMap = {pkg.name: pkg for pkg in packages}
+        result = set()
+        stack = list(pkgMap[name].deps)
+        while stack:
+            d = stack.pop()
+            if d not in result and d in pkgMap:
+                result.add(d)
+                stack.extend(pkgMap[d].deps)
+        return result
+
+    def _BuildPackage(pkg: Package, depsClosure: typing.Set[str], key: str) -> None:
+        Sampler.Start()
+        try:
+            with Trace.Span(pkg.name, "package"):
+                Scheduler._BuildPackageImpl(pkg, depsClosure, key)
+        finally:
+            Sampler.Stop()
+
+    def _BuildPackageImpl(pkg: Package, depsClosure: typing.Set[str], key: str) -> None:
+        InstallTracker.Reset()
+        Stamp.Invalidate(pkg.name)
+        with Trace.Span("cache restore"):
+            files = ArtifactCache.Restore(pkg.name, key) if Config.ARTIFACT_CACHE else None
+        if files is not None:
+            Stamp.Write(pkg.name, key, files)
+            return
+        CompilerCache.BeginPackage(pkg.name)
+        SourceCache.BeginPackage(pkg)
+        # 每个库单独的编译目录, 同时解压的源码包不会互相干扰
+        buildTmp = Config.DIR_BUILD_TMP
+        buildDir = RamBuildDir.BuildDir(pkg.name)
+        while True:
+            Config.DIR_BUILD_TMP = buildDir
+            os.makedirs(Config.DIR_BUILD_TMP, exist_ok=True)
+            RamBuildDir.StartWatch(pkg.name, buildDir)
+            try:
+                if "boost" in depsClosure:
+                    Config.InitBoostCmakeArgs()
+                else:
+                    Config.CMAKE_BOOST_ARGS = []
+                pkg.fnBuild()
+                break
+            except Exception:
+                Config.DIR_BUILD_TMP = buildTmp
+                RamBuildDir.StopWatch()
+                # 内存盘空间不足导致的失败, 改在磁盘上重新编译一次
+                if not RamBuildDir.ShouldSpill(pkg.name):
+                    raise
+                Tools.Log(f"{pkg.name}: build failed in RAM! {traceback.format_exc()}")
+                buildDir = RamBuildDir.Spill(pkg.name, buildDir)
+            finally:
+                Config.DIR_BUILD_TMP = buildTmp
+                RamBuildDir.StopWatch()
+        if Config.ARTIFACT_CACHE:
+            with Trace.Span("cache store"):
+                ArtifactCache.Store(pkg.name, key, InstallTracker.Installed())
+        Stamp.Write(pkg.name, key, InstallTracker.Installed())
+        RamBuildDir.Finish(pkg.name, buildDir)
+
+    def _BuildInChild(pkg: Package, depsClosure: typing.Set[str], key: str, logFile: str) -> None:
+        if logFile:
+            fd = os.open(logFile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            os.dup2(fd, sys.stdout.fileno())
+            os.dup2(fd, sys.stderr.fileno())
+            os.close(fd)
+        Trace.SetProcessName(pkg.name)
+        try:
+            Scheduler._BuildPackage(pkg, depsClosure, key)
+        except BaseException:
+            Tools.Log(f"Build {pkg.name} failed! {traceback.format_exc()}")
+            sys.stdout.flush()
+            os._exit(1)
+        sys.stdout.flush()
+        os._exit(0)
+
+    def Run(packages: typing.List[Package], parallelPackages: int = None) -> None:
+        if parallelPackages is None:
+            parallelPackages = Config.PARALLEL_PACKAGES
+        packages = Scheduler._SortPackages(packages)
+        keys = ArtifactCache.Keys(packages)
+        # 已完成且输入没有变化的库不再编译
+        done: typing.Set[str] = {pkg.name for pkg in packages if Stamp.IsUpToDate(pkg.name, keys[pkg.name])}
+        skipped = set(done)
+        if done:
+            Tools.Log(f"Up to date, skip: {[pkg.name for pkg in packages if pkg.name in done]}")
+        if os.name == "nt":
+            # windows 不支持fork, 按顺序编译
+            for pkg in packages:
+                if pkg.name in done:
+                    continue
+                Tools.Log(f"Build {pkg.name}")
+                Scheduler._BuildPackage(pkg, Scheduler.DepsClosure(packages, pkg.name), keys[pkg.name])
+                os.chdir(Config.DIR_BASE)
+            CompilerCache.Summary([pkg.name for pkg in packages if pkg.name not in skipped])
+            return
+
+        logDir = os.path.join(Config.DIR_BUILD_TMP, "logs")
+        os.makedirs(logDir, exist_ok=True)
+        ctx = multiprocessing.get_context("fork")
+        pending = [pkg for pkg in packages if pkg.name not in done]
+        failed: typing.List[str] = []
+        running: typing.Dict[int, typing.Tuple[Package, multiprocessing.Process, datetime.datetime]] = {}
+        while pending or running:
+            waitToken = False
+            if not failed:
+                for pkg in list(pending):
+                    if len(running) >= parallelPackages:
+                        break
+                    if not all(d in done for d in pkg.deps):
+                        continue
+                    # 每个正在编译的库占用一个token, 作为其make的隐含任务槽
+                    if JobServer.IsActive() and not JobServer.TryAcquire():
+                        waitToken = True
+                        break
+                    pending.remove(pkg)
+                    RamBuildDir.Place(pkg)
+                    # 先按新库的内存需求调整任务数, 再启动
+                    MemoryGovernor.Update([p.memPerJob for p, _, _ in running.values()] + [pkg.memPerJob], True)
+                    logFile = os.path.join(logDir, f"{pkg.name}.log") if parallelPackages > 1 else None
+                    Tools.Log(f"Build {pkg.name} start" + (f", log: {logFile}" if logFile else ""))
+                    proc = ctx.Process(
+                        target=Scheduler._BuildInChild,
+                        args=(pkg, Scheduler.DepsClosure(packages, pkg.name), keys[pkg.name], logFile),
+                        name=pkg.name,
+                    )
+                    proc.start()
+                    JobServer.AddPackages(1)
+                    running[proc.sentinel] = (pkg, proc, datetime.datetime.now())
+            if not running and not waitToken:
+                break
+
+            waitList = list(running.keys())
+            if MemoryGovernor.Update([p.memPerJob for p, _, _ in running.values()]):
+                waitToken = True
+            if waitToken:
+                waitList.append(JobServer.PollFd())
+            timeout = MemoryGovernor.UPDATE_INTERVAL if MemoryGovernor.IsActive() else None
+            for sentinel in multiprocessing.connection.wait(waitList, timeout):
+                if sentinel not in running:
+                    continue
+                pkg, proc, startTime = running.pop(sentinel)
+                proc.join()
+                JobServer.AddPackages(-1)
+                RamBuildDir.Release(pkg.name)
+                if JobServer.IsActive():
+                    JobServer.Release()
+                elapsed = datetime.datetime.now() - startTime
+                if proc.exitcode == 0:
+                    done.add(pkg.name)
+                    stats = CompilerCache.PackageStats(pkg.name)
+                    stats = f", {CompilerCache.FormatStats(stats)}" if stats else ""
+                    Tools.Log(f"Build {pkg.name} done, elapsed: {elapsed}{stats}")
+                else:
+                    failed.append(pkg.name)
+                    Tools.Log(f"Build {pkg.name} failed with {proc.exitcode}, elapsed: {elapsed}")
+                    logFile = os.path.join(logDir, f"{pkg.name}.log")
+                    if parallelPackages > 1 and os.path.exists(logFile):
+                        with open(logFile, encoding=OS_ENCODING, errors="replace") as fr:
+                            Tools.Log("".join(fr.readlines()[-50:]))
+
+        MemoryGovernor.ReleaseAll()
+        CompilerCache.Summary([pkg.name for pkg in packages if pkg.name not in skipped])
+        if failed:
+            raise RuntimeError(f"Build failed: {failed}, not built: {[pkg.name for pkg in pending]}")
+
+
+# ------------------------------------------------------------------------------------------------
+
+
+class Elf:
+    """Minimal ELF reader: section headers, the GNU build-id and the dynamic section, without readelf."""
+
+    SHT_DYNAMIC = 6
+    SHT_NOTE = 7
+    NT_GNU_BUILD_ID = 3
+    DT_NEEDED = 1
+    DT_SONAME = 14
+    DT_RPATH = 15
+    DT_RUNPATH = 29
+    ET_EXEC = 2
+    ET_DYN = 3
+
+    @dataclasses.dataclass()
+    class Info:
+        type: int
+        sections: typing.Dict[str, typing.Tuple[int, int, int]]  # name -> (type, offset, size)
+        buildId: typing.Optional[str]
+        dynamic: bool = False  # 是否动态链接
+        soname: typing.Optional[str] = None
+        needed: typing.List[str] = dataclasses.field(default_factory=list)
+        runpath: typing.Optional[str] = None  # DT_RUNPATH, 没有时为 DT_RPATH
+
+    def IsElf(path: str) -> bool:
+        try:
+            with open(path, "rb") as fr:
+                return fr.read(4) == b"\x7fELF"
+        except OSError:
+            return False
+
+    def Read(path: str) -> typing.Optional["Elf.Info"]:
+        with open(path, "rb") as fr:
+            ident = fr.read(16)
+            if len(ident) < 16 or ident[:4] != b"\x7fELF":
+                return None
+            is64 = ident[4] == 2
+            endian = "<" if ident[5] == 1 else ">"
+            headerFormat = endian + ("HHIQQQIHHHHHH" if is64 else "HHIIIIIHHHHHH")
+            header = struct.unpack(headerFormat, fr.read(struct.calcsize(headerFormat)))
+            eType, shOff, shEntSize, shNum, shStrIndex = header[0], header[5], header[10], header[11], header[12]
+            # name, type, flags, addr, offset, size, link, info, addralign, entsize
+            sectionFormat = endian + ("IIQQQQIIQQ" if is64 else "IIIIIIIIII")
+            headers = []
+            if shOff:
+                fr.seek(shOff)
+                first = struct.unpack(sectionFormat, fr.read(struct.calcsize(sectionFormat)))
+                # 节数目或字符串表索引过大时, 保存在第0节中
+                shNum = shNum or first[5]
+                shStrIndex = first[6] if shStrIndex == 0xFFFF else shStrIndex
+                fr.seek(shOff)
+                raw = fr.read(shEntSize * shNum)
+                headers = [struct.unpack_from(sectionFormat, raw, i * shEntSize) for i in range(shNum)]
+            info = Elf.Info(eType, {}, None)
+            if headers:
+                fr.seek(headers[shStrIndex][4])
+                names = fr.read(headers[shStrIndex][5])
+                for item in headers:
+                    name = names[item[0] : names.find(b"\0", item[0])].decode(errors="replace")
+                    info.sections[name] = (item[1], item[4], item[5])
+                    if item[1] == Elf.SHT_NOTE and info.buildId is None:
+                        fr.seek(item[4])
+                        info.buildId = Elf._BuildId(fr.read(item[5]), endian)
+                    elif item[1] == Elf.SHT_DYNAMIC:
+                        fr.seek(item[4])
+                        dynamic = fr.read(item[5])
+                        fr.seek(headers[item[6]][4])
+                        Elf._ReadDynamic(info, dynamic, fr.read(headers[item[6]][5]), endian + ("qQ" if is64 else "iI"))
+            return info
+
+    def _ReadDynamic(info: "Elf.Info", dynamic: bytes, strings: bytes, entryFormat: str) -> None:
+        info.dynamic = True
+        rpath = None
+        for tag, value in struct.iter_unpack(
+            entryFormat, dynamic[: len(dynamic) // struct.calcsize(entryFormat) * struct.calcsize(entryFormat)]
+        ):
+            if tag == 0:
+                break
+            if tag in [Elf.DT_NEEDED, Elf.DT_SONAME, Elf.DT_RPATH, Elf.DT_RUNPATH]:
+                text = strings[value : strings.find(b"\0", value)].decode(errors="replace")
+                if tag == Elf.DT_NEEDED:
+                    info.needed.append(text)
+                elif tag == Elf.DT_SONAME:
+                    info.soname = text
+                elif tag == Elf.DT_RPATH:
+                    rpath = text
+                else:
+                    info.runpath = text
+        if info.runpath is None:
+            info.runpath = rpath
+
+    def _BuildId(notes: bytes, endian: str) -> typing.Optional[str]:
+        pos = 0
+        while pos + 12 <= len(notes):
+            nameSize, descSize, noteType = struct.unpack_from(endian + "III", notes, pos)
+            pos += 12
+            name = notes[pos : pos + nameSize]
+            pos += (nameSize + 3) & ~3
+            desc = notes[pos : pos + descSize]
+            pos += (descSize + 3) & ~3
+            if noteType == Elf.NT_GNU_BUILD_ID and name == b"GNU\0":
+                return desc.hex()
+        return None
+
+
+class SharedLibs:
+    """
+    Post-install pass over the ELF files of the install root:
+    - Every library in lib gets the chain libX.so -> SONAME -> real file. ffmpeg for example installs
+      libavcodec.so -> libavcodec.so.58.91.100 while libavformat.so needs libavcodec.so.58, so copying the
+      libraries by their .so names to a deployment fails at run time.
+    - RUNPATH of the libraries in lib and the executables in bin is set to Config.INSTALL_RPATH (linux),
+      only on the files having another value, in parallel.
+    - NEEDED entries found neither in the root nor in the system are reported.
+    """
+
+    def _NaturalKey(name: str) -> list:
+        return [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", name)]
+
+    def _Scan(dirPath: str) -> typing.Dict[str, "Elf.Info"]:
+        """Real (not symlink) ELF files of dirPath."""
+        result = {}
+        if not os.path.isdir(dirPath):
+            return result
+        for name in sorted(os.listdir(dirPath), key=SharedLibs._NaturalKey):
+            path = os.path.join(dirPath, name)
+            if os.path.islink(path) or not os.path.isfile(path) or not Elf.IsElf(path):
+                continue
+            info = Elf.Read(path)
+            if info is not None:
+                result[name] = info
+        return result
+
+    def _Link(libDir: str, link: str, target: str) -> bool:
+        path = os.path.join(libDir, link)
+        if os.path.lexists(path):
+            if not os.path.islink(path) or os.readlink(path) == target:
+                return False
+            os.remove(path)
+        os.symlink(target, path)
+        return True
+
+    def FixLinks(libDir: str, libs: typing.Dict[str, "Elf.Info"]) -> int:
+        count = 0
+        # 按版本排序, 同一SONAME有多个文件时使用最新的
+        for name, info in libs.items():
+            if info.type != Elf.ET_DYN or not info.soname or ".so" not in info.soname:
+                continue
+            if info.soname != name:
+                count += SharedLibs._Link(libDir, info.soname, name)
+            devName = info.soname[: info.soname.index(".so") + 3]
+            if devName != info.soname:
+                count += SharedLibs._Link(libDir, devName, info.soname)
+        return count
+
+    def FixRunpath(files: typing.Dict[str, "Elf.Info"], runpath: str) -> int:
+        wrong = [path for path, info in files.items() if info.dynamic and info.runpath != runpath]
+
+        def Patch(path: str):
+            mode = stat.S_IMODE(os.stat(path).st_mode)
+            os.chmod(path, mode | stat.S_IWUSR)
+            subprocess.run(["patchelf", "--set-rpath", runpath, path], check=True, capture_output=True)
+            os.chmod(path, mode)
+
+        if wrong:
+            with JobServer.Reserve(Config.PARALLEL_JOBS) as jobs:
+                with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+                    list(executor.map(Patch, wrong))
+        return len(wrong)
+
+    def SystemLibs() -> typing.Callable[[str], bool]:
+        """Returns a function telling whether a NEEDED name is provided by the system."""
+        if Config.TARGET_OS == TargetOs.android:
+            sysroot = f"{Config.ANDROID_NDK.ANDROID_NDK_HOME}/toolchains/llvm/prebuilt/linux-x86_64/sysroot"
+            return lambda name: bool(glob.glob(f"{sysroot}/usr/lib/aarch64-linux-android/**/{name}", recursive=True))
+        names = set()
+        try:
+            output = subprocess.run(["ldconfig", "-p"], capture_output=True, encoding=OS_ENCODING).stdout
+            names = {line.split()[0] for line in output.splitlines()[1:] if line.strip()}
+        except OSError:
+            pass
+        return lambda name: name in names or os.path.exists(f"/lib64/{name}") or os.path.exists(f"/lib/{name}")
+
+    def CheckNeeded(root: str, files: typing.Dict[str, "Elf.Info"]) -> typing.List[str]:
+        isSystemLib = SharedLibs.SystemLibs()
+        libDir = os.path.join(root, "lib")
+        missing = {}
+        for path, info in files.items():
+            for needed in info.needed:
+                if not os.path.exists(os.path.join(libDir, needed)) and not isSystemLib(needed):
+                    missing.setdefault(needed, []).append(os.path.relpath(path, root))
+        for needed, users in sorted(missing.items()):
+            Tools.Log(f"warning: {needed} not found in {libDir} or the system, needed by {', '.join(users)}")
+        return sorted(missing)
+
+    def Run(root: str) -> None:
+        libDir = os.path.join(root, "lib")
+        libs = SharedLibs._Scan(libDir)
+        linkCount = SharedLibs.FixLinks(libDir, libs)
+        files = {os.path.join(libDir, name): info for name, info in libs.items()}
+        files.update({os.path.join(root, "bin", name): info for name, info in SharedLibs._Scan(f"{root}/bin").items()})
+        patchCount = 0
+        if Config.TARGET_OS == TargetOs.linux:
+            patchCount = SharedLibs.FixRunpath(files, Config.INSTALL_RPATH.strip("'"))
+        # glibc-hwcaps 中的库也要检查依赖
+        for hwcapsDir in glob.glob(os.path.join(root, ArchVariants.HWCAPS_DIR, "*/")):
+            files.update({os.path.join(hwcapsDir, name): info for name, info in SharedLibs._Scan(hwcapsDir).items()})
+        missing = SharedLibs.CheckNeeded(root, files)
+        Tools.Log(
+            f"shared libs: {len(files)} elf files, {linkCount} links fixed, {patchCount} runpath patched, "
+            f"{len(missing)} needed not found"
+        )
+
+
+class RuntimeClosure:
+    """
+    Minimal runtime copy of an install root: the entry libraries or executables and everything they need by
+    DT_NEEDED inside the root, with their SONAME links, glibc-hwcaps variants and RUNPATH relative to $ORIGIN.
+    Headers, archives, cmake and pkgconfig files and libraries nobody needs are left out.
+    Libraries loaded by dlopen (e.g. openssl engines) are not found this way and have to be listed as entries.
+    """
+
+    def _Resolve(root: str, entry: str) -> str:
+        """entry: path relative to root, file name in bin or lib, or library name like "ssl", "libavformat"."""
+        name = entry if entry.startswith("lib") else f"lib{entry}"
+        for candidate in [
+            os.path.join(root, entry),
+            os.path.join(root, "bin", entry),
+            os.path.join(root, "lib", entry),
+            os.path.join(root, "lib", f"{name}.so"),
+        ]:
+            if os.path.isfile(candidate):
+                return candidate
+        raise FileNotFoundError(f"{entry} not found in {root}")
+
+    def Collect(
+        root: str, entries: typing.List[str]
+    ) -> typing.Tuple[
+        typing.Dict[str, str], typing.Dict[str, str], typing.Set[str], typing.Dict[str, typing.List[str]]
+    ]:
+        """
+        Returns (files: relative path -> real file in root, links: relative path -> link target,
+        needed system libraries, needed libraries not found -> relative paths of the users).
+        """
+        libDir = os.path.join(root, "lib")
+        isSystemLib = SharedLibs.SystemLibs()
+        files, links, system, missing = {}, {}, set(), {}
+        queue = [RuntimeClosure._Resolve(root, entry) for entry in entries]
+        seen = set()
+        while queue:
+            real = os.path.realpath(queue.pop())
+            if real in seen:
+                continue
+            seen.add(real)
+            info = Elf.Read(real)
+            if info is None:
+                raise RuntimeError(f"{real} is not an elf file")
+            if info.soname is None and os.path.commonpath([root, real]) == root:
+                relPath = os.path.relpath(real, root)  # 可执行文件保持原位置
+            else:
+                relPath = f"lib/{os.path.basename(real)}"
+            files[relPath] = real
+            if info.soname:
+                if info.soname != os.path.basename(real):
+                    links[f"lib/{info.soname}"] = os.path.basename(real)
+                for hwcapsDir in glob.glob(os.path.join(root, ArchVariants.HWCAPS_DIR, "*", "")):
+                    variant = os.path.join(hwcapsDir, info.soname)
+                    if os.path.exists(variant):
+                        relDir = os.path.relpath(hwcapsDir, root)
+                        files[f"{relDir}/{os.path.basename(os.path.realpath(variant))}"] = os.path.realpath(variant)
+                        if os.path.islink(variant):
+                            links[f"{relDir}/{info.soname}"] = os.path.basename(os.path.realpath(variant))
+            for needed in info.needed:
+                if os.path.exists(os.path.join(libDir, needed)):
+                    queue.append(os.path.join(libDir, needed))
+                elif isSystemLib(needed):
+                    system.add(needed)
+                else:
+                    missing.setdefault(needed, []).append(relPath)
+        return files, links, system, missing
+
+    def Run(root: str, entries: typing.List[str], dest: str) -> None:
+        files, links, system, missing = RuntimeClosure.Collect(root, entries)
+        Tools.RemoveFileOrDirs(dest)
+        for relPath, real in files.items():
+            os.makedirs(os.path.dirname(os.path.join(dest, relPath)), exist_ok=True)
+            shutil.copy2(real, os.path.join(dest, relPath))
+        for relPath, target in links.items():
+            os.symlink(target, os.path.join(dest, relPath))
+        # 每个文件按其所在目录设置指向 lib 的相对 RUNPATH, 如 bin, libexec/x, lib/glibc-hwcaps/x86-64-v3
+        byDir: typing.Dict[str, typing.Dict[str, "Elf.Info"]] = {}
+        for relPath in files:
+            path = os.path.join(dest, relPath)
+            byDir.setdefault(os.path.dirname(relPath), {})[path] = Elf.Read(path)
+        for relDir, infos in byDir.items():
+            toLib = os.path.relpath("lib", relDir)
+            SharedLibs.FixRunpath(infos, "$ORIGIN" if toLib == "." else f"$ORIGIN/{toLib}")
+        for needed, users in sorted(missing.items()):
+            Tools.Log(f"warning: {needed} not found in {root} or the system, needed by {', '.join(users)}")
+
+        def Size(top: str) -> int:
+            total = 0
+            for dirPath, _, fileNames in os.walk(top):
+                total += sum(os.lstat(os.path.join(dirPath, name)).st_size for name in fileNames)
+            return total
+
+        Tools.Log(
+            f"closure: {dest}, {len(files)} files, {Size(dest) / (1 << 20):.1f} MB of {Size(root) / (1 << 20):.1f} MB, "
+            f"system libraries: {' '.join(sorted(system))}"
+        )
+
+
+class DebugInfo:
+    """
+    Post-install stage: the debug info and symbol tables of every ELF file in the install root are split into
+    lib/debug/.build-id/xx/yyyy.debug (the gdb/perf layout, by <relative path>.debug without a build-id),
+    then the installed file is stripped and linked to it by .gnu_debuglink. Files run in parallel.
+    """
+
+    STORE_DIR = "lib/debug"
+
+    def _Objcopy() -> str:
+        # android 使用ndk中的llvm工具
+        return "llvm-objcopy" if Config.TARGET_OS == TargetOs.android else "objcopy"
+
+    def _Files(root: str) -> typing.List[str]:
+        result = []
+        inodes = set()
+        for dirPath, dirNames, fileNames in os.walk(root):
+            relDir = os.path.relpath(dirPath, root)
+            dirNames[:] = [
+                name
+                for name in dirNames
+                if os.path.normpath(os.path.join(relDir, name)) not in [InstallTracker.STATE_DIR, DebugInfo.STORE_DIR]
+                and not os.path.islink(os.path.join(dirPath, name))
+            ]
+            for name in fileNames:
+                path = os.path.join(dirPath, name)
+                if os.path.islink(path) or not Elf.IsElf(path):
+                    continue
+                st = os.stat(path)
+                # 硬链接只处理一次
+                if (st.st_dev, st.st_ino) not in inodes:
+                    inodes.add((st.st_dev, st.st_ino))
+                    result.append(path)
+        return result
+
+    def _Split(root: str, path: str, env: typing.Dict[str, str]) -> typing.Tuple[int, int]:
+        """Returns the size before and after, (0, 0) if nothing to split."""
+        info = Elf.Read(path)
+        if info is None or info.type not in [Elf.ET_EXEC, Elf.ET_DYN]:
+            return (0, 0)
+        if ".gnu_debuglink" in info.sections or not any(
+            name == ".symtab" or name.startswith(".debug_") for name in info.sections
+        ):
+            # 已经处理过, 或没有可分离的内容
+            return (0, 0)
+        if info.buildId:
+            debugFile = os.path.join(
+                root, DebugInfo.STORE_DIR, ".build-id", info.buildId[:2], f"{info.buildId[2:]}.debug"
+            )
+        else:
+            debugFile = os.path.join(root, DebugInfo.STORE_DIR, f"{os.path.relpath(path, root)}.debug")
+        os.makedirs(os.path.dirname(debugFile), exist_ok=True)
+        sizeBefore = os.path.getsize(path)
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+        # 安装的文件可能是只读的
+        os.chmod(path, mode | stat.S_IWUSR)
+        objcopy = DebugInfo._Objcopy()
+        subprocess.run(
+            [objcopy, "--only-keep-debug", "--compress-debug-sections", path, debugFile],
+            env=env,
             check=True,
+            capture_output=True,
+        )
+        subprocess.run(
+            [objcopy, "--strip-unneeded", f"--add-gnu-debuglink={debugFile}", path],
+            env=env,
+            check=True,
+            capture_output=True,
+        )
+        os.chmod(path, mode)
+        return (sizeBefore, os.path.getsize(path))
+
+    def Run(root: str) -> None:
+        if Config.TARGET_OS == TargetOs.windows:
+            return
+        env = Config.EnvDict()
+        files = DebugInfo._Files(root)
+        with JobServer.Reserve(Config.PARALLEL_JOBS) as jobs:
+            with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+                sizes = list(executor.map(lambda path: DebugInfo._Split(root, path, env), files))
+        before = sum(item[0] for item in sizes)
+        after = sum(item[1] for item in sizes)
+        count = sum(1 for item in sizes if item[0])
+        Tools.Log(
+            f"split debug: {count} of {len(files)} elf files, {before / (1 << 20):.1f} MB -> {after / (1 << 20):.1f} MB, "
+            f"symbols in {os.path.join(root, DebugInfo.STORE_DIR)}"
+        )
+
+
+# ------------------------------------------------------------------------------------------------
+
+
+class Bundle:
+    """
+    Ships an install root as a tar stream compressed by the zstd cli on all cores, with a manifest of the
+    content hashes as the first member. A delta bundle against an older manifest only carries the changed files
+    and the list of removed ones, and is unpacked over the root it was made from.
+    """
+
+    MANIFEST = ".bundle/manifest.json"  # 包中以及解压后的清单
+    EXCLUDE = [InstallTracker.STATE_DIR, ".bundle", ".trash-*"]
+    WITH_DEBUG = False  # 是否包含 DebugInfo.STORE_DIR 中分离的调试信息
+    LEVEL = 9
+
+    def _Zstd(root: str) -> typing.Tuple[typing.List[str], typing.Dict[str, str]]:
+        if shutil.which("zstd"):
+            return ["zstd"], dict(os.environ)
+        # 没有安装时使用自己编译的
+        local = os.path.join(root, "bin", "zstd")
+        if os.path.exists(local):
+            return [local], {**os.environ, "LD_LIBRARY_PATH": os.path.join(root, "lib")}
+        raise RuntimeError("zstd not found!")
+
+    def _Hash(path: str) -> str:
+        sha = hashlib.sha256()
+        with open(path, "rb") as fr:
+            for block in iter(lambda: fr.read(1 << 20), b""):
+                sha.update(block)
+        return sha.hexdigest()
+
+    def Scan(root: str) -> typing.Dict[str, dict]:
+        """relative path -> {"sha256", "size"} of files or {"link"} of symlinks."""
+        files: typing.Dict[str, dict] = {}
+        toHash = []
+        for dirPath, dirNames, fileNames in os.walk(root):
+            relDir = os.path.relpath(dirPath, root)
+            for name in list(dirNames):
+                relPath = os.path.normpath(os.path.join(relDir, name))
+                if any(fnmatch.fnmatch(relPath, patten) for patten in Bundle.EXCLUDE) or (
+                    relPath == os.path.normpath(DebugInfo.STORE_DIR) and not Bundle.WITH_DEBUG
+                ):
+                    dirNames.remove(name)
+                elif os.path.islink(os.path.join(dirPath, name)):
+                    # 指向目录的链接, 如 lib64
+                    files[relPath] = {"link": os.readlink(os.path.join(dirPath, name))}
+            for name in fileNames:
+                relPath = os.path.normpath(os.path.join(relDir, name))
+                path = os.path.join(dirPath, name)
+                if any(fnmatch.fnmatch(relPath, patten) for patten in Bundle.EXCLUDE):
+                    continue
+                if os.path.islink(path):
+                    files[relPath] = {"link": os.readlink(path)}
+                else:
+                    files[relPath] = {"size": os.lstat(path).st_size}
+                    toHash.append(relPath)
+        # hashlib 计算时释放GIL
+        with concurrent.futures.ThreadPoolExecutor(Config.PARALLEL_JOBS) as executor:
+            for relPath, sha in zip(toHash, executor.map(lambda rel: Bundle._Hash(os.path.join(root, rel)), toHash)):
+                files[relPath]["sha256"] = sha
+        return dict(sorted(files.items()))
+
+    def ManifestId(files: typing.Dict[str, dict]) -> str:
+        return hashlib.sha256(json.dumps(files, sort_keys=True).encode()).hexdigest()
+
+    def LoadManifest(path: str) -> dict:
+        """path: a manifest, a bundle with its <bundle>.json beside, or an unpacked root."""
+        if os.path.isdir(path):
+            path = os.path.join(path, Bundle.MANIFEST)
+        elif not path.endswith(".json"):
+            path += ".json"
+        with open(path, encoding="utf-8") as fr:
+            return json.load(fr)
+
+    def Package(root: str, bundleFile: str, base: str = None) -> None:
+        with Trace.Span("package", root=root):
+            files = Bundle.Scan(root)
+            manifest = {"root": os.path.basename(root), "id": Bundle.ManifestId(files), "base": None}
+            changed = list(files)
+            removed = []
+            if base:
+                baseManifest = Bundle.LoadManifest(base)
+                manifest["base"] = baseManifest["id"]
+                changed = [rel for rel, entry in files.items() if baseManifest["files"].get(rel) != entry]
+                removed = [rel for rel in baseManifest["files"] if rel not in files]
+            manifest.update({"changed": changed, "removed": removed, "files": files})
+            manifestData = json.dumps(manifest, indent=1).encode()
+
+            zstdCmd, env = Bundle._Zstd(root)
+            tmpFile = f"{bundleFile}.{os.getpid()}.tmp"
+            with open(tmpFile, "wb") as fw:
+                proc = subprocess.Popen(
+                    zstdCmd + ["-q", "-c", "-T0", f"-{Bundle.LEVEL}"], stdin=subprocess.PIPE, stdout=fw, env=env
+                )
+                try:
+                    with tarfile.open(fileobj=proc.stdin, mode="w|", format=tarfile.PAX_FORMAT) as tar:
+                        info = tarfile.TarInfo(Bundle.MANIFEST)
+                        info.size = len(manifestData)
+                        info.mtime = int(time.time())
+                        tar.addfile(info, io.BytesIO(manifestData))
+                        for relPath in changed:
+                            tar.add(os.path.join(root, relPath), arcname=relPath, recursive=False)
+                finally:
+                    proc.stdin.close()
+                    returncode = proc.wait()
+            if returncode != 0:
+                os.remove(tmpFile)
+                raise RuntimeError(f"zstd failed with {returncode}")
+            os.replace(tmpFile, bundleFile)
+            with open(bundleFile + ".json", "w", encoding="utf-8") as fw:
+                fw.write(manifestData.decode())
+        size = sum(files[rel].get("size", 0) for rel in changed)
+        Tools.Log(
+            f"package: {bundleFile}, {len(changed)} files ({size >> 20} MB -> {os.path.getsize(bundleFile) >> 20} MB), "
+            f"{len(removed)} removed{', delta of ' + manifest['base'][:12] if base else ''}"
+        )
+
+    def Unpack(bundleFile: str, dest: str = None) -> None:
+        """dest: None means <DIR_BASE>/<root name in the bundle>."""
+        if not os.path.isfile(bundleFile):
+            raise FileNotFoundError(bundleFile)
+        zstdCmd, env = Bundle._Zstd(dest or Config.DIR_BASE)
+        proc = subprocess.Popen(zstdCmd + ["-q", "-d", "-c", bundleFile], stdout=subprocess.PIPE, env=env)
+        manifest = None
+        try:
+            with tarfile.open(fileobj=proc.stdout, mode="r|") as tar:
+                for member in tar:
+                    if manifest is None:
+                        assert member.name == Bundle.MANIFEST, f"{bundleFile} is not a bundle"
+                        manifest = json.load(tar.extractfile(member))
+                        dest = dest or os.path.join(Config.DIR_BASE, manifest["root"])
+                        if manifest["base"]:
+                            current = os.path.join(dest, Bundle.MANIFEST)
+                            currentId = Bundle.LoadManifest(current)["id"] if os.path.exists(current) else None
+                            if currentId != manifest["base"]:
+                                raise RuntimeError(
+                                    f"{bundleFile} is a delta of {manifest['base']}, {dest} is {currentId}"
+                                )
+                        os.makedirs(dest, exist_ok=True)
+                        continue
+                    tar.extract(member, dest, **ArtifactCache._TarFilter())
+        finally:
+            proc.stdout.close()
+            returncode = proc.wait()
+        if returncode != 0:
+            raise RuntimeError(f"zstd failed with {returncode}")
+        for relPath in manifest["removed"]:
+            path = os.path.join(dest, relPath)
+            if os.path.islink(path) or os.path.isfile(path):
+                os.remove(path)
+        # 解压后的清单, 用于检查之后的增量包
+        os.makedirs(os.path.dirname(os.path.join(dest, Bundle.MANIFEST)), exist_ok=True)
+        with open(os.path.join(dest, Bundle.MANIFEST), "w", encoding="utf-8") as fw:
+            json.dump(manifest, fw, indent=1)
+        Tools.Log(
+            f"unpack: {bundleFile} -> {dest}, {len(manifest['changed'])} files, {len(manifest['removed'])} removed"
         )
+
+
+def BuildTarget(noClean: bool) -> None:
+    """Build all packages of the current config into Config.DIR_INSTALL_ROOT."""
+    Config.InitConfig()
+    RamBuildDir.Init()
+    if not noClean:
+        # 改名后在后台删除, 不阻塞编译
+        Tools.RemoveFileOrDirs(Config.DIR_BUILD_TMP, background=True)
+        Tools.RemoveFileOrDirs(Config.DIR_INSTALL_ROOT, background=True)
+        if RamBuildDir.IsActive():
+            Tools.RemoveFileOrDirs(RamBuildDir.Root(), background=True)
+        Config.InitInstallRoot()
+    os.makedirs(Config.DIR_BUILD_TMP, exist_ok=True)
+    if Config.TRACE:
+        Trace.Start(os.path.join(Config.DIR_BUILD_TMP, "trace"))
+
+    try:
+        Scheduler.Run(Builder.Packages())
+
+        if Config.TARGET_OS != TargetOs.windows:
+            # ----修正软链接, 设置runpath，避免开发或部署时找不到依赖库 -------
+            with Trace.Span("patchelf"):
+                SharedLibs.Run(Config.DIR_INSTALL_ROOT)
+        if Config.SPLIT_DEBUG:
+            with Trace.Span("split-debug"):
+                DebugInfo.Run(Config.DIR_INSTALL_ROOT)
+        if Config.BENCHMARK:
+            with Trace.Span("benchmark"):
+                Benchmark.Run()
+    finally:
+        Trace.Finish(os.path.join(Config.DIR_BUILD_TMP, "trace.json"))
+
+
+def _BuildMatrixTarget(target: str, noClean: bool) -> None:
+    targetOs, buildType = target.split("-")
+    Config.PROFILE = {**Config.PROFILE, "target_os": targetOs, "build_type": buildType}
+    Config.INTERACTIVE = False  # 多个目标同时编译, 不能提示输入
+    Config.MATRIX_TARGET = target
+    Config.DIR_BUILD_TMP = os.path.join(Config.DIR_BUILD_TMP, target)
+    # 内存由父进程统一调节
+    Config.MEMORY_GOVERNOR = False
+    try:
+        BuildTarget(noClean)
+    except BaseException:
+        Tools.Log(f"Build {target} failed! {traceback.format_exc()}")
+        sys.stdout.flush()
+        os._exit(1)
+    sys.stdout.flush()
+    os._exit(0)
+
+
+def BuildMatrix(targets: typing.List[str], noClean: bool) -> None:
+    """
+    Build targets ("linux-release", "android-debug", ...) concurrently, each in a forked process with its own
+    build_tmp/<target> and 3rd_root_{os}_{type}. They share the jobserver and the source cache.
+    """
+    for target in targets:
+        targetOs, _, buildType = target.partition("-")
+        if targetOs not in ["linux", "android"] or buildType not in ["release", "debug"]:
+            raise ValueError(f"unknown target {target}, expected {{linux,android}}-{{release,debug}}")
+    if os.name == "nt":
+        raise RuntimeError("matrix build is not supported on windows")
+    os.makedirs(Config.DIR_BUILD_TMP, exist_ok=True)
+    if Config.RAM_BUILD_DIR:
+        # 各目标平分内存中编译目录的预算
+        budget = Config.RAM_BUILD_BUDGET_MB or (MemoryGovernor.Available() // 2) >> 20
+        Config.RAM_BUILD_BUDGET_MB = max(1, budget // len(targets))
+    ctx = multiprocessing.get_context("fork")
+    running: typing.Dict[int, typing.Tuple[str, multiprocessing.Process]] = {}
+    for target in targets:
+        proc = ctx.Process(target=_BuildMatrixTarget, args=(target, noClean), name=target)
+        proc.start()
+        Tools.Log(f"Build {target} start, pid: {proc.pid}")
+        running[proc.sentinel] = (target, proc)
+    failed = []
+    while running:
+        MemoryGovernor.Update([])
+        timeout = MemoryGovernor.UPDATE_INTERVAL if MemoryGovernor.IsActive() else None
+        for sentinel in multiprocessing.connection.wait(list(running.keys()), timeout):
+            target, proc = running.pop(sentinel)
+            proc.join()
+            Tools.Log(f"Build {target} {'done' if proc.exitcode == 0 else f'failed with {proc.exitcode}'}")
+            if proc.exitcode != 0:
+                failed.append(target)
+    MemoryGovernor.ReleaseAll()
+    if failed:
+        raise RuntimeError(f"Build failed: {failed}")
+
+
+def Main():
+    # 先读取 profile, 其中的值作为命令行参数的默认值
+    preParser = argparse.ArgumentParser(add_help=False)
+    preParser.add_argument("--profile")
+    profile = preParser.parse_known_args(sys.argv[1:])[0].profile
+    if profile:
+        Config.LoadProfile(profile)
+
+    parser = argparse.ArgumentParser("Build ThirdParty")
+    parser.add_argument(
+        "command",
+        nargs="?",
+        choices=["build", "package", "unpack", "closure"],
+        default="build",
+        help="package: pack an install root into a zstd bundle; unpack: unpack a bundle into a root; "
+        "closure: copy the runtime dependencies of --entries, and package them if a bundle is given",
+    )
+    parser.add_argument("bundle", nargs="?", help="bundle file of package and unpack")
+    parser.add_argument("--root", help="install root to package, default 3rd_root_<target_os>")
+    parser.add_argument("--base", help="package a delta against this bundle, manifest or unpacked root")
+    parser.add_argument("--dest", help="dir to unpack into (default the root name in the bundle), or of the closure")
+    parser.add_argument(
+        "--entries",
+        default="",
+        help="comma separated libraries or executables of closure, e.g. avformat,ssl,bin/ffmpeg",
+    )
+    parser.add_argument("--with_debug", action="store_true", help="package the split debug info too")
+    parser.add_argument(
+        "--split_debug",
+        action="store_true",
+        default=Config.SPLIT_DEBUG,
+        help=f"split debug info into {DebugInfo.STORE_DIR}/.build-id and strip the installed elf files",
+    )
+    parser.add_argument(
+        "--configure_cache",
+        action="store_true",
+        default=Config.CONFIGURE_CACHE,
+        help="reuse configure check results of builds with the same toolchain: identical cmake checks are shared "
+        "between packages (CMAKE_PROJECT_INCLUDE), autoconf keeps a cache file per package (CONFIG_SITE), "
+        "which only speeds up reruns of libiconv, the other configure scripts are hand written and ignore it",
+    )
+    parser.add_argument("--profile", help="json file of Config values and prompt answers")
+    parser.add_argument("--non_interactive", action="store_true", help="don't prompt, use profile or default values")
+    parser.add_argument("--build_type", choices=[item.name for item in BuildType], help="answer of the prompt")
+    parser.add_argument("--target_os", choices=["linux", "android"], help="answer of the prompt")
+    parser.add_argument("--compiler", choices=["gcc", "clang"], help="answer of the prompt, linux only")
+    parser.add_argument("--ndk_dir", help="answer of the prompt, android ndk root dir")
+    parser.add_argument("--api_level", type=int, help="answer of the prompt, android api level")
+    parser.add_argument(
+        "--matrix",
+        default=",".join(Config.MATRIX),
+        help="comma separated targets built concurrently, e.g. linux-release,linux-debug,android-release",
+    )
+    parser.add_argument("--debug_env", action="store_true", help="debug env")
+    parser.add_argument(
+        "--no_clean",
+        action="store_true",
+        help="don't clean old build cache, packages whose stamp is up to date are skipped",
+    )
+    parser.add_argument("--no_artifact_cache", action="store_true", help="don't use cached package installs")
+    parser.add_argument(
+        "--source_cache",
+        choices=SourceCache.MODES,
+        default=Config.SOURCE_CACHE,
+        help="how to check out the cached extracted sources",
+    )
+    parser.add_argument(
+        "--compiler_cache",
+        choices=CompilerCache.MODES,
+        default=Config.COMPILER_CACHE,
+        help="compiler launcher used as a local compile cache",
+    )
+    parser.add_argument(
+        "--no_memory_governor", action="store_true", help="don't adjust parallel jobs by available memory"
+    )
+    parser.add_argument(
+        "--ram_build_dir",
+        default=Config.RAM_BUILD_DIR,
+        help="extract and build packages on this tmpfs mount, auto means /dev/shm; too large packages use build_tmp",
+    )
+    parser.add_argument(
+        "--ram_build_budget_mb",
+        type=int,
+        default=Config.RAM_BUILD_BUDGET_MB,
+        help="max total size of the build dirs in --ram_build_dir, 0 means half of the available memory",
+    )
+    parser.add_argument(
+        "--boost_components",
+        default=",".join(Config.BOOST_COMPONENTS),
+        help="comma separated boost libraries to build, e.g. filesystem,thread,log. empty means all",
+    )
+    parser.add_argument("--no_trace", action="store_true", help="don't write build_tmp/trace.json")
+    parser.add_argument(
+        "--arch_levels",
+        default=",".join(Config.ARCH_LEVELS),
+        help=f"comma separated x86-64 levels ({','.join(ArchVariants.LEVELS)}) built for ARCH_VARIANT_PACKAGES",
+    )
+    parser.add_argument(
+        "--benchmark", action="store_true", default=Config.BENCHMARK, help="measure the built libraries after the build"
+    )
+    parser.add_argument(
+        "--benchmark_update", action="store_true", help="accept the benchmark results as the new baseline"
+    )
+    parser.add_argument(
+        "--benchmark_threshold",
+        type=float,
+        default=Config.BENCHMARK_THRESHOLD,
+        help="fail if a benchmark is lower than its baseline by more than this ratio",
+    )
+    parser.add_argument(
+        "--pgo", action="store_true", default=Config.PGO, help="profile guided build of x264, x265, vpx and ffmpeg"
+    )
+    parser.add_argument(
+        "--cmake_generator",
+        choices=["auto", *Config.CMAKE_GENERATOR_NAMES],
+        default=Config.CMAKE_GENERATOR,
+        help="cmake generator on linux and android, auto means Ninja if ninja>=1.13 is installed (it joins the "
+        "jobserver), else Unix Makefiles. Without the jobserver any installed ninja is used",
+    )
+    parser.add_argument(
+        "--jobs", type=int, default=Config.PARALLEL_JOBS, help="total parallel compile jobs of all packages"
+    )
+    parser.add_argument(
+        "--parallel_packages", type=int, default=Config.PARALLEL_PACKAGES, help="max packages built at the same time"
+    )
+    args = parser.parse_known_intermixed_args(sys.argv[1:])
+    for key, value in [
+        ("build_type", args[0].build_type),
+        ("target_os", args[0].target_os),
+        ("clang", None if args[0].compiler is None else args[0].compiler == "clang"),
+        ("ndk_dir", args[0].ndk_dir),
+        ("api_level", args[0].api_level),
+    ]:
+        if value is not None:
+            Config.PROFILE[key] = value
+    Config.INTERACTIVE = Config.INTERACTIVE and not args[0].non_interactive
+    Config.MATRIX = [item.strip() for item in args[0].matrix.split(",") if item.strip()]
+    if args[0].debug_env:
+        Config.InitConfig()
+        Tools.Log(f"Debug env, next, exter new interactive shell...")
+        returncode = SUBPROCESS_RUN(env=Config.EnvDict()).returncode
+        Tools.Log(f"Exit with {returncode}!")
+        sys.exit(returncode)
+    Config.PARALLEL_JOBS = max(1, args[0].jobs)
+    Config.PARALLEL_PACKAGES = max(1, args[0].parallel_packages)
+    Config.ARTIFACT_CACHE = Config.ARTIFACT_CACHE and not args[0].no_artifact_cache
+    Config.SOURCE_CACHE = args[0].source_cache
+    Config.MEMORY_GOVERNOR = Config.MEMORY_GOVERNOR and not args[0].no_memory_governor
+    Config.RAM_BUILD_DIR = args[0].ram_build_dir
+    Config.RAM_BUILD_BUDGET_MB = max(0, args[0].ram_build_budget_mb)
+    Config.COMPILER_CACHE = args[0].compiler_cache
+    Config.TRACE = Config.TRACE and not args[0].no_trace
+    Config.CMAKE_GENERATOR = args[0].cmake_generator
+    Config.PGO = args[0].pgo
+    # 开关参数只能打开或关闭 profile 中的值, 没有指定时保留 profile 的值
+    Config.BENCHMARK_UPDATE = Config.BENCHMARK_UPDATE or args[0].benchmark_update
+    Config.BENCHMARK = args[0].benchmark or Config.BENCHMARK_UPDATE
+    Config.BENCHMARK_THRESHOLD = args[0].benchmark_threshold
+    Config.ARCH_LEVELS = [item.strip() for item in args[0].arch_levels.split(",") if item.strip()]
+    for level in Config.ARCH_LEVELS:
+        if level not in ArchVariants.LEVELS:
+            parser.error(f"unknown arch level {level}, expected {ArchVariants.LEVELS}")
+    Config.BOOST_COMPONENTS = [item.strip() for item in args[0].boost_components.split(",") if item.strip()]
+    Config.SPLIT_DEBUG = args[0].split_debug
+    Config.CONFIGURE_CACHE = args[0].configure_cache
+    targetOs = Config.PROFILE.get("target_os", "windows" if os.name == "nt" else "linux")
+    root = os.path.abspath(args[0].root or f"{Config.DIR_BASE}/3rd_root_{targetOs}")
+    if args[0].command == "package":
+        Bundle.WITH_DEBUG = args[0].with_debug
+        bundle = args[0].bundle or f"{root}{'.delta' if args[0].base else ''}.tar.zst"
+        Bundle.Package(root, bundle, args[0].base)
+        return
+    if args[0].command == "closure":
+        entries = [item.strip() for item in args[0].entries.split(",") if item.strip()]
+        if not entries:
+            parser.error("closure needs --entries")
+        Config.TARGET_OS = TargetOs[targetOs]
+        dest = os.path.abspath(args[0].dest or f"{root}_runtime")
+        RuntimeClosure.Run(root, entries, dest)
+        if args[0].bundle:
+            Bundle.Package(dest, args[0].bundle)
+        return
+    if args[0].command == "unpack":
+        if not args[0].bundle:
+            parser.error("unpack needs a bundle file")
+        Bundle.Unpack(args[0].bundle, args[0].dest)
+        return
+    CompilerCache.Init(Config.COMPILER_CACHE)
+    JobServer.Start(Config.PARALLEL_JOBS)
+    if Config.MATRIX:
+        BuildMatrix(Config.MATRIX, args[0].no_clean)
+    else:
+        BuildTarget(args[0].no_clean)
+
+
+if __name__ == "__main__":
+    Main()